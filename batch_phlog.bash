@@ -7,12 +7,12 @@ function show_help {
     echo """Usage: ./batch_phlog.bash -m mode -l load -s scope [-s scope]
 
 mode must be one of:
-  * reconstruct: Reconstruct the complete history of all specified scopes.  Also report on each one.  Could take hours per scope.
-  * incremental: Reconstruct new history for specified scopes based on the dates in the data.  Also report on each one.  Usually takes less than an hour per scope.
+  * reconstruct: Reconstruct the complete history of all specified scopes, together in one pass.  Also report on each one.  Could take hours.
+  * incremental: Reconstruct new history for specified scopes based on the dates in the data, together in one pass.  Also report on each one.  Usually takes less than an hour.  A load in this mode only applies the tasks that changed since the last load.
   * reports: Report on each specified scope.
 
 load must be one of:
-  * true:  Download a fresh database dump and load it into Phlogiston for use in reconstructions.  Takes an hour.
+  * true:  Download a fresh database dump and load it into Phlogiston for use in reconstructions.  Takes an hour, unless the dump hasn't changed since the last load.
   * false:  Don't.
 
 scope must match the name of a *scope*_scope.py and *scope*_recategorization.csv file
@@ -22,11 +22,17 @@ scope must match the name of a *scope*_scope.py and *scope*_recategorization.csv
 function load_dump {
     echo "$(date): Downloading new Phabricator dump"
     cd ${HOMEDIR}
-    rm phabricator_public.dump
-    wget -nv http://dumps.wikimedia.org/other/misc/phabricator_public.dump
+    # -N only downloads the dump if it is newer than the copy we have,
+    # and the load skips a dump it has already loaded
+    wget -nv -N http://dumps.wikimedia.org/other/misc/phabricator_public.dump
     echo "$(date): Loading loading new Phabricator dump"
     cd ${PHLOGDIR}
-    python3 -u phlogiston.py --load --verbose 2>&1
+    load_flag="--load"
+    if [[ "$mode" == "incremental" ]]
+    then
+        load_flag="--load --incremental"
+    fi
+    python3 -u phlogiston.py ${load_flag} --verbose 2>&1
 }
 
 while getopts "h?l:m:s:" opt; do
@@ -78,26 +84,42 @@ fi
 case "$mode" in
     reconstruct)
         reconstruct_flag="--reconstruct"
-        action="Complete Reconstruction and Report"
+        action="Complete Reconstruction"
         ;;
     incremental)
         reconstruct_flag="--reconstruct --incremental"
-        action="Incremental Reconstruction and Report"
+        action="Incremental Reconstruction"
         ;;
     reports)
         reconstruct_flag=""
-        action="Report"
         ;;
 esac
 
 cd ${PHLOGDIR}
+if [[ -n "$reconstruct_flag" ]]
+then
+    # All of the scopes are reconstructed together, in one pass over
+    # the tasks, rather than one after another
+    scope_flags=""
+    for scope in ${scope_list[@]}; do
+        scope_flags+=" --scope_prefix ${scope}"
+    done
+    start_datetime=`date '+%s'`
+    echo "$(date): Starting ${action} for ${scope_list[@]}"
+    python3 -u phlogiston.py ${reconstruct_flag} --verbose ${scope_flags} 2>&1
+    end_datetime=`date '+%s'`
+    let duration=end_datetime-start_datetime
+    minutes=$((duration/60))
+    echo "$(date) : Done with ${action} for ${scope_list[@]}.  ${minutes} minutes total."
+fi
+
 for scope in ${scope_list[@]}; do
     start_datetime=`date '+%s'`
-    echo "$(date): Starting ${action} for ${scope}"
-    python3 -u phlogiston.py ${reconstruct_flag} --report --verbose --scope_prefix ${scope} 2>&1
+    echo "$(date): Starting Report for ${scope}"
+    python3 -u phlogiston.py --report --verbose --scope_prefix ${scope} 2>&1
     end_datetime=`date '+%s'`
     let duration=end_datetime-start_datetime
     minutes=$((duration/60))
 
-    echo "$(date) : Done with ${action} for ${scope}.  ${minutes} minutes total."
+    echo "$(date) : Done with Report for ${scope}.  ${minutes} minutes total."
 done
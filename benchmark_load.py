@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+"""Time phlogiston.py --load against a synthetic Phabricator dump and
+report rows per second.
+
+The target database must already exist and have been set up with
+phlogiston.py --initialize.  Its loaded data is replaced.
+"""
+
+import getopt
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import psycopg2
+
+LOADED_TABLES = ['phabricator_project', 'phabricator_column', 'maniphest_task',
+                 'maniphest_transaction', 'maniphest_blocked_phid',
+                 'maniphest_edge_transaction', 'maniphest_edge_interval',
+                 'maniphest_blocked']
+
+
+def main(argv):
+    try:
+        opts, args = getopt.getopt(argv, "b:hj:t:", ["dbname=", "help", "jobs=", "tasks="])
+    except getopt.GetoptError as e:
+        print(e)
+        usage()
+        sys.exit(2)
+    dbname = 'phlogiston_benchmark'
+    task_count = 20000
+    jobs = 1
+    for opt, arg in opts:
+        if opt in ("-b", "--dbname"):
+            dbname = arg
+        elif opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt in ("-t", "--tasks"):
+            task_count = int(arg)
+
+    dump_file = tempfile.NamedTemporaryFile('w', suffix='.dump', delete=False)
+    write_dump(dump_file, task_count)
+    dump_file.close()
+
+    start = time.time()
+    subprocess.check_call([sys.executable, 'phlogiston.py', '--load', '--force', '--verbose',
+                           '--dbname', dbname, '--dumpfile', dump_file.name,
+                           '--jobs', str(jobs)])
+    elapsed = time.time() - start
+    os.remove(dump_file.name)
+
+    conn = psycopg2.connect('dbname={0}'.format(dbname))
+    cur = conn.cursor()
+    total = 0
+    for table in LOADED_TABLES:
+        cur.execute('SELECT count(*) FROM {0}'.format(table))
+        count = cur.fetchone()[0]
+        total += count
+        print('{0:30} {1:10} rows'.format(table, count))
+    conn.close()
+    print('{0} rows in {1:.1f} seconds: {2:.0f} rows/sec'.format(total, elapsed, total / elapsed))
+
+
+def usage():
+    print("""Usage:\n
+  --dbname  Database to load into.  Defaults to phlogiston_benchmark.\n
+  --jobs    Number of processes to load with.  Defaults to 1.\n
+  --tasks   Number of tasks in the synthetic dump.  Defaults to 20000.\n""")
+
+
+def write_dump(dump_file, task_count):
+    """ Write a dump with the same shape as phabricator_public.dump: a
+    project section with projects and columns, and a task section with
+    info, edges and transactions for each task."""
+    rnd = random.Random(0)
+    project_ids = list(range(1, 201))
+    projects = [[i, 'Project {0}'.format(i), 'PHID-PROJ-{0:020d}'.format(i)]
+                for i in project_ids]
+    columns = [[i, 'PHID-PCOL-{0:020d}'.format(i), 'Column {0}'.format(i), 0, 0,
+                'PHID-PROJ-{0:020d}'.format(1 + i % 200)] for i in range(1, 1001)]
+    dump_file.write('{"project": ')
+    json.dump({'projects': projects, 'columns': columns}, dump_file)
+    dump_file.write(', "task": {')
+    trans_id = 0
+    start = 1420070400
+    for task_id in range(1, task_count + 1):
+        task_phid = 'PHID-TASK-{0:020d}'.format(task_id)
+        when = start + rnd.randint(0, 86400 * 1000)
+        transactions = []
+        edges = set(rnd.sample(project_ids, 2))
+        for i in range(rnd.randint(5, 60)):
+            trans_id += 1
+            when += rnd.randint(0, 86400 * 5)
+            kind = rnd.random()
+            if kind < 0.2:
+                trans = ['status', '"open"', rnd.choice(['"open"', '"resolved"']), None]
+            elif kind < 0.3:
+                board = rnd.choice(sorted(edges))
+                trans = ['core:columns', 'null',
+                         json.dumps([{'boardPHID': 'PHID-PROJ-{0:020d}'.format(board),
+                                      'columnPHID': 'PHID-PCOL-{0:020d}'.format(board)}]),
+                         None]
+            elif kind < 0.4:
+                added = rnd.choice(project_ids)
+                edges.add(added)
+                trans = ['core:edge', '[]', json.dumps(['PHID-PROJ-{0:020d}'.format(added)]),
+                         '{"edge:type":41}']
+            else:
+                trans = ['core:comment', 'null', 'comment {0}'.format(trans_id), None]
+            transactions.append([trans_id, 'PHID-XACT-{0:020d}'.format(trans_id), 0, task_phid,
+                                 0, 0] + trans[:3] + [trans[3], 0, when])
+        info = [task_id, task_phid, 0, 0, 'open', 0, 'Task {0}'.format(task_id), 0, 0, 0, '3']
+        edge = []
+        if task_id > 1 and rnd.random() < 0.1:
+            edge.append([task_phid, 3, 'PHID-TASK-{0:020d}'.format(rnd.randint(1, task_id - 1))])
+        if task_id > 1:
+            dump_file.write(', ')
+        dump_file.write('"{0}": '.format(task_id))
+        json.dump({'info': info, 'edge': edge, 'transactions': {'0': transactions}}, dump_file)
+    dump_file.write('}}')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,3 +1,29 @@
+CREATE OR REPLACE FUNCTION build_blocked_closure(
+) RETURNS void AS $$
+
+  -- UNION rather than UNION ALL drops pairs already found, so the
+  -- recursion stops at cycles in the blocked graph
+  DELETE FROM maniphest_blocked_closure;
+
+  INSERT INTO maniphest_blocked_closure
+  WITH RECURSIVE closure(ancestor_id, descendant_id) AS (
+         SELECT parent_id,
+                child_id
+           FROM maniphest_blocked
+          UNION
+         SELECT c.ancestor_id,
+                mb.child_id
+           FROM closure c,
+                maniphest_blocked mb
+          WHERE mb.parent_id = c.descendant_id
+  )
+  SELECT ancestor_id,
+         descendant_id
+    FROM closure;
+
+$$ LANGUAGE SQL VOLATILE;
+
+
 CREATE OR REPLACE FUNCTION convert_blocked_phid_to_id_sql(
 ) RETURNS void AS $$
 
@@ -10,3 +36,382 @@ CREATE OR REPLACE FUNCTION convert_blocked_phid_to_id_sql(
      AND mb.blocked_by_phid = mt2.phid
 
 $$ LANGUAGE SQL VOLATILE;
+
+CREATE OR REPLACE FUNCTION get_loading_tables(
+) RETURNS text[] AS $$
+
+  -- Referenced tables come before the tables that refer to them
+  SELECT ARRAY['loaded_dump',
+               'phabricator_project',
+               'maniphest_task',
+               'phabricator_column',
+               'maniphest_transaction',
+               'maniphest_edge_transaction',
+               'maniphest_edge_interval',
+               'maniphest_column_interval',
+               'maniphest_attribute_interval',
+               'maniphest_blocked_phid',
+               'maniphest_blocked',
+               'maniphest_blocked_closure']
+
+$$ LANGUAGE SQL IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION get_loading_views(
+) RETURNS text[] AS $$
+
+  SELECT ARRAY['maniphest_edge']
+
+$$ LANGUAGE SQL IMMUTABLE;
+
+
+CREATE OR REPLACE FUNCTION set_loading_tables_logged(
+       load_schema text,
+       logged boolean
+) RETURNS void AS $$
+DECLARE
+  loading_tables text[] := get_loading_tables();
+BEGIN
+    -- A logged table can't refer to an unlogged one, so referenced
+    -- tables are made logged first and unlogged last
+    IF logged THEN
+        FOR i IN 1 .. array_length(loading_tables, 1)
+        LOOP
+            EXECUTE format('ALTER TABLE %I.%I SET LOGGED', load_schema, loading_tables[i]);
+        END LOOP;
+    ELSE
+        FOR i IN REVERSE array_length(loading_tables, 1) .. 1
+        LOOP
+            EXECUTE format('ALTER TABLE %I.%I SET UNLOGGED', load_schema, loading_tables[i]);
+        END LOOP;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION swap_in_loaded_tables(
+       load_schema text,
+       live_schema text
+) RETURNS void AS $$
+DECLARE
+  loading_tables text[] := get_loading_tables();
+  loading_view text;
+BEGIN
+    -- Runs as one transaction, so readers see either the old tables
+    -- or the new ones, and a failure leaves the old ones in place
+    FOREACH loading_view IN ARRAY get_loading_views()
+    LOOP
+        EXECUTE format('DROP VIEW IF EXISTS %I.%I', live_schema, loading_view);
+    END LOOP;
+
+    FOR i IN REVERSE array_length(loading_tables, 1) .. 1
+    LOOP
+        EXECUTE format('DROP TABLE IF EXISTS %I.%I', live_schema, loading_tables[i]);
+    END LOOP;
+
+    FOR i IN 1 .. array_length(loading_tables, 1)
+    LOOP
+        EXECUTE format('ALTER TABLE %I.%I SET SCHEMA %I', load_schema, loading_tables[i], live_schema);
+    END LOOP;
+
+    FOREACH loading_view IN ARRAY get_loading_views()
+    LOOP
+        EXECUTE format('ALTER VIEW %I.%I SET SCHEMA %I', load_schema, loading_view, live_schema);
+    END LOOP;
+
+    EXECUTE format('DROP SCHEMA %I', load_schema);
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION get_loaded_task_signatures(
+) RETURNS TABLE(id int, signature text) AS $$
+
+  -- Must match get_task_signature() in phlogiston.py
+  SELECT mt.id,
+         md5(concat_ws(E'\x1f',
+                       coalesce(mt.phid, '\N'),
+                       coalesce(mt.title, '\N'),
+                       coalesce(mt.story_points, '\N'),
+                       coalesce(mt.status_at_load, '\N'),
+                       coalesce(tx.transactions, '')))
+    FROM maniphest_task mt
+    LEFT OUTER JOIN (
+         SELECT task_id,
+                string_agg(id || ' ' || to_char(date_modified, 'MM/DD/YYYY HH24:MI:SS'),
+                           ',' ORDER BY id) AS transactions
+           FROM maniphest_transaction
+          GROUP BY task_id) AS tx ON tx.task_id = mt.id
+
+$$ LANGUAGE SQL STABLE;
+
+
+CREATE OR REPLACE FUNCTION merge_incoming_load(
+) RETURNS void AS $$
+BEGIN
+    -- Projects and columns are added or renamed, never removed
+    INSERT INTO phabricator_project
+    SELECT *
+      FROM incoming_phabricator_project ip
+     WHERE NOT EXISTS (SELECT *
+                         FROM phabricator_project pp
+                        WHERE pp.id = ip.id);
+
+    UPDATE phabricator_project pp
+       SET name = ip.name
+      FROM incoming_phabricator_project ip
+     WHERE pp.id = ip.id
+       AND pp.name IS DISTINCT FROM ip.name;
+
+    INSERT INTO phabricator_column
+    SELECT *
+      FROM incoming_phabricator_column ic
+     WHERE NOT EXISTS (SELECT *
+                         FROM phabricator_column pc
+                        WHERE pc.id = ic.id);
+
+    UPDATE phabricator_column pc
+       SET name = ic.name,
+           project_phid = ic.project_phid
+      FROM incoming_phabricator_column ic
+     WHERE pc.id = ic.id
+       AND (pc.name, pc.project_phid) IS DISTINCT FROM (ic.name, ic.project_phid);
+
+    -- incoming_maniphest_task holds only new and changed tasks, and
+    -- the other incoming task tables all of the rows for them
+    INSERT INTO maniphest_task
+    SELECT *
+      FROM incoming_maniphest_task it
+     WHERE NOT EXISTS (SELECT *
+                         FROM maniphest_task mt
+                        WHERE mt.id = it.id);
+
+    UPDATE maniphest_task mt
+       SET phid = it.phid,
+           title = it.title,
+           story_points = it.story_points,
+           status_at_load = it.status_at_load
+      FROM incoming_maniphest_task it
+     WHERE mt.id = it.id;
+
+    DELETE FROM maniphest_edge_transaction
+     WHERE task_id IN (SELECT id FROM incoming_maniphest_task);
+
+    DELETE FROM maniphest_edge_interval
+     WHERE task IN (SELECT id FROM incoming_maniphest_task);
+
+    DELETE FROM maniphest_column_interval
+     WHERE task IN (SELECT id FROM incoming_maniphest_task);
+
+    DELETE FROM maniphest_attribute_interval
+     WHERE task IN (SELECT id FROM incoming_maniphest_task);
+
+    DELETE FROM maniphest_transaction mt
+     WHERE mt.task_id IN (SELECT id FROM incoming_maniphest_task)
+       AND NOT EXISTS (SELECT *
+                         FROM incoming_maniphest_transaction itr
+                        WHERE itr.id = mt.id);
+
+    UPDATE maniphest_transaction mt
+       SET phid = itr.phid,
+           object_phid = itr.object_phid,
+           transaction_type = itr.transaction_type,
+           old_value = itr.old_value,
+           new_value = itr.new_value,
+           date_modified = itr.date_modified,
+           metadata = itr.metadata
+      FROM incoming_maniphest_transaction itr
+     WHERE mt.id = itr.id
+       AND mt.date_modified IS DISTINCT FROM itr.date_modified;
+
+    INSERT INTO maniphest_transaction
+    SELECT *
+      FROM incoming_maniphest_transaction itr
+     WHERE NOT EXISTS (SELECT *
+                         FROM maniphest_transaction mt
+                        WHERE mt.id = itr.id);
+
+    INSERT INTO maniphest_edge_transaction
+    SELECT *
+      FROM incoming_maniphest_edge_transaction;
+
+    PERFORM insert_edge_intervals(ARRAY(SELECT id FROM incoming_maniphest_task));
+    PERFORM insert_column_intervals(ARRAY(SELECT id FROM incoming_maniphest_task));
+    PERFORM insert_attribute_intervals(ARRAY(SELECT id FROM incoming_maniphest_task));
+
+    -- Blocked edges come from the current state of every task in the
+    -- dump, not from transactions, so they are replaced outright
+    DELETE FROM maniphest_blocked;
+    DELETE FROM maniphest_blocked_phid;
+    INSERT INTO maniphest_blocked_phid
+    SELECT *
+      FROM incoming_maniphest_blocked_phid;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION insert_attribute_intervals(
+       task_ids int[]
+) RETURNS void AS $$
+
+  -- Derive maniphest_attribute_interval rows from the status, priority
+  -- and points transactions of task_ids, or of every task if task_ids
+  -- is NULL.  A transaction takes effect at the first midnight at or
+  -- after it, and the last one of each type before each midnight sets
+  -- the value for that day.  Of transactions at the same time, the one
+  -- with the lowest id is the last.
+  WITH effective AS (
+       SELECT DISTINCT ON (task_id, transaction_type, effective_date)
+              task_id,
+              transaction_type,
+              new_value,
+              effective_date
+         FROM (SELECT task_id,
+                      id,
+                      transaction_type,
+                      date_modified,
+                      new_value,
+                      CASE WHEN date_modified = date_trunc('day', date_modified)
+                           THEN date(date_modified)
+                           ELSE date(date_modified) + 1
+                      END AS effective_date
+                 FROM maniphest_transaction
+                WHERE transaction_type IN ('status', 'priority', 'points')
+                  AND ($1 IS NULL
+                       OR task_id = ANY($1))) AS tt
+        ORDER BY task_id, transaction_type, effective_date, date_modified DESC, id
+  )
+  INSERT INTO maniphest_attribute_interval
+  SELECT task_id,
+         transaction_type,
+         new_value,
+         CASE WHEN transaction_type = 'points'
+               AND new_value ~ '^\s*[-+]?[0-9]{1,9}\s*$'
+              THEN new_value::int
+         END,
+         effective_date,
+         lead(effective_date) OVER (PARTITION BY task_id, transaction_type
+                                        ORDER BY effective_date)
+    FROM effective;
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+CREATE OR REPLACE FUNCTION insert_column_intervals(
+       task_ids int[]
+) RETURNS void AS $$
+
+  -- Derive maniphest_column_interval rows from the core:columns
+  -- transactions of task_ids, or of every task if task_ids is NULL.  A
+  -- transaction takes effect at the first midnight at or after it, and
+  -- the last one on each board before each midnight sets the task's
+  -- column on that board for that day.  Of transactions at the same
+  -- time, the one with the lowest id is the last.
+  WITH effective AS (
+       SELECT DISTINCT ON (task_id, board_phid, effective_date)
+              task_id,
+              board_phid,
+              column_phid,
+              effective_date
+         FROM (SELECT task_id,
+                      id,
+                      date_modified,
+                      new_value::json -> 0 ->> 'boardPHID' AS board_phid,
+                      new_value::json -> 0 ->> 'columnPHID' AS column_phid,
+                      CASE WHEN date_modified = date_trunc('day', date_modified)
+                           THEN date(date_modified)
+                           ELSE date(date_modified) + 1
+                      END AS effective_date
+                 FROM maniphest_transaction
+                WHERE transaction_type = 'core:columns'
+                  AND ($1 IS NULL
+                       OR task_id = ANY($1))) AS ct
+        ORDER BY task_id, board_phid, effective_date, date_modified DESC, id
+  )
+  INSERT INTO maniphest_column_interval
+  SELECT e.task_id,
+         pp.id,
+         e.column_phid,
+         e.effective_date,
+         lead(e.effective_date) OVER (PARTITION BY e.task_id, e.board_phid
+                                          ORDER BY e.effective_date)
+    FROM effective e,
+         phabricator_project pp
+   WHERE pp.phid = e.board_phid;
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+CREATE OR REPLACE FUNCTION insert_edge_intervals(
+       task_ids int[]
+) RETURNS void AS $$
+
+  -- Derive maniphest_edge_interval rows from the edge transactions of
+  -- task_ids, or of every task if task_ids is NULL.  A transaction
+  -- takes effect at the first midnight at or after it, which is how
+  -- date_modified compares to a date, and the last one before each
+  -- midnight sets the edges for that day.
+  WITH effective AS (
+       SELECT DISTINCT ON (task_id, effective_date)
+              task_id,
+              effective_date,
+              edges
+         FROM (SELECT task_id,
+                      date_modified,
+                      edges,
+                      CASE WHEN date_modified = date_trunc('day', date_modified)
+                           THEN date(date_modified)
+                           ELSE date(date_modified) + 1
+                      END AS effective_date
+                 FROM maniphest_edge_transaction
+                WHERE $1 IS NULL
+                   OR task_id = ANY($1)) AS et
+        ORDER BY task_id, effective_date, date_modified DESC
+  ), spans AS (
+       SELECT DISTINCT
+              task_id AS task,
+              unnest(edges) AS project,
+              effective_date AS valid_from,
+              lead(effective_date) OVER (PARTITION BY task_id
+                                             ORDER BY effective_date) AS valid_to
+         FROM effective
+  ), islands AS (
+       -- consecutive spans with the same project are merged
+       SELECT task,
+              project,
+              valid_from,
+              valid_to,
+              count(*) FILTER (WHERE starts_island) OVER (PARTITION BY task, project
+                                                              ORDER BY valid_from) AS island
+         FROM (SELECT *,
+                      valid_from IS DISTINCT FROM lag(valid_to) OVER (PARTITION BY task, project
+                                                                          ORDER BY valid_from)
+                        AS starts_island
+                 FROM spans) AS s
+  )
+  INSERT INTO maniphest_edge_interval
+  SELECT task,
+         project,
+         min(valid_from),
+         (array_agg(valid_to ORDER BY valid_from DESC))[1]
+    FROM islands
+   GROUP BY task, project, island;
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+DROP FUNCTION IF EXISTS set_loaded_dump(text, text, text, text, text);
+
+CREATE OR REPLACE FUNCTION set_loaded_dump(
+       fingerprint text,
+       dump_path text,
+       project_digest text,
+       column_digest text
+) RETURNS void AS $$
+
+  DELETE FROM loaded_dump;
+
+  INSERT INTO loaded_dump
+  VALUES ($1, $2, now(), $3, $4);
+
+$$ LANGUAGE SQL VOLATILE;
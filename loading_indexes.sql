@@ -0,0 +1,63 @@
+ALTER TABLE phabricator_project
+  ADD PRIMARY KEY (id),
+  ADD UNIQUE (phid);
+
+ALTER TABLE maniphest_task
+  ADD PRIMARY KEY (id),
+  ADD UNIQUE (phid);
+
+ALTER TABLE phabricator_column
+  ADD PRIMARY KEY (id),
+  ADD UNIQUE (phid),
+  ADD FOREIGN KEY (project_phid) REFERENCES phabricator_project (phid);
+
+ALTER TABLE maniphest_transaction
+  ADD PRIMARY KEY (id),
+  ADD UNIQUE (phid),
+  ADD FOREIGN KEY (task_id) REFERENCES maniphest_task;
+
+CREATE INDEX ON maniphest_transaction (date_modified, transaction_type, task_id);
+CREATE INDEX ON maniphest_transaction (transaction_type, task_id);
+CREATE INDEX ON maniphest_transaction (task_id);
+
+ALTER TABLE maniphest_edge_transaction
+  ADD FOREIGN KEY (task_id) REFERENCES maniphest_task;
+
+CREATE INDEX ON maniphest_edge_transaction (task_id, date_modified);
+
+ALTER TABLE maniphest_edge_interval
+  ADD FOREIGN KEY (task) REFERENCES maniphest_task (id);
+
+CREATE INDEX ON maniphest_edge_interval (task, project);
+CREATE INDEX ON maniphest_edge_interval (project);
+CREATE INDEX ON maniphest_edge_interval USING gist (daterange(valid_from, valid_to));
+
+ALTER TABLE maniphest_column_interval
+  ADD FOREIGN KEY (task) REFERENCES maniphest_task (id);
+
+CREATE INDEX ON maniphest_column_interval (task, project, valid_from);
+CREATE INDEX ON maniphest_column_interval (column_phid);
+
+ALTER TABLE maniphest_attribute_interval
+  ADD FOREIGN KEY (task) REFERENCES maniphest_task (id);
+
+CREATE INDEX ON maniphest_attribute_interval (task, attribute, valid_from);
+CREATE INDEX ON maniphest_attribute_interval USING gist (daterange(valid_from, valid_to));
+
+-- No RI for maniphest_blocked_phid because otherwise we would have to
+-- load all tasks before any blocks
+
+CREATE INDEX ON maniphest_blocked_phid (blocks_phid);
+CREATE INDEX ON maniphest_blocked_phid (blocked_by_phid);
+
+ALTER TABLE maniphest_blocked
+  ADD FOREIGN KEY (parent_id) REFERENCES maniphest_task (id),
+  ADD FOREIGN KEY (child_id) REFERENCES maniphest_task (id);
+
+CREATE INDEX ON maniphest_blocked (parent_id);
+CREATE INDEX ON maniphest_blocked (child_id);
+
+ALTER TABLE maniphest_blocked_closure
+  ADD PRIMARY KEY (ancestor_id, descendant_id);
+
+CREATE INDEX ON maniphest_blocked_closure (descendant_id);
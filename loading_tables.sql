@@ -1,37 +1,60 @@
 CREATE EXTENSION IF NOT EXISTS intarray;
 
+-- CASCADE takes the maniphest_edge view with it.  maniphest_edge
+-- was a per-day table in older versions.
+DROP TABLE IF EXISTS maniphest_edge_interval CASCADE;
+DROP TABLE IF EXISTS maniphest_column_interval;
+DROP TABLE IF EXISTS maniphest_attribute_interval;
+DROP TABLE IF EXISTS maniphest_edge;
+DROP TABLE IF EXISTS maniphest_blocked_closure;
 DROP TABLE IF EXISTS maniphest_blocked;
 DROP TABLE IF EXISTS maniphest_edge_transaction;
 DROP TABLE IF EXISTS maniphest_transaction;
 DROP TABLE IF EXISTS maniphest_task;
 DROP TABLE IF EXISTS phabricator_column;
 DROP TABLE IF EXISTS phabricator_project;
+DROP TABLE IF EXISTS loaded_dump;
+
+-- The dump the loading tables were loaded from.  fingerprint is a
+-- digest of the whole file, and project_digest and column_digest of
+-- the text of the projects and columns in it.
+CREATE TABLE loaded_dump (
+       fingerprint text,
+       dump_path text,
+       loaded_at timestamp with time zone,
+       project_digest text,
+       column_digest text
+);
+
+-- Keys, foreign keys and indexes for these tables are in
+-- loading_indexes.sql, so that a staged load can add them after the
+-- data is in.
 
 CREATE TABLE phabricator_project (
-       id int primary key,
+       id int,
        name text,
-       phid text unique
+       phid text
 );
 
 CREATE TABLE maniphest_task (
-       id int primary key,
-       phid text unique,
+       id int,
+       phid text,
        title text,
        story_points text,
        status_at_load text
 );
 
 CREATE TABLE phabricator_column (
-       id int primary key,
-       phid text unique,
+       id int,
+       phid text,
        name text,
-       project_phid text references phabricator_project (phid)
+       project_phid text
 );
 
 CREATE TABLE maniphest_transaction (
-       id int primary key,
-       phid text unique,
-       task_id int references maniphest_task,
+       id int,
+       phid text,
+       task_id int,
        object_phid text,
        transaction_type text,
        old_value text,
@@ -40,12 +63,8 @@ CREATE TABLE maniphest_transaction (
        metadata text
 );
 
-CREATE INDEX on maniphest_transaction (date_modified, transaction_type, task_id);
-CREATE INDEX on maniphest_transaction (transaction_type, task_id);
-CREATE INDEX on maniphest_transaction (task_id);
-
 CREATE TABLE maniphest_edge_transaction (
-       task_id int references maniphest_task,
+       task_id int,
        date_modified timestamp with time zone,
        old_value int[],
        new_value int[],
@@ -53,10 +72,46 @@ CREATE TABLE maniphest_edge_transaction (
        edges int[]
 );
 
-CREATE INDEX ON maniphest_edge_transaction (task_id, date_modified);
+-- Each row says that task had an edge to project from valid_from
+-- through the day before valid_to, or through today if valid_to is
+-- NULL.  Days are counted the way reconstruction counts them: a task
+-- is in a project on a day if it was at midnight at the start of it.
+CREATE TABLE maniphest_edge_interval (
+       task int,
+       project int,
+       valid_from date,
+       valid_to date
+);
+
+-- Each row says that task was in column_phid on project's board from
+-- valid_from through the day before valid_to, or through today if
+-- valid_to is NULL, counting days the same way as
+-- maniphest_edge_interval.  Derived from the core:columns transactions
+-- by insert_column_intervals, so that their JSON is only decoded once.
+CREATE TABLE maniphest_column_interval (
+       task int,
+       project int,
+       column_phid text,
+       valid_from date,
+       valid_to date
+);
+
+-- Each row says that the task's status, priority or points, as named
+-- by attribute, was value from valid_from through the day before
+-- valid_to, or through today if valid_to is NULL, counting days the
+-- same way as maniphest_edge_interval.  points holds value as an
+-- integer for the points attribute, or NULL if it isn't one.  Derived
+-- from the transactions by insert_attribute_intervals; see
+-- get_task_attribute for as-of lookups.
+CREATE TABLE maniphest_attribute_interval (
+       task int,
+       attribute text CHECK (attribute IN ('status', 'priority', 'points')),
+       value text,
+       points int,
+       valid_from date,
+       valid_to date
+);
 
--- No RI for this table because otherwise we would have to load all
--- tasks before any blocks
 DROP TABLE IF EXISTS maniphest_blocked_phid;
 
 CREATE TABLE maniphest_blocked_phid (
@@ -65,14 +120,28 @@ CREATE TABLE maniphest_blocked_phid (
        blocked_by_phid text
 );
 
-CREATE INDEX ON maniphest_blocked_phid (blocks_phid);
-CREATE INDEX ON maniphest_blocked_phid (blocked_by_phid);
-
 CREATE TABLE maniphest_blocked (
        blocked_date date,
-       parent_id int references maniphest_task (id),
-       child_id int references maniphest_task (id)
+       parent_id int,
+       child_id int
+);
+
+-- Every task blocked by each task, directly or through other tasks.
+-- Built from maniphest_blocked by build_blocked_closure after each
+-- load.
+CREATE TABLE maniphest_blocked_closure (
+       ancestor_id int,
+       descendant_id int
 );
 
-CREATE INDEX ON maniphest_blocked (parent_id);
-CREATE INDEX ON maniphest_blocked (child_id);
+-- One row per task, project and day, the way maniphest_edge used to
+-- be stored.  Reconstruction and reporting use maniphest_edge_interval
+-- directly; this is for ad hoc queries.
+CREATE VIEW maniphest_edge AS
+SELECT task,
+       project,
+       date::date
+  FROM maniphest_edge_interval,
+       generate_series(valid_from::timestamp,
+                       coalesce(valid_to - 1, greatest(valid_from, current_date))::timestamp,
+                       interval '1 day') AS date;
@@ -129,7 +129,7 @@ SELECT COUNT(*),
        category_title,
        project,
        projectcolumn
-  FROM task_on_date
+  FROM task_history
  WHERE scope = :'scope_prefix'
  GROUP BY category_title, project, projectcolumn
  ORDER BY category_title, project, projectcolumn
@@ -139,8 +139,7 @@ SELECT COUNT(*),
    Maintenance fraction
 Divide all resolved work into Maintenance or New Project, by week. */
 
-DELETE FROM maintenance_week where scope = :'scope_prefix';
-DELETE FROM maintenance_delta where scope = :'scope_prefix';
+SELECT truncate_scope_partitions(:'scope_prefix', ARRAY['maintenance_week', 'maintenance_delta']);
 
 INSERT INTO maintenance_week (
 SELECT scope,
@@ -237,9 +236,8 @@ SELECT ROUND(100 * maint_count::decimal / nullif((maint_count + new_count),0),0)
 ) TO '/tmp/phlog/maintenance_fraction_total_by_count.csv' DELIMITER ',' CSV;
 
 /* ####################################################################
-Burnup and Velocity and Forecasts */
-
-SELECT calculate_velocities(:'scope_prefix');
+Burnup and Velocity and Forecasts
+   The velocities and their rollups are calculated by update_reporting_tables. */
 
 COPY (
 SELECT date,
@@ -351,43 +349,40 @@ ORDER BY sort_order
 ) TO '/tmp/phlog/forecast_done.csv' DELIMITER ',' CSV HEADER;
 
 COPY (
-SELECT v.week AS date,
-       z.sort_order,
-       MAX(v.category) AS category,
-       SUM(v.delta_points_resolved) AS points,
-       SUM(v.delta_count_resolved) AS count
-  FROM velocity v
-  LEFT OUTER JOIN category z ON v.scope = z.scope AND v.category = z.title
- WHERE v.scope = :'scope_prefix'
-   AND date >= current_date - interval '3 months'
- GROUP BY week, sort_order
- ORDER BY week, sort_order
+SELECT date,
+       sort_order,
+       category,
+       points,
+       count
+  FROM velocity_rollup
+ WHERE scope = :'scope_prefix'
+   AND period = 'week'
+   AND last_date >= current_date - interval '3 months'
+ ORDER BY date, sort_order
 ) to '/tmp/phlog/recently_closed_week.csv' DELIMITER ',' CSV HEADER;
 
 COPY (
-SELECT v.month AS date,
-       z.sort_order,
-       MAX(v.category) AS category,
-       SUM(v.delta_points_resolved) AS points,
-       SUM(v.delta_count_resolved) AS count
-  FROM velocity v
-  LEFT OUTER JOIN category z ON v.scope = z.scope AND v.category = z.title
- WHERE v.scope = :'scope_prefix'
- GROUP BY month, sort_order
- ORDER BY month, sort_order
+SELECT date,
+       sort_order,
+       category,
+       points,
+       count
+  FROM velocity_rollup
+ WHERE scope = :'scope_prefix'
+   AND period = 'month'
+ ORDER BY date, sort_order
 ) to '/tmp/phlog/recently_closed_month.csv' DELIMITER ',' CSV HEADER;
 
 COPY (
-SELECT v.quarter AS date,
-       z.sort_order,
-       MAX(v.category) AS category,
-       SUM(v.delta_points_resolved) AS points,
-       SUM(v.delta_count_resolved) AS count
-  FROM velocity v
-  LEFT OUTER JOIN category z ON v.scope = z.scope AND v.category = z.title
- WHERE v.scope = :'scope_prefix'
- GROUP BY quarter, sort_order
- ORDER BY quarter, sort_order
+SELECT date,
+       sort_order,
+       category,
+       points,
+       count
+  FROM velocity_rollup
+ WHERE scope = :'scope_prefix'
+   AND period = 'quarter'
+ ORDER BY date, sort_order
 ) to '/tmp/phlog/recently_closed_quarter.csv' DELIMITER ',' CSV HEADER;
 
 /* ####################################################################
@@ -400,12 +395,12 @@ SELECT COUNT(points) as count,
   FROM (
 SELECT points,
        priority
-  FROM task_on_date
+  FROM task_history
  WHERE id in (SELECT DISTINCT id
-                FROM task_on_date
+                FROM task_history
                WHERE scope = :'scope_prefix')
    AND date = (SELECT MAX(date)
-                 FROM task_on_date
+                 FROM task_history
                 WHERE scope = :'scope_prefix')
    AND status = 'resolved') AS point_query
  GROUP BY points, priority
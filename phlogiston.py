@@ -1,15 +1,21 @@
 #!/usr/bin/python3
 
 import bisect
+import collections
 import configparser
 import csv
 import datetime
 from dateutil import relativedelta as rd
+import difflib
 import getopt
+import hashlib
+import io
 import json
+import multiprocessing
 import os.path
 import psycopg2
 import pytz
+import re
 import subprocess
 import sys
 import time
@@ -20,10 +26,10 @@ from jinja2 import Template
 def main(argv):
     try:
         opts, args = getopt.getopt(
-            argv, "b:cde:hilnp:rs:v",
-            ["dbname=", "reconstruct", "debug", "enddate", "help", "initialize",
-             "load", "incremental", "scope_prefix=", "report", "startdate=",
-             "verbose"])
+            argv, "b:cde:f:hij:lnp:rs:v",
+            ["dbname=", "reconstruct", "debug", "enddate", "dumpfile=", "force", "help",
+             "initialize", "jobs=", "load", "incremental", "scope_prefix=", "report",
+             "resume", "startdate=", "verbose"])
     except getopt.GetoptError as e:
         print(e)
         usage()
@@ -33,13 +39,17 @@ def main(argv):
     reconstruct_data = False
     run_report = False
     incremental = False
+    force = False
+    resume = False
     global DEBUG
     global VERBOSE
     DEBUG = False
     VERBOSE = False
     start_date = ''
-    scope_prefix = ''
+    scope_prefixes = []
     dbname = 'phlogiston'
+    dump_path = '../phabricator_public.dump'
+    jobs = 1
     today = datetime.datetime.now().date()
 
     # Wikimedia Phabricator constants
@@ -61,9 +71,15 @@ def main(argv):
             DEBUG = True
         elif opt in ("-e", "--end-date"):
             end_date = arg
+        elif opt in ("-f", "--dumpfile"):
+            dump_path = arg
+        elif opt == "--force":
+            force = True
         elif opt in ("-h", "--help"):
             usage()
             sys.exit()
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
         elif opt in ("-l", "--load"):
             load_data = True
         elif opt in ("-i", "--initialize"):
@@ -71,9 +87,11 @@ def main(argv):
         elif opt in ("-n", "--incremental"):
             incremental = True
         elif opt in ("-p", "--scope_prefix"):
-            scope_prefix = arg
+            scope_prefixes.extend(arg.split(','))
         elif opt in ("-r", "--report"):
             run_report = True
+        elif opt == "--resume":
+            resume = True
         elif opt in ("-s", "--startdate"):
             start_date = read_date(arg)
         elif opt in ("-v", "--verbose"):
@@ -86,91 +104,26 @@ def main(argv):
         do_initialize(conn)
 
     if load_data:
-        load(conn, end_date)
+        load(conn, end_date, dump_path, jobs, incremental, force)
 
-    if scope_prefix:
-        config = configparser.ConfigParser()
-        config_filename = 'config/{0}_scope.py'.format(scope_prefix)
-        config.read(config_filename)
-
-        try:
-            scope_title = config['vars']['scope_title']
-        except KeyError as e:
-            print('Config file {0} is missing required parameter(s): {1}'.
-                  format(scope_prefix, e))
-            sys.exit(1)
-
-        show_points = True
-        if config.has_option('vars', 'show_points'):
-            if not config.getboolean('vars', 'show_points'):
-                show_points = False
-
-        show_count = True
-        if config.has_option('vars', 'show_count'):
-            if not config.getboolean('vars', 'show_count'):
-                show_count = False
-
-        default_points = None
-        if config.has_option('vars', 'default_points'):
-            default_points = config['vars']['default_points']
-
-        backlog_resolved_cutoff = None
-        if config.has_option('vars', 'backlog_resolved_cutoff'):
-            input_brc = config['vars']['backlog_resolved_cutoff']
-            if isinstance(read_date(input_brc), datetime.date):
-                backlog_resolved_cutoff = read_date(input_brc)
-            if input_brc.lower() in ['default', 'true', 't', 'yes', '1']:
-                backlog_resolved_cutoff = start_of_quarter(today)
-
-        status_report_start = start_of_quarter(today)
-        if config.has_option('vars', 'status_report_start'):
-            input_srs = config['vars']['status_report_start']
-            if isinstance(input_srs, int):
-                status_report_start = today - rd.relativedelta(days=input_srs)
-            elif isinstance(read_date(input_srs), datetime.date):
-                status_report_start = read_date(input_srs)
-
-        status_report_end = None
-        if config.has_option('vars', 'status_report_end'):
-            input_sre = config['vars']['status_report_end']
-            if isinstance(read_date(input_sre), datetime.date):
-                status_report_end = read_date(input_sre)
-
-        status_report_project = None
-        if config.has_option('vars', 'status_report_project'):
-            status_report_project = config['vars']['status_report_project']
-
-        retroactive_categories = False
-        if config.has_option('vars', 'retroactive_categories'):
-            if config.getboolean('vars', 'retroactive_categories'):
-                retroactive_categories = True
-
-        retroactive_points = False
-        if config.has_option('vars', 'retroactive_points'):
-            if config.getboolean('vars', 'retroactive_points'):
-                retroactive_points = True
-
-        if not start_date:
-            if config.has_option('vars', 'start_date'):
-                start_date = read_date(config['vars']['start_date'])
-            if not start_date:
-                start_date = start_of_quarter(today) - rd.relativedelta(months=+3)
+    scopes = [read_scope_config(scope_prefix, start_date, today)
+              for scope_prefix in scope_prefixes]
 
     if reconstruct_data:
-        if scope_prefix:
-            reconstruct(conn, default_points,
-                        start_date, end_date,
-                        scope_prefix, incremental,
-                        status_report_project)
+        if scopes:
+            reconstruct(conn, scopes, end_date, incremental, jobs, resume)
         else:
             print("Reconstruct specified without a scope_prefix.\n Please specify a scope_prefix with --scope_prefix.")  # noqa
     if run_report:
-        if scope_prefix:
-            report(conn, dbname, scope_prefix,
-                   scope_title, default_points,
-                   retroactive_categories, retroactive_points,
-                   backlog_resolved_cutoff, show_points, show_count, start_date,
-                   status_report_start, status_report_end, status_report_project)
+        if scopes:
+            for scope in scopes:
+                report(conn, dbname, scope['scope_prefix'],
+                       scope['scope_title'], scope['default_points'],
+                       scope['retroactive_categories'], scope['retroactive_points'],
+                       scope['backlog_resolved_cutoff'], scope['show_points'],
+                       scope['show_count'], scope['start_date'],
+                       scope['status_report_start'], scope['status_report_end'],
+                       scope['status_report_project'], scope['recently_closed_days'])
         else:
             print("Report specified without a scope_prefix.\nPlease specify a scope_prefix with --scope_prefix.")  # noqa
     conn.close()
@@ -185,8 +138,9 @@ def usage():
 At least one of:
   --initialize       to create or recreate database tables and stored
                      procedures.\n
-  --load             Load data from dump. This will wipe the previously
-                     loaded data, but not any reconstructed data.\n
+  --load             Load data from dump. This will replace the previously
+                     loaded data, but not any reconstructed data.  The
+                     previous data stays in place until the load finishes.\n
   --reconstruct      Use the loaded data to reconstruct a historical
                      record day by day, in the database.  This will wipe
                      previously reconstructed data for this scope_prefix unless
@@ -198,13 +152,29 @@ Optionally:
   --debug        to work on a small subset of data and see extra information.\n
   --enddate      ending date for loading and reconstruction, as YYYY-MM-DD.
                  Defaults to now.\n
+  --dumpfile     Phabricator dump to load.  Defaults to
+                 ../phabricator_public.dump.  Rows that can't be loaded are
+                 written to the same path with .rejects appended.\n
+  --force        With --load, load the dump even if it is the same as the
+                 last one loaded.\n
   --help         for this message.\n
+  --jobs         Number of processes to load or reconstruct with.  Defaults
+                 to 1.\n
   --incremental  Reconstruct only new data since the last reconstruction for
-                 this scope_prefix.  Faster.\n
+                 this scope_prefix.  With --load, apply only the tasks that
+                 are new or changed since the last load, in a single
+                 process.  Faster.\n
+  --resume       With --reconstruct, carry on with the last reconstruction
+                 of each scope_prefix from where it stopped, if it didn't
+                 finish.  The dates and the kind of reconstruction are the
+                 ones it started with.\n
   --scope_prefix Unique prefix, six letters or fewer, labeling the scope of
                  Phabricator projects to be included in the report.  There must
                  be a configuration file named [prefix]_scope.py.  This is
-                 required for reconstruct and report.\n
+                 required for reconstruct and report.  Give it more than
+                 once, or a comma-separated list, to reconstruct several
+                 scopes together in one pass over the tasks, and report on
+                 each of them.\n
   --startdate    The date reconstruction should start, as YYYY-MM-DD.\n
   --verbose      Show progress messages.\n""")
 
@@ -212,286 +182,357 @@ Optionally:
 def do_initialize(conn):
     cur = conn.cursor()
     cur.execute(open("loading_tables.sql", "r").read())
+    cur.execute(open("loading_indexes.sql", "r").read())
     cur.execute(open("loading_functions.sql", "r").read())
     cur.execute(open("reconstruction_tables.sql", "r").read())
     cur.execute(open("reconstruction_functions.sql", "r").read())
     cur.execute(open("reporting_tables.sql", "r").read())
     cur.execute(open("reporting_functions.sql", "r").read())
 
+    # Every scope in the config directory gets its partitions now; any
+    # other scope gets them when it is first wiped
+    for config_filename in sorted(os.listdir('config')):
+        if config_filename.endswith('_scope.py'):
+            cur.execute('SELECT create_scope_partitions(%s)',
+                        (config_filename[:-len('_scope.py')],))
 
-def load(conn, end_date):
-    cur = conn.cursor()
-
-    cur.execute(open("loading_tables.sql", "r").read())
-    log('Dump file load starting', 'load')
-    with open('../phabricator_public.dump') as dump_file:
-        data = json.load(dump_file)
-
-    ######################################################################
-    # Load project and project column data
-    ######################################################################
-
-    project_count = len(data['project']['projects'])
-    log('{0} projects loading'.format(project_count), 'load')
 
-    project_insert = ("""INSERT INTO phabricator_project
-                VALUES (%(id)s, %(name)s, %(phid)s)""")
-    for row in data['project']['projects']:
-        cur.execute(project_insert,
-                    {'id': row[0], 'name': row[1], 'phid': row[2]})
+def load(conn, end_date, dump_path, jobs=1, incremental=False, force=False):
+    cur = conn.cursor()
 
-    cur.execute("SELECT phid, id from phabricator_project")
-    project_phid_to_id_dict = dict(cur.fetchall())
+    # Skip a dump that is byte for byte the one last loaded.
+    log('Dump file fingerprinting', 'load')
+    fingerprint = get_dump_fingerprint(dump_path)
+    cur.execute('SELECT fingerprint FROM loaded_dump')
+    loaded_dump = cur.fetchone()
+    if loaded_dump and loaded_dump[0] == fingerprint and not force:
+        log('Dump {0} is unchanged since the last load.  Skipping the load.'.
+            format(fingerprint), 'load')
+        return
 
-    column_insert = ("""INSERT INTO phabricator_column
-                VALUES (%(id)s, %(phid)s, %(name)s, %(project_phid)s)""")
-    column_count = len(data['project']['columns'])
-    log('{0} columns loading'.format(column_count), 'load')
-    for row in data['project']['columns']:
-        phid = row[1]
-        project_phid = row[5]
-        if project_phid in project_phid_to_id_dict:
-            cur.execute(column_insert,
-                        {'id': row[0], 'phid': phid,
-                         'name': row[2], 'project_phid': project_phid})
-        else:
-            print("Data error for column {0}: project {1} doesn't exist.Skipping.".
-                  format(phid, project_phid))
+    project_data, digests = read_project_section(dump_path)
 
-    ######################################################################
-    # Load transactions and edges
-    ######################################################################
+    if incremental:
+        cur.execute('SELECT count(*) FROM maniphest_task')
+        if cur.fetchone()[0]:
+            load_incremental(conn, dump_path, fingerprint, project_data, digests)
+            return
+        log('Nothing loaded yet; loading the whole dump.', 'load')
+
+    # Load into unlogged shadow tables with no keys or indexes, in a
+    # schema of their own, and swap them in for the live tables only
+    # once they are complete.  Until then, anything reading the live
+    # tables sees the previous load.
+    cur.execute('SELECT current_schema()')
+    live_schema = cur.fetchone()[0]
+    cur.execute('DROP SCHEMA IF EXISTS {0} CASCADE'.format(LOAD_SCHEMA))
+    cur.execute('CREATE SCHEMA {0}'.format(LOAD_SCHEMA))
+    cur.execute('SET search_path TO {0}'.format(LOAD_SCHEMA))
+    cur.execute(open("loading_tables.sql", "r").read())
+    cur.execute('SET search_path TO {0}, {1}'.format(LOAD_SCHEMA, live_schema))
+    cur.execute('SELECT set_loading_tables_logged(%s, false)', (LOAD_SCHEMA,))
 
-    transaction_insert = """
-      INSERT INTO maniphest_transaction
-      VALUES (%(id)s, %(phid)s, %(task_id)s, %(object_phid)s,
-              %(transaction_type)s, %(old_value)s, %(new_value)s,
-              %(date_modified)s, %(metadata)s)"""
-
-    task_insert = """
-      INSERT INTO maniphest_task
-      VALUES (%(task_id)s, %(phid)s, %(title)s, %(story_points)s, %(status_at_load)s) """
-
-    blocked_insert = """
-      INSERT INTO maniphest_blocked_phid
-      VALUES (%(date)s, %(phid)s, %(blocked_phid)s) """
-
-    task_count = len(data['task'].keys())
-    log('Tasks, transactions, and edges for {0} tasks loading'.format(task_count), 'load')
-    for task_id in data['task'].keys():
-
-        task = data['task'][task_id]
-        if task['info']:
-            task_phid = task['info'][1]
-            status_at_load = task['info'][4]
-            title = task['info'][6]
-            story_points = task['info'][10]
+    log('Dump file load starting', 'load')
+    load_start = time.time()
+    loader = BulkLoader(cur, '{0}.rejects'.format(dump_path))
+    try:
+        project_phid_to_id_dict = load_projects(cur, loader, project_data)
+
+        ##################################################################
+        # Load transactions and edges
+        ##################################################################
+
+        log('Tasks, transactions, and edges loading', 'load')
+        if jobs > 1:
+            # The dump is read once, here, and each task's text is handed
+            # undecoded to whichever job is free.  Only that job decodes
+            # the task, and it loads it on a connection of its own.
+            search_path = '{0}, {1}'.format(LOAD_SCHEMA, live_schema)
+            task_count = 0
+            reject_paths = set()
+            with multiprocessing.Pool(jobs, start_load_job,
+                                      (conn.dsn, search_path, loader.reject_path,
+                                       project_phid_to_id_dict)) as pool:
+                batches = iter_task_batches(dump_path)
+                pending = collections.deque()
+                while True:
+                    batch = next(batches, None)
+                    if batch is not None:
+                        pending.append(pool.apply_async(load_task_batch, (batch,)))
+                    if not pending:
+                        break
+                    # keep only a few batches in flight, so the dump is not
+                    # read into memory faster than it is loaded
+                    if batch is None or len(pending) > 2 * jobs:
+                        batch_task_count, counts, reject_path = pending.popleft().get()
+                        loader.merge(counts, None)
+                        if reject_path:
+                            reject_paths.add(reject_path)
+                        if (task_count + batch_task_count) // 10000 > task_count // 10000:
+                            log('{0} tasks loaded'.format(task_count + batch_task_count),
+                                'load')
+                        task_count += batch_task_count
+            for reject_path in sorted(reject_paths):
+                loader.merge({}, reject_path)
         else:
-            task_phid = ''
-            status_at_load = ''
-            title = ''
-            story_points = ''
-        cur.execute(task_insert, {'task_id': task_id,
-                                  'phid': task_phid,
-                                  'title': title,
-                                  'story_points': story_points,
-                                  'status_at_load': status_at_load})
-
-        # Load the blocked info for this task. When transactional data
-        # becomes available, this should use that instead
-        for edge in task['edge']:
-            if edge[1] == 3:
-                blocked_phid = edge[2]
-                cur.execute(blocked_insert,
-                            {'date': datetime.datetime.now().date(),
-                             'phid': task_phid,
-                             'blocked_phid': blocked_phid})
-
-        # Load transactions for this task
-        transactions = task['transactions']
-        quote_trans_table = {ord('"'): None}
-        for trans_key in list(transactions.keys()):
-            if transactions[trans_key]:
-                for trans in transactions[trans_key]:
-                    trans_type = trans[6]
-                    raw_old_value = trans[7]
-                    raw_new_value = trans[8]
-                    metadata = trans[9]
-                    if trans_type == 'status':
-                        old_value = raw_old_value.translate(quote_trans_table)
-                        new_value = raw_new_value.translate(quote_trans_table)
-                    else:
-                        old_value = raw_old_value
-                        new_value = raw_new_value
-                    date_mod = time.strftime('%m/%d/%Y %H:%M:%S',
-                                             time.gmtime(trans[11]))
-                    try:
-                        cur.execute(transaction_insert,
-                                    {'id': trans[0],
-                                     'phid': trans[1],
-                                     'task_id': task_id,
-                                     'object_phid': trans[3],
-                                     'transaction_type': trans_type,
-                                     'old_value': old_value,
-                                     'new_value': new_value,
-                                     'metadata': metadata,
-                                     'date_modified': date_mod})
-                    except psycopg2.DataError:
-                        log('Error importing task {0}\'s transaction {1}'.
-                            format(task_id, trans), 'load')
-
-    log('Preparing edge transactions for use.', 'load')
-    populate_maniphest_edge_transaction(conn, project_phid_to_id_dict)
+            task_count = 0
+            for task_id, task in iter_dump_entries(dump_path, 'task'):
+                load_task(loader, task_id, task, project_phid_to_id_dict)
+                task_count += 1
+                if task_count % 10000 == 0:
+                    log('{0} tasks loaded'.format(task_count), 'load')
+
+        loader.flush()
+        log('{0} tasks loaded'.format(task_count), 'load')
+        log_load_rates(loader.counts, time.time() - load_start)
+        if loader.reject_count:
+            log('{0} rows rejected; see {1}'.format(loader.reject_count, loader.reject_path),
+                'load')
+    finally:
+        loader.close()
+
+    log('Edge intervals deriving.', 'load')
+    cur.execute('SELECT insert_edge_intervals(NULL)')
+    log('Column intervals deriving.', 'load')
+    cur.execute('SELECT insert_column_intervals(NULL)')
+    log('Attribute intervals deriving.', 'load')
+    cur.execute('SELECT insert_attribute_intervals(NULL)')
+    log('Adding keys and indexes.', 'load')
+    cur.execute(open("loading_indexes.sql", "r").read())
     log('Converting Blocked PHIDs to IDs.', 'load')
     cur.execute('SELECT convert_blocked_phid_to_id_sql()')
+    log('Building the blocked task closure.', 'load')
+    cur.execute('SELECT build_blocked_closure()')
+
+    set_loaded_dump(cur, dump_path, fingerprint, digests)
+    log('Swapping in loaded tables.', 'load')
+    cur.execute('SELECT set_loading_tables_logged(%s, true)', (LOAD_SCHEMA,))
+    cur.execute('SELECT unnest(get_loading_tables())')
+    for (table,) in cur.fetchall():
+        cur.execute('ANALYZE {0}.{1}'.format(LOAD_SCHEMA, table))
+    cur.execute('SELECT swap_in_loaded_tables(%s, %s)', (LOAD_SCHEMA, live_schema))
+    cur.execute('RESET search_path')
     cur.close()
     log('Dump file load finished.', 'load')
 
 
-def reconstruct(conn, default_points,
-                start_date, end_date, scope_prefix, incremental,
-                status_report_project):
+def reconstruct(conn, scopes, end_date, incremental, jobs=1, resume=False):
+    """ Reconstruct the history of each of the scopes, given as the dicts
+    returned by read_scope_config, through end_date.  The scopes share
+    one pass over the tasks: each task's history is read and swept
+    through the days once, and its rows for every scope it is in are
+    written from the same sweep.
 
-    cur = conn.cursor()
+    Each step of the run, down to each slice of days of the task
+    reconstruction, is committed together with its record in
+    reconstruction_progress.  With resume, an unfinished run carries on
+    after the last step that was committed, with the dates and changed
+    tasks it started with."""
 
-    import_recategorization_file(conn, scope_prefix)
-    project_id_list = get_project_list(conn, scope_prefix)[0]
-    lookups = {}
-    lookups['project_id_list'] = project_id_list
+    cur = conn.cursor()
+    scopes = [dict(scope) for scope in scopes]
+    scopes_label = ','.join([scope['scope_prefix'] for scope in scopes])
+    project_id_list = []
+    slices = None
+    for scope in scopes:
+        scope_prefix = scope['scope_prefix']
+        import_recategorization_file(conn, scope_prefix)
+        scope['project_id_list'] = get_project_list(conn, scope_prefix)[0]
+        for project_id in scope['project_id_list']:
+            if project_id not in project_id_list:
+                project_id_list.append(project_id)
+
+        cur.execute("""SELECT start_date, end_date, task_ids, slices
+                         FROM reconstruction_run
+                        WHERE scope = %s
+                          AND finished_at IS NULL""", (scope_prefix,))
+        run = cur.fetchone()
+        scope['completed'] = set()
+        if resume:
+            if not run:
+                print("No unfinished reconstruction of {0} to resume.".format(scope_prefix))
+                sys.exit(1)
+            if slices is not None and (end_date, slices) != (run[1], run[3]):
+                print("The reconstructions of {0} didn't start together.\nResume them one at a time.".format(scopes_label))  # noqa
+                sys.exit(1)
+            scope['start_date'], end_date, scope['task_ids'], slices = run
+            cur.execute("""SELECT phase, first_date, last_date
+                             FROM reconstruction_progress
+                            WHERE scope = %s""", (scope_prefix,))
+            scope['completed'] = set(cur.fetchall())
+            log('Reconstruction resuming after {0} steps'.format(len(scope['completed'])),
+                scope_prefix)
+        elif incremental:
+            if run:
+                print("The last reconstruction of {0} didn't finish.\nResume it with --resume, or run without --incremental.".format(scope_prefix))  # noqa
+                sys.exit(1)
+            scope['start_date'] = get_max_date(conn, scope_prefix)
+            if not scope['start_date']:
+                print("No data available for incremental run of {0}.\nProbably this reconstruction should be run without --incremental.".format(scope_prefix))  # noqa
+                sys.exit(1)
+            # Only the tasks with transactions since the last day
+            # reconstructed can have changed.  The rest are carried
+            # forward from that day as they are.
+            cur.execute('SELECT get_changed_tasks(%s)', (scope['start_date'],))
+            scope['task_ids'] = cur.fetchone()[0]
+            log('{0} tasks changed since {1}'.format(len(scope['task_ids']),
+                                                     scope['start_date']), scope_prefix)
+        else:
+            scope['task_ids'] = None
+            cur.execute('SELECT wipe_reconstruction(%(scope_prefix)s)',
+                        {'scope_prefix': scope_prefix})
+            # Every row of the scope is about to be written again, so
+            # its indexes are built once afterwards rather than updated
+            # for each row
+            cur.execute('SELECT drop_scope_partition_indexes(%s, %s)',
+                        (scope_prefix, RECONSTRUCTED_TABLES))
+            if not scope['start_date']:
+                oldest_data_query = """
+                SELECT DATE(min(date_modified)) FROM maniphest_transaction"""
+                cur.execute(oldest_data_query)
+                scope['start_date'] = cur.fetchone()[0].date()
+
+        # Each day holds the state of the tasks at midnight at the start
+        # of it, so the first day reconstructed is the one after
+        # start_date, and the last is end_date itself, which holds the
+        # state at the end of the day before
+        scope['first_date'] = scope['start_date'] + datetime.timedelta(days=1)
+
+    scopes_to_do = [scope for scope in scopes if scope['first_date'] <= end_date]
+    if scopes_to_do:
+        first_date = min([scope['first_date'] for scope in scopes_to_do])
+    if not resume:
+        # There are several slices of days for each process so that
+        # slices with more tasks in them don't hold up the rest
+        slices = jobs * 4
+        if scopes_to_do:
+            slices = max(slices, ((end_date - first_date).days // RECONSTRUCTION_SLICE_DAYS) + 1)
+        for scope in scopes:
+            cur.execute('SELECT start_reconstruction_run(%s, %s, %s, %s, %s)',
+                        (scope['scope_prefix'], scope['start_date'], end_date,
+                         scope['task_ids'], slices))
 
     ######################################################################
     # preload project and column for fast lookup
     ######################################################################
 
-    cur.execute("""SELECT name, phid
-                   FROM phabricator_project
-                  WHERE id IN %(project_id_list)s""",
-                {'project_id_list': tuple(project_id_list)})
-    lookups['project_name_to_phid_dict'] = dict(cur.fetchall())
+    lookups = {}
     cur.execute("""SELECT id, name
                      FROM phabricator_project
                     WHERE id IN %(project_id_list)s""",
                 {'project_id_list': tuple(project_id_list)})
     lookups['project_id_to_name_dict'] = dict(cur.fetchall())
-    cur.execute("""SELECT pc.phid, pc.name
-                     FROM phabricator_column pc,
-                          phabricator_project pp
-                    WHERE pc.project_phid = pp.phid
-                      AND pp.id = ANY(%(project_id_list)s)""",
-                {'project_id_list': project_id_list})
-    lookups['column_dict'] = dict(cur.fetchall())
-    # In addition to scope_prefix-specific projects, include special, global tags
-    reconstruction_id_list = list(project_id_list)
-    for i in PHAB_TAGS.keys():
-        reconstruction_id_list.extend([PHAB_TAGS[i]])
-    # make sure every project in the status report list is also included
-    if status_report_project:
-        if status_report_project not in reconstruction_id_list:
-            reconstruction_id_list.extend(status_report_project)
-
-    ######################################################################
-    # Generate denormalized data
-    ######################################################################
-    # Generate denormalized edge data.  This is edge data for only the
-    # projects of interest, but goes into a shared table for
-    # simplicity.
-
-    if incremental:
-        try:
-            start_date = get_max_date(conn, scope_prefix)
-        except AttributeError:
-            print("No data available for incremental run.\nProbably this reconstruction should be run without --incremental.")  # noqa
-            sys.exit(1)
-    else:
-        cur.execute('SELECT wipe_reconstruction(%(scope_prefix)s)',
-                    {'scope_prefix': scope_prefix})
-        if not start_date:
-            oldest_data_query = """
-            SELECT DATE(min(date_modified)) FROM maniphest_transaction"""
-            cur.execute(oldest_data_query)
-            start_date = cur.fetchone()[0].date()
-
-    working_date = start_date
-
-    while working_date <= end_date:
-        log('Maniphest_edge creation for {0}'.format(working_date), scope_prefix)
-        # For every task in scope that doesn't already have
-        # maniphest_edges for the working date, generate fresh
-        # maniphest_edges
-
-        # for all active projects,
-
-        cur.execute('SELECT build_edges(%(date)s, %(project_id_list)s)',
-                    {'date': working_date,
-                     'project_id_list': reconstruction_id_list})
-
-        working_date += datetime.timedelta(days=1)
 
     ######################################################################
     # Reconstruct historical state of tasks
     ######################################################################
-    working_date = start_date
-    while working_date <= end_date:
-        log('Task reconstruction for {0}'.format(working_date), scope_prefix)
-
-        # because working_date is midnight at the beginning of the
-        # day, increment the count before using it so that the
-        # effective date used is midnight at the end of the day
-        working_date += datetime.timedelta(days=1)
-
-        cur.execute('SELECT get_tasks(%(working_date)s, %(project_ids)s)',
-                    {'working_date': working_date,
-                     'project_ids': project_id_list})
-        for row in cur.fetchall():
-            task_id = row[0]
-            reconstruct_task_on_date(cur, task_id, working_date, scope_prefix, default_points, **lookups)  # noqa
-
-        # Use as-is data to reconstruct certain relationships for working data
-        # see https://phabricator.wikimedia.org/T115936#1847188
-        cur.execute('SELECT * from get_phab_parent_categories_by_day(%(scope_prefix)s, %(working_date)s, %(category_tag_id)s)',  # noqa
-                    {'scope_prefix': scope_prefix,
-                     'working_date': working_date,
-                     'category_tag_id': PHAB_TAGS['category']})
-        for row in cur.fetchall():
-            category_id = row[0]
-            cur.execute('SELECT create_phab_parent_category_edges(%(scope_prefix)s, %(working_date)s, %(category_id)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'category_id': category_id,
-                         'working_date': working_date})
-        # See https://phabricator.wikimedia.org/T167838
-        # TODO: merge with above by allowing two IDs to be passed in for category_tag_id
-        cur.execute('SELECT * from get_phab_parent_categories_by_day(%(scope_prefix)s, %(working_date)s, %(category_tag_id)s)',  # noqa
-                    {'scope_prefix': scope_prefix,
-                     'working_date': working_date,
-                     'category_tag_id': PHAB_TAGS['goal']})
-        for row in cur.fetchall():
-            category_id = row[0]
-            cur.execute('SELECT create_phab_parent_category_edges(%(scope_prefix)s, %(working_date)s, %(category_id)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'category_id': category_id,
-                         'working_date': working_date})
-
-    log('Phab parent category titles updating', scope_prefix)
-    cur.execute("SELECT update_phab_parent_category_titles(%s, %s)", (scope_prefix, start_date))  # noqa
-    log('Categorizing category tasks', scope_prefix)
-    cur.execute("SELECT put_category_tasks_in_own_category(%s, %s)",
-                (scope_prefix, PHAB_TAGS['category']))
-    cur.execute("SELECT put_category_tasks_in_own_category(%s, %s)",
-                (scope_prefix, PHAB_TAGS['goal']))
-
-    log('Corrupted task status info correcting', scope_prefix)
-
-    cur.execute("SELECT fix_status(%s)", (scope_prefix,))
+    if scopes_to_do:
+        date_slices = []
+        for slice_first_date, slice_last_date in get_date_slices(first_date, end_date, slices):
+            slice_scopes = [scope for scope in scopes_to_do
+                            if ('tasks', slice_first_date, slice_last_date)
+                            not in scope['completed']]
+            if slice_scopes:
+                date_slices.append((slice_scopes, slice_first_date, slice_last_date))
+        log('Task reconstruction from {0} to {1}, {2} slices of days'.
+            format(first_date, end_date, len(date_slices)), scopes_label)
+        if jobs > 1:
+            # A day's rows depend only on the loaded data, so slices of
+            # days can be reconstructed side by side
+            with multiprocessing.Pool(jobs) as pool:
+                pool.starmap(reconstruct_task_on_date_job,
+                             [(conn.dsn, slice_scopes, slice_first_date, slice_last_date,
+                               project_id_list, lookups)
+                              for slice_scopes, slice_first_date, slice_last_date
+                              in date_slices])
+        else:
+            for slice_scopes, slice_first_date, slice_last_date in date_slices:
+                reconstruct_task_on_date_slice(cur, slice_scopes, slice_first_date,
+                                               slice_last_date, project_id_list, lookups)
+
+        for scope in scopes_to_do:
+            if scope['task_ids'] is not None and ('carry_forward', None, None) not in scope['completed']:  # noqa
+                cur.execute('BEGIN')
+                cur.execute('SELECT carry_forward_task_on_date(%s, %s, %s, %s)',
+                            (scope['scope_prefix'], scope['start_date'], end_date,
+                             scope['task_ids']))
+                record_progress(cur, [scope], 'carry_forward')
+                cur.execute('COMMIT')
+
+        # The category edges of a day depend on the rows of every day up
+        # to it, so they wait until all of the rows are written
+        log('Phab parent category edges building', scopes_label)
+        for scope in scopes_to_do:
+            if ('parent_categories', None, None) in scope['completed']:
+                continue
+            # Use as-is data to reconstruct certain relationships for
+            # working data.  See https://phabricator.wikimedia.org/T115936#1847188
+            # and, for goals, https://phabricator.wikimedia.org/T167838
+            cur.execute('BEGIN')
+            cur.execute('SELECT create_phab_parent_category_edges(%s, %s, %s, %s)',
+                        (scope['scope_prefix'], scope['first_date'], end_date,
+                         [PHAB_TAGS['category'], PHAB_TAGS['goal']]))
+            record_progress(cur, [scope], 'parent_categories')
+            cur.execute('COMMIT')
+
+    # The rows were written too quickly for autovacuum to have analyzed
+    # them, and without statistics the scope-wide passes can take
+    # minutes instead of seconds
+    for scope in scopes:
+        build_scope_partition_indexes(conn, scope['scope_prefix'], RECONSTRUCTED_TABLES)
+
+    for scope in scopes:
+        scope_prefix = scope['scope_prefix']
+        start_date = scope['start_date']
+        # After an incremental run, only the rows of the changed tasks,
+        # and of the tasks they block, whose titles come from them, need
+        # fixing up
+        task_ids = scope['task_ids']
+        if task_ids is not None:
+            cur.execute("""SELECT array(SELECT DISTINCT descendant_id
+                                          FROM maniphest_blocked_closure
+                                         WHERE ancestor_id = ANY(%s))""", (task_ids,))
+            task_ids = sorted(set(task_ids) | set(cur.fetchone()[0]))
+        if ('titles', None, None) not in scope['completed']:
+            log('Phab parent category titles updating', scope_prefix)
+            cur.execute('BEGIN')
+            if task_ids is not None:
+                # The titles are only updated from start_date on
+                cur.execute('SELECT split_task_on_date_runs(%s, %s, %s)',
+                            (scope_prefix, start_date, task_ids))
+            cur.execute("SELECT update_phab_parent_category_titles(%s, %s, %s)",
+                        (scope_prefix, start_date, task_ids))
+            record_progress(cur, [scope], 'titles')
+            cur.execute('COMMIT')
+        if ('categories', None, None) not in scope['completed']:
+            log('Categorizing category tasks', scope_prefix)
+            cur.execute('BEGIN')
+            cur.execute("SELECT put_category_tasks_in_own_category(%s, %s, %s)",
+                        (scope_prefix, PHAB_TAGS['category'], task_ids))
+            cur.execute("SELECT put_category_tasks_in_own_category(%s, %s, %s)",
+                        (scope_prefix, PHAB_TAGS['goal'], task_ids))
+            record_progress(cur, [scope], 'categories')
+            cur.execute('COMMIT')
+
+        log('Corrupted task status info correcting', scope_prefix)
+
+        cur.execute('BEGIN')
+        cur.execute("SELECT fix_status(%s, %s)", (scope_prefix, task_ids))
+        cur.execute('SELECT merge_task_on_date_runs(%s, %s)', (scope_prefix, task_ids))
+        cur.execute("SELECT set_reconstruction_source(%s)", (scope_prefix,))
+        cur.execute('SELECT finish_reconstruction_run(%s)', (scope_prefix,))
+        cur.execute('COMMIT')
     cur.close()
 
-    log('Reconstruction finished.', scope_prefix)
+    log('Reconstruction finished.', scopes_label)
 
 
 def report(conn, dbname, scope_prefix,
            scope_title, default_points,
            retroactive_categories, retroactive_points,
            backlog_resolved_cutoff, show_points, show_count, start_date,
-           status_report_start, status_report_end, status_report_project):
+           status_report_start, status_report_end, status_report_project,
+           recently_closed_days):
 
     cur = conn.cursor()
     log('Report Starting', scope_prefix)
@@ -503,22 +544,14 @@ def report(conn, dbname, scope_prefix,
     month_after_current_q_end = current_quarter_start + rd.relativedelta(months=+4)
     three_months_ago = report_date + rd.relativedelta(months=-3)
 
+    check_for_empty_task_on_date(conn, scope_prefix)
+    check_reconstruction_finished(conn, scope_prefix)
+    check_reconstruction_source(conn, scope_prefix)
     # This config file is loaded during reconstruction.  Reload it here to
     # make it possible to run reporting without reconstruction
-    check_for_empty_task_on_date(conn, scope_prefix)
-    reset_reporting_tables(conn, scope_prefix)
-    log('Recategorization Starting', scope_prefix)
     import_recategorization_file(conn, scope_prefix)
-    recategorize(conn, scope_prefix)
-    log('Applying Retroactive values, if any', scope_prefix)
-    if retroactive_categories:
-        set_categories_retroactively(conn, scope_prefix)
-    if retroactive_points:
-        set_points_retroactively(conn, scope_prefix)
-    log('Populating Recently Closed', scope_prefix)
-    populate_recently_closed(conn, scope_prefix, start_date)
-    log('Aggregating task records', scope_prefix)
-    aggregate_task_on_date(conn, scope_prefix, backlog_resolved_cutoff)
+    update_reporting_tables(conn, scope_prefix, retroactive_categories, retroactive_points,
+                            backlog_resolved_cutoff, start_date, recently_closed_days)
     log('Generating CSVs', scope_prefix)
     generate_reporting_files(conn, scope_prefix, dbname)
 
@@ -701,9 +734,10 @@ def report(conn, dbname, scope_prefix,
 
     max_trans_date_query = """
         SELECT MAX(date_modified), now()
-          FROM task_on_date tod, maniphest_transaction mt
-         WHERE tod.scope = %(scope_prefix)s
-           AND tod.id = mt.task_id"""
+          FROM maniphest_transaction mt
+         WHERE mt.task_id IN (SELECT id
+                                FROM task_history
+                               WHERE scope = %(scope_prefix)s)"""
 
     cur.execute(max_trans_date_query, {'scope_prefix': scope_prefix})
     result = cur.fetchone()
@@ -758,6 +792,8 @@ def report(conn, dbname, scope_prefix,
          'retroactive_categories': retroactive_categories,
          'retroactive_points': retroactive_points,
          'backlog_resolved_cutoff': backlog_resolved_cutoff,
+         'recently_closed_days': recently_closed_days,
+         'start_date': start_date,
          }))
     report_output.close()
 
@@ -765,81 +801,111 @@ def report(conn, dbname, scope_prefix,
     log('Report finished.', scope_prefix)
 
 
-def aggregate_task_on_date(conn, scope_prefix, backlog_resolved_cutoff):
+def aggregate_task_on_date(conn, scope_prefix, backlog_resolved_cutoff, dates=None,
+                           previous_excluded=None):
     """ Create three different datasets, all stuffed into the same table and
     differentiated by scope and range.  The datasets aggregating the daily data
     three ways: with no cutoff, with the specified cutoff, and with a cutoff
-    three months before specified.
+    three months before specified.  All three come from one pass over
+    the recategorized rows.
+
+    With dates, only those days are aggregated again, along with the
+    days of the tasks that have been left out of the cutoff ranges or
+    let back into them since previous_excluded.  Return the tasks left
+    out of each cutoff range.
     """
     cur = conn.cursor()
-    tod_agg_common = """INSERT INTO task_on_date_agg (
-                        SELECT scope,
-                               %(range)s,
-                               date,
-                               category,
-                               status,
-                               SUM(points) as points,
-                               COUNT(id) as count,
-                               maint_type
-                          FROM task_on_date_recategorized
-                         WHERE scope = %(scope_prefix)s
-                               {cutoff_clause}
-                         GROUP BY status, category, maint_type, date, scope)"""
-    cur.execute(tod_agg_common.format(cutoff_clause=''), {
-        'scope_prefix': scope_prefix,
-        'range': 'normal'
-    })
-
+    excluded = {'cutoff': [], 'lastq': []}
     if backlog_resolved_cutoff:
-        tod_cutoff_clause = """AND id NOT IN (SELECT id
-                                                FROM task_on_date th
-                                               WHERE date = %(backlog_resolved_cutoff)s
-                                                 AND scope = %(scope_prefix)s
-                                                 AND status = 'resolved') """
-
-        tod_agg_common_cutoff = tod_agg_common.format(cutoff_clause=tod_cutoff_clause)
         backlog_resolved_cutoff_lastq = backlog_resolved_cutoff\
             - datetime.timedelta(days=91)
-        cur.execute(tod_agg_common_cutoff,
-                    {
-                        'scope_prefix': scope_prefix,
-                        'range': 'cutoff',
-                        'backlog_resolved_cutoff': backlog_resolved_cutoff,
-                    })
-
-        cur.execute(tod_agg_common_cutoff,
-                    {
-                        'scope_prefix': scope_prefix,
-                        'range': 'lastq',
-                        'backlog_resolved_cutoff': backlog_resolved_cutoff_lastq,
-                    })
-
-    else:
-        # If there's no cutoff, stuff data into the table anyway
-        # so that retrieval doesn't have to change
-        cur.execute(tod_agg_common.format(cutoff_clause=''), {
-            'scope_prefix': scope_prefix,
-            'range': 'cutoff'
-        })
-
-        cur.execute(tod_agg_common.format(cutoff_clause=''), {
-            'scope_prefix': scope_prefix,
-            'range': 'lastq'
-        })
+        for agg_range, cutoff in (('cutoff', backlog_resolved_cutoff),
+                                  ('lastq', backlog_resolved_cutoff_lastq)):
+            cur.execute("""SELECT array(SELECT id
+                                          FROM get_task_history(%s, ARRAY[%s::date])
+                                         WHERE status = 'resolved')""",
+                        (scope_prefix, cutoff))
+            excluded[agg_range] = cur.fetchone()[0]
+
+    # If there's no cutoff, the cutoff ranges get the same data as the
+    # normal one anyway so that retrieval doesn't have to change
+    if dates is not None:
+        moved = set()
+        for agg_range in ('cutoff', 'lastq'):
+            moved |= set(excluded[agg_range]) ^ set(previous_excluded[agg_range])
+        if moved:
+            cur.execute("""SELECT array(SELECT DISTINCT date::date
+                                          FROM task_on_date_recategorized
+                                         WHERE scope = %s
+                                           AND id = ANY(%s))""",
+                        (scope_prefix, sorted(moved)))
+            dates = sorted(set(dates) | set(cur.fetchone()[0]))
+        if not dates:
+            return excluded
+    cur.execute('SELECT aggregate_task_on_date(%s, %s, %s, %s)',
+                (scope_prefix, excluded['cutoff'], excluded['lastq'], dates))
+    return excluded
+
+
+def build_scope_partition_indexes(conn, scope_prefix, partitioned_tables):
+    """ Build the indexes of the scope's partitions of the
+    partitioned_tables that are missing, or were left unfinished,
+    without locking out reads of them, and then analyze the
+    partitions"""
+    cur = conn.cursor()
+    cur.execute('SELECT * FROM get_scope_partition_indexes(%s, %s)',
+                (scope_prefix, partitioned_tables))
+    for index_name, partition_name, index_definition, is_valid in cur.fetchall():
+        if is_valid:
+            continue
+        log('Index {0} building'.format(index_name), scope_prefix)
+        if is_valid is not None:
+            cur.execute('DROP INDEX CONCURRENTLY {0}'.format(index_name))
+        cur.execute('CREATE INDEX CONCURRENTLY {0} ON {1} {2}'.
+                    format(index_name, partition_name, index_definition))
+    for partitioned_table in partitioned_tables:
+        cur.execute('ANALYZE {0}_scope_{1}'.format(partitioned_table, scope_prefix))
 
 
 def check_for_empty_task_on_date(conn, scope_prefix):
     cur = conn.cursor()
-    size_query = """SELECT count(*)
-                      FROM task_on_date
-                     WHERE scope = %(scope_prefix)s"""
+    size_query = """SELECT EXISTS (SELECT *
+                                     FROM task_history
+                                    WHERE scope = %(scope_prefix)s)"""
     cur.execute(size_query, {'scope_prefix': scope_prefix})
-    data_size = cur.fetchone()[0]
-    if data_size == 0:
+    if not cur.fetchone()[0]:
         print("ERROR: no data in task_on_date for {0}".format(scope_prefix))
         sys.exit(-1)
 
 
+def check_reconstruction_finished(conn, scope_prefix):
+    """ Stop if the last reconstruction of the scope didn't finish, since
+    some of its days may be missing, and the rest not yet categorized"""
+    cur = conn.cursor()
+    unfinished_query = """SELECT EXISTS (SELECT *
+                                           FROM reconstruction_run
+                                          WHERE scope = %(scope_prefix)s
+                                            AND finished_at IS NULL)"""
+    cur.execute(unfinished_query, {'scope_prefix': scope_prefix})
+    if cur.fetchone()[0]:
+        print("ERROR: the last reconstruction of {0} didn't finish.  Resume it with --reconstruct --resume.".format(scope_prefix))  # noqa
+        sys.exit(-1)
+
+
+def check_reconstruction_source(conn, scope_prefix):
+    """ Warn if the scope was reconstructed from a different dump than the
+    one loaded now"""
+    cur = conn.cursor()
+    source_query = """SELECT rs.dump_fingerprint, ld.fingerprint
+                        FROM reconstruction_source rs, loaded_dump ld
+                       WHERE rs.scope = %(scope_prefix)s"""
+    cur.execute(source_query, {'scope_prefix': scope_prefix})
+    row = cur.fetchone()
+    if row and row[0] != row[1]:
+        print("WARNING: {0} was reconstructed from dump {1}, but dump {2} is loaded now".
+              format(scope_prefix, row[0], row[1]))
+
+
 def generate_reporting_files(conn, scope_prefix, dbname):
     # working around dynamic filename constructions limitations in
     # psql rather than try to write the file /tmp/foo/report.csv,
@@ -865,11 +931,146 @@ def generate_reporting_files(conn, scope_prefix, dbname):
     subprocess.call('cp /tmp/{0}/category_possibilities.txt ~/html/{0}_category_possibilities.txt'.format(scope_prefix), shell=True)  # noqa
 
 
+def get_changed_category_tasks(conn, reported_categories, categories):
+    """ Return the tasks whose categories can differ between two lists
+    of recategorization rules, each of (digest, project_id) in sort
+    order, as returned by get_category_digests.  The rules found in
+    both lists in the same order are kept; a task on a day that none of
+    the other rules in either list matches has the same first matching
+    rule, and so the same category, with both.  A rule only matches
+    tasks in its project, so these are the tasks ever in the project of
+    one of the other rules."""
+    matcher = difflib.SequenceMatcher(None,
+                                      [category[0] for category in reported_categories],
+                                      [category[0] for category in categories],
+                                      autojunk=False)
+    project_ids = set()
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            project_ids.update([category[1] for category in reported_categories[i1:i2]])
+            project_ids.update([category[1] for category in categories[j1:j2]])
+    project_ids.discard(None)
+    if not project_ids:
+        return []
+    cur = conn.cursor()
+    cur.execute("""SELECT array(SELECT DISTINCT task
+                                  FROM maniphest_edge_interval
+                                 WHERE project = ANY(%s))""", (sorted(project_ids),))
+    return cur.fetchone()[0]
+
+
+def get_date_slices(first_date, last_date, count):
+    """ Split the days from first_date through last_date into at most
+    count slices of consecutive days, as (first, last) pairs of nearly
+    the same length"""
+    days = (last_date - first_date).days + 1
+    count = min(count, days)
+    return [(first_date + datetime.timedelta(days=days * i // count),
+             first_date + datetime.timedelta(days=days * (i + 1) // count - 1))
+            for i in range(count)]
+
+
+def get_dump_fingerprint(dump_path):
+    """ Return a SHA-256 digest of the bytes of the dump."""
+    fingerprint = hashlib.sha256()
+    with open(dump_path, 'rb') as dump_file:
+        for chunk in iter(lambda: dump_file.read(1048576), b''):
+            fingerprint.update(chunk)
+    return fingerprint.hexdigest()
+
+
+def get_edge_transaction_rows(task_id, edge_transactions, project_phid_to_id_dict):
+    """ Return the maniphest_edge_transaction rows for one task's edge
+    transactions, given as (epoch, maniphest_transaction row) pairs.
+    Each row has the project ids added and removed by the transaction
+    and the project ids of all of the task's edges after it."""
+
+    # Phabricator has two different edge transaction semantics.  In
+    # Version A, metadata is blank and new_value contains a json blob
+    # for which the ninth field is the list of PHIDs of all project
+    # edges present at the end of the transaction.  In Version B,
+    # which is newer, metadata is for edge transactions begins with
+    # {"edge:type":41}, old_value contains the PHID of any project
+    # edge removed in the transaction, and new_value contains the PHID
+    # of any project edge added in the transaction.
+
+    edge_rows = []
+    edges = []
+    for epoch, trans_row in sorted(edge_transactions, key=lambda pair: pair[0]):
+        old_value = []
+        new_value = []
+        date_modified = trans_row[7]
+        metadata = trans_row[8]
+        if metadata:
+            if '{"edge:type":41' in metadata:
+                try:
+                    old_value_list = json.loads(trans_row[5])
+                    new_value_list = json.loads(trans_row[6])
+                    for phid in old_value_list:
+                        project_id = project_phid_to_id_dict[phid]
+                        old_value.append(project_id)
+                    for phid in new_value_list:
+                        project_id = project_phid_to_id_dict[phid]
+                        new_value.append(project_id)
+                except Exception as e:
+                    log('Task {0} has bad (new style) transaction data.  Error {1}. trans: {2}.'.  # noqa
+                        format(task_id, e, trans_row), 'load')
+            edges = list(set(edges) - set(old_value))
+            if new_value:
+                edges = list(set(edges + new_value))
+        else:
+            jblob = json.loads(trans_row[6])
+            if jblob:
+                try:
+                    for key in jblob.keys():
+                        if int(jblob[key]['type']) == 41:
+                            if key in project_phid_to_id_dict:
+                                project_id = project_phid_to_id_dict[key]
+                                new_value.append(project_id)
+                except Exception as e:
+                    log('Task {0} has bad (old style) transaction data.  Error {1}. trans: {2}.'.  # noqa
+                        format(task_id, e, trans_row), 'load')
+            edges = new_value
+        edge_rows.append([task_id, date_modified, old_value, new_value, metadata, edges])
+
+    # Transactions at the same moment all get the edges from after the
+    # last of them
+    for i in range(len(edge_rows) - 2, -1, -1):
+        if edge_rows[i][1] == edge_rows[i + 1][1]:
+            edge_rows[i][5] = edge_rows[i + 1][5]
+    return edge_rows
+
+
+def get_interval_value(intervals, as_of, default=None):
+    """ Return the value of the interval that as_of falls in, from a list
+    of (valid_from, valid_to, value) in order of valid_from, such as the
+    rows of maniphest_attribute_interval or maniphest_column_interval
+    for one task, or default if it falls in none of them"""
+    for valid_from, valid_to, value in reversed(intervals):
+        if valid_from <= as_of:
+            if valid_to and as_of >= valid_to:
+                return default
+            return value
+    return default
+
+
+def get_task_attribute(conn, task_id, attribute, as_of):
+    """ Return the status, priority or points of the task at midnight at
+    the start of the day as_of, or None if it had none yet"""
+    cur = conn.cursor()
+    cur.execute('SELECT get_task_attribute(%s, %s, %s)', (task_id, attribute, as_of))
+    return cur.fetchone()[0]
+
+
 def get_max_date(conn, scope_prefix):
     cur = conn.cursor()
-    max_date_query = """SELECT MAX(date)
-                          FROM task_on_date
-                         WHERE scope = %(scope_prefix)s"""
+    max_date_query = """SELECT GREATEST(
+                                   (SELECT MAX(date)
+                                      FROM task_on_date
+                                     WHERE scope = %(scope_prefix)s),
+                                   (SELECT MAX(valid_to) - 1
+                                      FROM task_on_date_run
+                                     WHERE scope = %(scope_prefix)s)::timestamp)"""
     cur.execute(max_date_query, {'scope_prefix': scope_prefix})
     try:
         max_date = cur.fetchone()[0].date()
@@ -920,9 +1121,55 @@ def get_project_name(conn, project_id):
     return result
 
 
+def get_runs(task_on_date_rows):
+    """ Return the task_on_date_run rows for one task's task_on_date rows,
+    given in date order: one for each run of consecutive days on which
+    the rows of a scope are the same but for the date"""
+    runs = []
+    last_runs = {}
+    for row in task_on_date_rows:
+        scope, date, task_id = row[:3]
+        last_run = last_runs.get(scope)
+        if last_run and last_run[3] == date and last_run[4:] == list(row[3:]):
+            last_run[3] = date + datetime.timedelta(days=1)
+        else:
+            last_runs[scope] = [scope, task_id, date, date + datetime.timedelta(days=1)] + \
+                list(row[3:])
+            runs.append(last_runs[scope])
+    return runs
+
+
+def get_task_signature(task_row, trans_rows):
+    """ Digest a task row and the ids and dates of its transactions, the
+    same way get_loaded_task_signatures() does for loaded tasks."""
+    fields = ['\\N' if value is None else str(value) for value in task_row[1:]]
+    fields.append(','.join('{0} {1}'.format(trans_row[0], trans_row[7]) for trans_row in
+                           sorted(trans_rows, key=lambda trans_row: int(trans_row[0]))))
+    return hashlib.md5('\x1f'.join(fields).encode('utf-8')).hexdigest()
+
+
 def import_recategorization_file(conn, scope_prefix):
-    """ Reload the recategorization file into the database"""
+    """ Reload the recategorization file into the database, unless
+    neither the file nor the loaded projects, whose names the rules are
+    matched against, have changed since it was last imported"""
     cur = conn.cursor()
+    recat_file = 'config/{0}_recategorization.csv'.format(scope_prefix)
+    if not os.path.isfile(recat_file):
+        raise Exception('Missing recat file {0}'.recat_file)
+    with open(recat_file, 'rb') as f:
+        file_digest = hashlib.sha256(f.read()).hexdigest()
+    cur.execute("""SELECT *
+                     FROM recategorization_source rs, loaded_dump ld
+                    WHERE rs.scope = %s
+                      AND rs.file_digest = %s
+                      AND rs.project_digest = ld.project_digest""",
+                (scope_prefix, file_digest))
+    if cur.fetchone():
+        log('Recategorization file unchanged', scope_prefix)
+        return
+
+    cur.execute('DELETE FROM recategorization_source WHERE scope = %(scope_prefix)s',
+                {'scope_prefix': scope_prefix})
     cur.execute('DELETE FROM category WHERE scope = %(scope_prefix)s',
                 {'scope_prefix': scope_prefix})
 
@@ -938,9 +1185,6 @@ def import_recategorization_file(conn, scope_prefix):
                     %(include_in_status)s,
                     %(force_status)s)"""
 
-    recat_file = 'config/{0}_recategorization.csv'.format(scope_prefix)
-    if not os.path.isfile(recat_file):
-        raise Exception('Missing recat file {0}'.recat_file)
     with open(recat_file, 'rt') as f:
         reader = csv.DictReader(f)
         counter = 0
@@ -1087,6 +1331,563 @@ def import_recategorization_file(conn, scope_prefix):
                     print('Skipping a duplicate category produced by rule {0}: {1}'.
                           format(line, E))
 
+    cur.execute("""INSERT INTO recategorization_source
+                   SELECT %s, %s, project_digest
+                     FROM loaded_dump""", (scope_prefix, file_digest))
+
+
+# Columns written by BulkLoader, with each table listed after the
+# tables it references
+LOAD_COLUMNS = [
+    ('phabricator_project', ('id', 'name', 'phid')),
+    ('phabricator_column', ('id', 'phid', 'name', 'project_phid')),
+    ('maniphest_task', ('id', 'phid', 'title', 'story_points', 'status_at_load')),
+    ('maniphest_blocked_phid', ('blocked_date', 'blocks_phid', 'blocked_by_phid')),
+    ('maniphest_transaction', ('id', 'phid', 'task_id', 'object_phid', 'transaction_type',
+                               'old_value', 'new_value', 'date_modified', 'metadata')),
+    ('maniphest_edge_transaction', ('task_id', 'date_modified', 'old_value', 'new_value',
+                                    'metadata', 'edges')),
+]
+
+# Columns of the task_on_date rows, or the task_on_date_run rows, written
+# by reconstruct_task_on_date
+# The tables written by reconstruction, each partitioned by scope
+RECONSTRUCTED_TABLES = ['task_on_date', 'task_on_date_run', 'phab_parent_category_edge']
+
+# The task reconstruction is committed in slices of about this many
+# days, or fewer if that makes too few slices to share among the jobs
+RECONSTRUCTION_SLICE_DAYS = 28
+
+RECONSTRUCTION_COLUMNS = [
+    ('task_on_date', ('scope', 'date', 'id', 'status', 'project_id', 'project',
+                      'projectcolumn', 'points', 'maint_type', 'priority')),
+    ('task_on_date_run', ('scope', 'id', 'valid_from', 'valid_to', 'status', 'project_id',
+                          'project', 'projectcolumn', 'points', 'maint_type', 'priority')),
+]
+
+
+class BulkLoader:
+    """Buffers rows for the loading tables and writes them in large
+    batches with COPY, instead of one INSERT and one commit per row.
+
+    Tables are flushed in the order of columns, so rows always land
+    after any rows they refer to.  If a batch fails with a DataError, it
+    is retried row by row and the rows that fail again are written to
+    reject_path, or the error is raised if there is no reject_path.
+    Rows of a task whose maniphest_task row was rejected are rejected
+    too.
+    Rows go to the tables named in columns, with table_prefix in
+    front."""
+
+    def __init__(self, cur, reject_path, batch_size=50000, table_prefix='',
+                 columns=LOAD_COLUMNS):
+        self.cur = cur
+        self.reject_path = reject_path
+        self.table_prefix = table_prefix
+        self.batch_size = batch_size
+        self.columns = columns
+        self.rows = {table: [] for table, table_columns in columns}
+        self.counts = {table: 0 for table, table_columns in columns}
+        self.pending = 0
+        self.reject_count = 0
+        self.rejected_task_ids = set()
+        self.reject_file = None
+        self.reject_writer = None
+        if reject_path and os.path.exists(reject_path):
+            os.remove(reject_path)
+
+    def add(self, table, row):
+        self.rows[table].append(row)
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        for table, columns in self.columns:
+            if self.rows[table]:
+                self.copy(table, columns, self.rows[table])
+                self.rows[table] = []
+        self.pending = 0
+
+    def copy(self, table, columns, rows):
+        if 'task_id' in columns and self.rejected_task_ids:
+            # Rows of a rejected task would break the foreign keys to
+            # maniphest_task, so they go to the reject file with it
+            task_id_index = columns.index('task_id')
+            kept_rows = []
+            for row in rows:
+                if str(row[task_id_index]) in self.rejected_task_ids:
+                    self.reject(table, row, 'Task {0} was rejected'.format(row[task_id_index]))
+                else:
+                    kept_rows.append(row)
+            rows = kept_rows
+        data = io.StringIO()
+        for row in rows:
+            data.write('\t'.join([copy_format(value) for value in row]))
+            data.write('\n')
+        data.seek(0)
+        # Inside the caller's transaction, a failed statement would abort
+        # the whole transaction, so each attempt gets a savepoint to roll
+        # back to instead.
+        in_transaction = (self.cur.connection.get_transaction_status() ==
+                          psycopg2.extensions.TRANSACTION_STATUS_INTRANS)
+        try:
+            self.savepoint('SAVEPOINT', in_transaction)
+            self.cur.copy_expert('COPY {0}{1} ({2}) FROM STDIN'.
+                                 format(self.table_prefix, table, ', '.join(columns)), data)
+            self.savepoint('RELEASE SAVEPOINT', in_transaction)
+            self.counts[table] += len(rows)
+        except psycopg2.DataError:
+            self.savepoint('ROLLBACK TO SAVEPOINT', in_transaction)
+            self.savepoint('RELEASE SAVEPOINT', in_transaction)
+            if not self.reject_path:
+                raise
+            insert = 'INSERT INTO {0}{1} ({2}) VALUES ({3})'.format(
+                self.table_prefix, table, ', '.join(columns), ', '.join(['%s'] * len(columns)))
+            for row in rows:
+                try:
+                    self.savepoint('SAVEPOINT', in_transaction)
+                    self.cur.execute(insert, row)
+                    self.counts[table] += 1
+                except (psycopg2.DataError, ValueError) as e:
+                    # psycopg2 raises ValueError for strings containing NUL
+                    self.savepoint('ROLLBACK TO SAVEPOINT', in_transaction)
+                    self.reject(table, row, e)
+                self.savepoint('RELEASE SAVEPOINT', in_transaction)
+
+    def merge(self, counts, reject_path):
+        """ Add in the counts and rejected rows of a BulkLoader that ran
+        in another process."""
+        for table, count in counts.items():
+            self.counts[table] += count
+        if reject_path and os.path.exists(reject_path):
+            with open(reject_path, newline='') as reject_file:
+                for rejected in csv.reader(reject_file):
+                    self.write_reject(rejected)
+            os.remove(reject_path)
+
+    def close(self):
+        if self.reject_file:
+            self.reject_file.close()
+
+    def reject(self, table, row, error):
+        if table == 'maniphest_task':
+            self.rejected_task_ids.add(str(row[0]))
+        self.write_reject([table, str(error).strip().splitlines()[0]] + list(row))
+
+    def savepoint(self, command, in_transaction):
+        if in_transaction:
+            self.cur.execute('{0} bulk_loader'.format(command))
+
+    def write_reject(self, rejected):
+        if not self.reject_writer:
+            self.reject_file = open(self.reject_path, 'w', newline='')
+            self.reject_writer = csv.writer(self.reject_file)
+        self.reject_writer.writerow(rejected)
+        self.reject_file.flush()
+        self.reject_count += 1
+
+
+# Schema that load() builds the shadow loading tables in
+LOAD_SCHEMA = 'phlogiston_load'
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_format(value):
+    """ Render one value in COPY's text format"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, list):
+        return '{' + ','.join([str(item) for item in value]) + '}'
+    return str(value).translate(COPY_ESCAPES)
+
+
+class DumpReader:
+    """Incremental decoder for the JSON in a Phabricator dump file.
+
+    Only a window of the file is held in memory.  Containers are walked
+    with iter_members and iter_elements; the caller must consume each
+    member's value, with read_value, skip_value, or a nested iterator,
+    before asking for the next one."""
+
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ',:]} \t\n\r'
+    UNBRACKETED = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+    STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+
+    def __init__(self, dump_file, chunk_size=1048576):
+        self.dump_file = dump_file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.raw = None
+        self.raw_start = 0
+
+    def fill(self):
+        """ Drop the consumed part of the buffer and read more of the file.
+        Reads at least as much as is already buffered, so that a value
+        larger than chunk_size is decoded in a few attempts rather than many.
+        Returns False at end of file."""
+        if self.eof:
+            return False
+        chunk = self.dump_file.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+        if self.raw is not None:
+            self.raw.append(self.buffer[self.raw_start:self.pos])
+            self.raw_start = 0
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ Return the next non-whitespace character without consuming it,
+        or '' at end of file."""
+        while True:
+            self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Malformed dump: expected one of {0} but found {1!r}'.
+                             format(list(chars), char))
+        self.pos += 1
+        return char
+
+    def read_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # a number cut off by the end of the buffer decodes without
+            # error, so make sure a delimiter follows it
+            if (end == len(self.buffer) or self.buffer[end] not in self.DELIMITERS) \
+               and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    def skip_value(self):
+        """ Consume a value without decoding it.  Only quotes and brackets
+        are looked for, so skipping a container costs a fraction of
+        decoding it, and only a window of it is held in memory."""
+        char = self.peek()
+        if char == '"':
+            self.skip_string()
+        elif char and char in '{[':
+            depth = 0
+            while True:
+                # strings and everything else but brackets in one match
+                self.pos = self.UNBRACKETED.match(self.buffer, self.pos).end()
+                if self.pos == len(self.buffer) or self.buffer[self.pos] == '"':
+                    # the buffer ends, perhaps inside a string
+                    if not self.fill():
+                        raise ValueError('Malformed dump: unexpected end of file')
+                    continue
+                char = self.buffer[self.pos]
+                self.pos += 1
+                if char in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        return
+        else:
+            self.read_value()
+
+    def skip_string(self):
+        """ Consume the string at the current position without decoding it."""
+        while True:
+            match = self.STRING.match(self.buffer, self.pos)
+            if match:
+                self.pos = match.end()
+                return
+            if not self.fill():
+                raise ValueError('Malformed dump: unterminated string')
+
+    def read_raw(self):
+        """ Consume the value at the current position without decoding it
+        and return its JSON text, for json.loads to decode elsewhere."""
+        self.peek()
+        self.raw = []
+        self.raw_start = self.pos
+        self.skip_value()
+        self.raw.append(self.buffer[self.raw_start:self.pos])
+        raw, self.raw = ''.join(self.raw), None
+        return raw
+
+    def iter_members(self):
+        """ Yield each key of the object at the current position."""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.read_value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def iter_elements(self):
+        """ Yield once for each element of the array at the current position."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_dump_entries(dump_path, section, raw=False):
+    """ Yield (key, value) for each member of one top-level section of the
+    dump ('project' or 'task'), decoding a single member at a time, or
+    yield the undecoded JSON text of each value if raw.  Other sections
+    are skipped without being kept in memory."""
+    with open(dump_path) as dump_file:
+        reader = DumpReader(dump_file)
+        for key in reader.iter_members():
+            if key == section:
+                for member_key in reader.iter_members():
+                    if raw:
+                        yield member_key, reader.read_raw()
+                    else:
+                        yield member_key, reader.read_value()
+                return
+            reader.skip_value()
+
+
+def iter_task_batches(dump_path, batch_size=1000):
+    """ Yield lists of (task id, JSON text) pairs for the tasks in the
+    dump, without decoding them."""
+    batch = []
+    for task_id, task_text in iter_dump_entries(dump_path, 'task', raw=True):
+        batch.append((task_id, task_text))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def load_columns(loader, columns, project_phid_to_id_dict):
+    """ Load the columns from the dump whose projects exist"""
+    column_count = len(columns)
+    log('{0} columns loading'.format(column_count), 'load')
+    for row in columns:
+        phid = row[1]
+        project_phid = row[5]
+        if project_phid in project_phid_to_id_dict:
+            loader.add('phabricator_column', (row[0], phid, row[2], project_phid))
+        else:
+            print("Data error for column {0}: project {1} doesn't exist.Skipping.".
+                  format(phid, project_phid))
+    loader.flush()
+
+
+def load_incremental(conn, dump_path, fingerprint, project_data, digests):
+    """ Apply the differences between the dump and the loaded data to the
+    live loading tables, in one transaction.  Tasks whose row and
+    transaction ids and dates are unchanged are skipped; the rest are
+    written to temporary incoming_ tables, with their edge transactions,
+    and merged from there.  The blocked tables are small and always
+    rebuilt.  The projects and columns are skipped if their text is the
+    same as in the last load."""
+    cur = conn.cursor()
+    cur.execute('BEGIN')
+    for table, columns in LOAD_COLUMNS:
+        cur.execute('CREATE TEMP TABLE incoming_{0} (LIKE {0}) ON COMMIT DROP'.format(table))
+
+    log('Incremental dump file load starting', 'load')
+    load_start = time.time()
+    loader = BulkLoader(cur, '{0}.rejects'.format(dump_path), table_prefix='incoming_')
+    try:
+        cur.execute('SELECT project_digest, column_digest FROM loaded_dump')
+        if cur.fetchone() == (digests.get('projects'), digests.get('columns')):
+            log('Projects and columns unchanged since the last load.  Skipping them.',
+                'load')
+            cur.execute('SELECT phid, id FROM phabricator_project')
+            project_phid_to_id_dict = dict(cur.fetchall())
+        else:
+            project_phid_to_id_dict = load_projects(cur, loader, project_data)
+
+        cur.execute('SELECT id, signature FROM get_loaded_task_signatures()')
+        loaded_signatures = dict(cur.fetchall())
+        log('Comparing tasks to the {0} already loaded'.format(len(loaded_signatures)), 'load')
+        task_count = 0
+        changed_count = 0
+        for task_id, task in iter_dump_entries(dump_path, 'task'):
+            if load_task(loader, task_id, task, project_phid_to_id_dict, loaded_signatures):
+                changed_count += 1
+            task_count += 1
+            if task_count % 10000 == 0:
+                log('{0} tasks compared'.format(task_count), 'load')
+        loader.flush()
+        log('{0} of {1} tasks new or changed'.format(changed_count, task_count), 'load')
+        log_load_rates(loader.counts, time.time() - load_start)
+        if loader.reject_count:
+            log('{0} rows rejected; see {1}'.format(loader.reject_count, loader.reject_path),
+                'load')
+    finally:
+        loader.close()
+
+    log('Merging new and changed rows.', 'load')
+    cur.execute('SELECT merge_incoming_load()')
+    log('Converting Blocked PHIDs to IDs.', 'load')
+    cur.execute('SELECT convert_blocked_phid_to_id_sql()')
+    log('Building the blocked task closure.', 'load')
+    cur.execute('SELECT build_blocked_closure()')
+    set_loaded_dump(cur, dump_path, fingerprint, digests)
+    cur.execute('COMMIT')
+    cur.close()
+    log('Incremental dump file load finished.', 'load')
+
+
+def load_projects(cur, loader, project_data):
+    """ Load the projects and columns from the project section of the
+    dump, and return a dictionary of project ids by PHID"""
+    project_count = len(project_data['projects'])
+    log('{0} projects loading'.format(project_count), 'load')
+
+    for row in project_data['projects']:
+        loader.add('phabricator_project', (row[0], row[1], row[2]))
+    loader.flush()
+
+    cur.execute("SELECT phid, id from {0}phabricator_project".format(loader.table_prefix))
+    project_phid_to_id_dict = dict(cur.fetchall())
+    load_columns(loader, project_data['columns'], project_phid_to_id_dict)
+    return project_phid_to_id_dict
+
+
+def load_task(loader, task_id, task, project_phid_to_id_dict, loaded_signatures=None):
+    """ Add the rows for one task of the dump to loader.  If
+    loaded_signatures is given, the task, transaction and edge
+    transaction rows are only added when the task's signature differs
+    from the loaded one.  Returns True if they were added."""
+    quote_trans_table = {ord('"'): None}
+    if task['info']:
+        task_phid = task['info'][1]
+        status_at_load = task['info'][4]
+        title = task['info'][6]
+        story_points = task['info'][10]
+    else:
+        task_phid = ''
+        status_at_load = ''
+        title = ''
+        story_points = ''
+    task_row = (task_id, task_phid, title, story_points, status_at_load)
+
+    # Load the blocked info for this task. When transactional data
+    # becomes available, this should use that instead
+    for edge in task['edge']:
+        if edge[1] == 3:
+            blocked_phid = edge[2]
+            loader.add('maniphest_blocked_phid',
+                       (datetime.datetime.now().date(), task_phid, blocked_phid))
+
+    # Load transactions for this task
+    trans_rows = []
+    edge_transactions = []
+    transactions = task['transactions']
+    for trans_key in list(transactions.keys()):
+        if transactions[trans_key]:
+            for trans in transactions[trans_key]:
+                trans_type = trans[6]
+                raw_old_value = trans[7]
+                raw_new_value = trans[8]
+                metadata = trans[9]
+                if trans_type == 'status':
+                    old_value = raw_old_value.translate(quote_trans_table)
+                    new_value = raw_new_value.translate(quote_trans_table)
+                else:
+                    old_value = raw_old_value
+                    new_value = raw_new_value
+                date_mod = time.strftime('%m/%d/%Y %H:%M:%S',
+                                         time.gmtime(trans[11]))
+                trans_row = (trans[0], trans[1], task_id, trans[3], trans_type,
+                             old_value, new_value, date_mod, metadata)
+                trans_rows.append(trans_row)
+                if trans_type == 'core:edge':
+                    edge_transactions.append((trans[11], trans_row))
+
+    if loaded_signatures is not None:
+        if get_task_signature(task_row, trans_rows) == loaded_signatures.get(int(task_id)):
+            return False
+    loader.add('maniphest_task', task_row)
+    for trans_row in trans_rows:
+        loader.add('maniphest_transaction', trans_row)
+    for edge_row in get_edge_transaction_rows(task_id, edge_transactions,
+                                              project_phid_to_id_dict):
+        loader.add('maniphest_edge_transaction', edge_row)
+    return True
+
+
+def load_task_batch(batch):
+    """ Decode and load a list of (task id, JSON text) pairs in a load job
+    started by start_load_job.  Returns the number of tasks, the row
+    counts since the last batch, and the path of the job's reject file
+    if it has rejected any rows."""
+    loader, project_phid_to_id_dict = LOAD_JOB
+    for task_id, task_text in batch:
+        load_task(loader, task_id, json.loads(task_text), project_phid_to_id_dict)
+    loader.flush()
+    counts = loader.counts
+    loader.counts = {table: 0 for table in counts}
+    return len(batch), counts, loader.reject_path if loader.reject_count else None
+
+
+def load_task_timelines(cur, project_id_list, first_date, last_date, task_ids=None):
+    """ Return, in task id order, a TaskTimeline for each task that is in
+    one of the projects on any day from first_date through last_date,
+    or only for those of task_ids if it is given"""
+    cur.execute('SELECT * FROM get_task_intervals(%s, %s, %s, %s)',
+                (project_id_list, first_date, last_date, task_ids))
+    timelines = {}
+    for task_id, project, valid_from, valid_to in cur.fetchall():
+        if task_id not in timelines:
+            timelines[task_id] = TaskTimeline(task_id)
+        timelines[task_id].intervals.append((project, valid_from, valid_to))
+    task_ids = sorted(timelines)
+
+    cur.execute('SELECT id, story_points FROM maniphest_task WHERE id = ANY(%s)',
+                (task_ids,))
+    for task_id, story_points in cur.fetchall():
+        try:
+            timelines[task_id].points_from_info = int(story_points)
+        except:
+            pass
+
+    cur.execute('SELECT * FROM get_task_attribute_intervals(%s, %s)', (task_ids, last_date))
+    for task_id, attribute, value, points, valid_from, valid_to in cur.fetchall():
+        if attribute == 'points':
+            value = points
+        timelines[task_id].attribute_intervals[attribute].append((valid_from, valid_to, value))
+
+    cur.execute('SELECT * FROM get_task_column_intervals(%s, %s)', (task_ids, last_date))
+    for task_id, project, column_name, valid_from, valid_to in cur.fetchall():
+        timelines[task_id].column_intervals.setdefault(project, []).append(
+            (valid_from, valid_to, column_name))
+
+    cur.execute('SELECT * FROM get_task_edge_transactions(%s, %s)', (task_ids, last_date))
+    for task_id, effective_date, edges in cur.fetchall():
+        timelines[task_id].edge_transactions.append((effective_date, edges))
+
+    return [timelines[task_id] for task_id in task_ids]
+
 
 def log(message, scope_prefix):
     """ TODO: convert this into native logging """
@@ -1097,116 +1898,45 @@ def log(message, scope_prefix):
                      message))
 
 
-def populate_maniphest_edge_transaction(conn, project_phid_to_id_dict):
-    # Phabricator has two different edge transaction semantics.  In
-    # Version A, metadata is blank and new_value contains a json blob
-    # for which the ninth field is the list of PHIDs of all project
-    # edges present at the end of the transaction.  In Version B,
-    # which is newer, metadata is for edge transactions begins with
-    # {"edge:type":41}, old_value contains the PHID of any project
-    # edge removed in the transaction, and new_value contains the PHID
-    # of any project edge added in the transaction.
+def log_load_rates(counts, elapsed):
+    """ Report rows loaded and rows per second, per table and overall"""
+    elapsed = max(elapsed, 0.001)
+    for table, count in sorted(counts.items()):
+        log('{0}: {1} rows, {2:.0f} rows/sec'.format(table, count, count / elapsed), 'load')
+    total = sum(counts.values())
+    log('{0} rows loaded in {1:.1f} seconds, {2:.0f} rows/sec'.
+        format(total, elapsed, total / elapsed), 'load')
 
-    cur = conn.cursor()
-    get_edge_transactions = """SELECT task_id, date_modified, old_value, new_value, metadata
-                                 FROM maniphest_transaction
-                                WHERE transaction_type = 'core:edge'"""
 
-    cur.execute(get_edge_transactions)
-    for transaction in cur.fetchall():
-        old_value = []
-        new_value = []
-        task_id = transaction[0]
-        date_modified = transaction[1]
-        metadata = transaction[4]
-        if metadata:
-            if '{"edge:type":41' in metadata:
-                try:
-                    old_value_list = json.loads(transaction[2])
-                    new_value_list = json.loads(transaction[3])
-                    for phid in old_value_list:
-                        project_id = project_phid_to_id_dict[phid]
-                        old_value.append(project_id)
-                    for phid in new_value_list:
-                        project_id = project_phid_to_id_dict[phid]
-                        new_value.append(project_id)
-                except Exception as e:
-                    log('Task {0} has bad (new style) transaction data.  Error {1}. trans: {2}.'.  # noqa
-                        format(task_id, e, transaction), 'load')
-        else:
-            jblob = json.loads(transaction[3])
-            if jblob:
-                try:
-                    for key in jblob.keys():
-                        if int(jblob[key]['type']) == 41:
-                            if key in project_phid_to_id_dict:
-                                project_id = project_phid_to_id_dict[key]
-                                new_value.append(project_id)
-                except Exception as e:
-                    log('Task {0} has bad (old style) transaction data.  Error {1}. trans: {2}.'.  # noqa
-                        format(task_id, e, transaction), 'load')
-
-        insert_met_sql = """INSERT INTO maniphest_edge_transaction VALUES (%(task_id)s,\
-                                                                           %(date_modified)s,
-                                                                           %(old_value)s,
-                                                                           %(new_value)s,
-                                                                           %(metadata)s)"""  # noqa
-        cur.execute(insert_met_sql, {'task_id': task_id,
-                                     'date_modified': date_modified,
-                                     'old_value': old_value,
-                                     'new_value': new_value,
-                                     'metadata': metadata})
-
-    # Second pass, to standardize from transactional data to point-in-time data
-    log('Starting second pass on transactional edge data', 'load')
-    get_tasks_sql = """SELECT id FROM maniphest_task ORDER BY id"""
-    update_edges_sql = """UPDATE maniphest_edge_transaction
-                             SET edges = %(edges)s
-                           WHERE task_id = %(task_id)s
-                             AND date_modified = %(date_modified)s"""
-
-    cur.execute(get_tasks_sql)
-    task_ids = cur.fetchall()
-    for task_id in task_ids:
-        get_task_trans_sql = """SELECT date_modified,
-                                  old_value,
-                                  new_value,
-                                  metadata
-                             FROM maniphest_edge_transaction
-                            WHERE task_id = %s
-                            ORDER BY date_modified"""
-        cur.execute(get_task_trans_sql, task_id)
-        task_transactions = cur.fetchall()
-        edges = []
-        for trans in task_transactions:
-            date_modified = trans[0]
-            old_value = trans[1]
-            new_value = trans[2]
-            metadata = trans[3]
-            if metadata:
-                edges = list(set(edges) - set(old_value))
-                if new_value:
-                    edges = list(set(edges + new_value))
-            else:
-                edges = new_value
-            cur.execute(update_edges_sql, {'task_id': task_id,
-                                           'edges': edges,
-                                           'date_modified': date_modified})
-
-    log('Finished second pass on transactional edge data', 'load')
-
-
-def populate_recently_closed(conn, scope_prefix, start_date):
+def populate_recently_closed(conn, scope_prefix, start_date, recently_closed_days,
+                             dates=None):
+    """ Fill in the tasks closed on each day since start_date, and
+    list the individual tasks closed in the last recently_closed_days
+    days, or since start_date if that is None.  With dates, only the
+    days whose rows have changed, the tasks closed on those days and
+    the days after them are found again."""
     cur = conn.cursor()
     end_date = get_max_date(conn, scope_prefix)
-    cur.execute('SELECT populate_recently_closed(%(scope_prefix)s,\
-                %(start_date)s,\
-                %(end_date)s)',
+    closed_dates = None
+    if dates is not None:
+        closed_dates = sorted(set(dates) |
+                              set([date + datetime.timedelta(days=1) for date in dates]))
+    if closed_dates != []:
+        cur.execute('SELECT populate_recently_closed(%(scope_prefix)s,\
+                    %(start_date)s,\
+                    %(end_date)s,\
+                    %(closed_dates)s)',
+                    {'scope_prefix': scope_prefix,
+                     'start_date': start_date,
+                     'end_date': end_date,
+                     'closed_dates': closed_dates})
+    since = start_date
+    if recently_closed_days is not None:
+        since = datetime.datetime.now().date() - \
+            rd.relativedelta(days=recently_closed_days)
+    cur.execute('SELECT populate_recently_closed_task(%(scope_prefix)s, %(since)s)',
                 {'scope_prefix': scope_prefix,
-                 'start_date': start_date,
-                 'end_date': end_date})
-    cur.execute('SELECT populate_recently_closed_task(%(scope_prefix)s)',
-                {'scope_prefix': scope_prefix})
+                 'since': since})
 
 
 def read_date(input_string):
@@ -1222,196 +1952,207 @@ def recategorize(conn, scope_prefix):
 
     cur = conn.cursor()
 
-    cur.execute('SELECT * FROM get_category_rules(%(scope_prefix)s)', {'scope_prefix': scope_prefix})  # noqa
-    for row in cur.fetchall():
-        rule = row[0]
-        project_id_list = row[1]
-        matchstring = row[3]
-        title = row[4]
-        scope_prefix = scope_prefix
-
-        if rule == "ProjectByID":
-            cur.execute('SELECT recategorize_by_project(%(scope_prefix)s, %(project_id_list)s, %(title)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title})
-        elif rule == "Intersection":
-            cur.execute('SELECT recategorize_by_intersection(%(scope_prefix)s, %(project_id_list)s, %(title)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title})
-        elif rule == "ProjectColumn":
-            cur.execute('SELECT recategorize_by_column(%(scope_prefix)s, %(project_id_list)s, %(title)s, %(matchstring)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title,
-                         'matchstring': matchstring})
-        elif rule == "ParentTask":
-            cur.execute('SELECT recategorize_by_parenttask(%(scope_prefix)s, %(project_id_list)s, %(title)s, %(matchstring)s)',  # noqa
-                        {'scope_prefix': scope_prefix,
-                         'project_id_list': project_id_list,
-                         'title': title,
-                         'matchstring': matchstring})
-        else:
-            raise Exception("Invalid categorization rule {0}".format(rule))
-            sys.exit()
-
+    cur.execute('SELECT recategorize(%(scope_prefix)s)',
+                {'scope_prefix': scope_prefix})
     cur.execute('SELECT purge_leftover_and_omitted_task_on_date_rec(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
 
 
-def reconstruct_task_on_date(cur, task_id, working_date, scope_prefix,
-                             default_points, project_id_list,
-                             project_id_to_name_dict,
-                             project_name_to_phid_dict, column_dict):
-
-    # ----------------------------------------------------------------------
-    # Maniphest_task provides as-is information about tasks.  It's used here
-    # to provide points and title.
-    # Points data prior to Feb 2016 was not recorded transactionally and is
-    # only available here, so we use this to supplement transactional points
-    # data.
-    # Title could be tracked through transactions but this code doesn't
-    # make that effort, instead using the as-is title retroactively.
-    # ----------------------------------------------------------------------
-    task_info_query = """SELECT title, story_points
-    FROM maniphest_task
-    WHERE id = %(task_id)s"""
-    cur.execute(task_info_query,
-                {'task_id': task_id,
-                 'working_date': working_date,
-                 'transaction_type': 'status'})
-    task_info = cur.fetchone()
-    try:
-        points_from_info = int(task_info[1])
-    except:
-        points_from_info = None
-
-    # For all other fields, use transactional data:
-    # For each relevant variable of the task, use the most
-    # recent value that is no later than that day.  (So, if
-    # that variable didn't change that day, use the last time
-    # it was changed.  If it changed multiple times, use the
-    # final value)
-
-    # ----------------------------------------------------------------------
-    # Status
-    # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'status', task_id))
-    status_raw = cur.fetchone()
-    pretty_status = ""
-    if status_raw:
-        pretty_status = status_raw[0]
-
-    # ----------------------------------------------------------------------
-    # Priority
-    # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'priority', task_id))
-    priority_raw = cur.fetchone()
-    pretty_priority = ""
-    if priority_raw:
-        pretty_priority = priority_raw[0]
-
-    # ----------------------------------------------------------------------
-    # Story Points
-    # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'points', task_id))
-    points_raw = cur.fetchone()
-    try:
-        points_from_trans = int(points_raw[0])
-    except:
-        points_from_trans = None
-
-    if isinstance(points_from_trans, int):
-        pretty_points = points_from_trans
-    elif isinstance(points_from_info, int):
-        pretty_points = points_from_info
-    else:
-        pretty_points = default_points
-
-    # ----------------------------------------------------------------------
-    # Project & Maintenance Type
-    # ----------------------------------------------------------------------
-    cur.execute("SELECT * FROM get_edge_value(%s, %s)",
-                (working_date, task_id))
-    edges = cur.fetchall()[0][0]
-    pretty_project = ''
-
-    if not edges:
-        log('Task {0} has no edges.'.format(task_id), 'load')
-        return
-    if PHAB_TAGS['new'] in edges:
-        maint_type = 'New Functionality'
-    elif PHAB_TAGS['maint'] in edges:
-        maint_type = 'Maintenance'
+def reconstruct_task_on_date(cur, scopes, first_date, last_date, project_id_list,
+                             project_id_to_name_dict):
+    """ Write the task_on_date rows for every task in each of the scopes
+    on each day from first_date through last_date, or for scopes with
+    run_length_history, the task_on_date_run rows for the runs of those
+    days.  Only the tasks in a scope's task_ids are written for it, if
+    that isn't None.  project_id_list holds the projects of all of the
+    scopes.  The history of each task is read once and swept forward
+    through the days for all of the scopes together, and the rows are
+    written with COPY."""
+    scopes_label = ','.join([scope['scope_prefix'] for scope in scopes])
+    run_length_scopes = set([scope['scope_prefix'] for scope in scopes
+                             if scope['run_length_history']])
+    if any([scope['task_ids'] is None for scope in scopes]):
+        task_ids = None
     else:
-        maint_type = ''
-
-    best_edge = ''
-    # Reduce the list of edges to only the single best match,
-    # where best = earliest in the specified project list
-    for project in project_id_list:
-        if project in edges:
-            best_edge = project
-            break
-
-    if not best_edge:
-        # This should be impossible since by this point we
-        # only see tasks that have edges in the desired list.
-        # However, certain transactions (gerrit Conduit
-        # transactions) aren't properly parsed by Phlogiston.
-        # See https://phabricator.wikimedia.org/T114021.  Skipping
-        # these transactions should not affect the data for
-        # our purposes.
-        log('Error: No edge match for {0} on {1}'.format(task_id, working_date),
-            scope_prefix)
-        return
+        task_ids = sorted(set().union(*[scope['task_ids'] for scope in scopes]))
+    timelines = load_task_timelines(cur, project_id_list, first_date, last_date, task_ids)
+    log('{0} tasks reconstructing'.format(len(timelines)), scopes_label)
+    loader = BulkLoader(cur, None, columns=RECONSTRUCTION_COLUMNS)
+    scope_task_ids = [None if scope['task_ids'] is None else set(scope['task_ids'])
+                      for scope in scopes]
+    for timeline in timelines:
+        task_scopes = [scope for scope, ids in zip(scopes, scope_task_ids)
+                       if ids is None or timeline.task_id in ids]
+        run_length_rows = []
+        for row in timeline.task_on_date_rows(task_scopes, first_date, last_date,
+                                              project_id_to_name_dict):
+            if row[0] in run_length_scopes:
+                run_length_rows.append(row)
+            else:
+                loader.add('task_on_date', row)
+        for row in get_runs(run_length_rows):
+            loader.add('task_on_date_run', row)
+    loader.flush()
+    log('{0} task_on_date rows and {1} task_on_date_run rows written'.
+        format(loader.counts['task_on_date'], loader.counts['task_on_date_run']), scopes_label)
+
+
+def reconstruct_task_on_date_job(dsn, scopes, first_date, last_date, project_id_list,
+                                 lookups):
+    """ Run reconstruct_task_on_date_slice in a process and on a
+    connection of its own"""
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    reconstruct_task_on_date_slice(cur, scopes, first_date, last_date, project_id_list,
+                                   lookups)
+    conn.close()
 
-    pretty_project = project_id_to_name_dict[best_edge]
-    project_phid = project_name_to_phid_dict[pretty_project]
-
-    # ----------------------------------------------------------------------
-    # Column
-    # ----------------------------------------------------------------------
-    pretty_column = ''
-    cur.execute("SELECT * FROM get_transaction_value(%s, %s, %s)",
-                (working_date, 'core:columns', task_id))
-    pc_trans_list = cur.fetchall()
-
-    for pc_trans in pc_trans_list:
-        jblob = json.loads(pc_trans[0])[0]
-        if project_phid in jblob['boardPHID']:
-            column_phid = jblob['columnPHID']
-            pretty_column = column_dict[column_phid]
-            break
-
-    denorm_insert = """
-        INSERT INTO task_on_date VALUES (
-        %(scope_prefix)s,
-        %(working_date)s,
-        %(id)s,
-        %(status)s,
-        %(project_id)s,
-        %(project)s,
-        %(projectcolumn)s,
-        %(points)s,
-        %(maint_type)s,
-        %(priority)s)"""
-
-    cur.execute(denorm_insert,
-                {'scope_prefix': scope_prefix,
-                 'working_date': working_date,
-                 'id': task_id,
-                 'status': pretty_status,
-                 'project_id': best_edge,
-                 'project': pretty_project,
-                 'projectcolumn': pretty_column,
-                 'points': pretty_points,
-                 'maint_type': maint_type,
-                 'priority': pretty_priority})
+
+def reconstruct_task_on_date_slice(cur, scopes, first_date, last_date, project_id_list,
+                                   lookups):
+    """ Reconstruct the days from first_date through last_date for the
+    scopes, and record them as done, in one transaction, so that the
+    slice is either all there or not there at all"""
+    cur.execute('BEGIN')
+    reconstruct_task_on_date(cur, scopes, first_date, last_date, project_id_list, **lookups)
+    record_progress(cur, scopes, 'tasks', first_date, last_date)
+    cur.execute('COMMIT')
+
+
+def record_progress(cur, scopes, phase, first_date=None, last_date=None):
+    """ Record that the step phase of the reconstruction of each of the
+    scopes is done, for the days from first_date through last_date if
+    the step covers only some of them"""
+    for scope in scopes:
+        cur.execute("""INSERT INTO reconstruction_progress
+                       VALUES (%s, %s, %s, %s, now())""",
+                    (scope['scope_prefix'], phase, first_date, last_date))
+
+
+def read_project_section(dump_path):
+    """ Return the project section of the dump, and a SHA-256 digest of
+    the text of each of its members."""
+
+    # The dump is decoded one section member at a time, rather than
+    # with a single json.load, so that memory use stays flat as the
+    # dump grows.  The project section is small and is read in its own
+    # pass so that it is available no matter where it is in the file.
+    project_data = {}
+    digests = {}
+    for key, text in iter_dump_entries(dump_path, 'project', raw=True):
+        project_data[key] = json.loads(text)
+        digests[key] = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return project_data, digests
+
+
+def read_scope_config(scope_prefix, start_date, today):
+    """ Return the settings in the scope's config file, as a dict, with
+    the defaults filled in.  start_date, if given, overrides the one in
+    the file."""
+    config = configparser.ConfigParser()
+    config_filename = 'config/{0}_scope.py'.format(scope_prefix)
+    config.read(config_filename)
+
+    try:
+        scope_title = config['vars']['scope_title']
+    except KeyError as e:
+        print('Config file {0} is missing required parameter(s): {1}'.
+              format(scope_prefix, e))
+        sys.exit(1)
+
+    show_points = True
+    if config.has_option('vars', 'show_points'):
+        if not config.getboolean('vars', 'show_points'):
+            show_points = False
+
+    show_count = True
+    if config.has_option('vars', 'show_count'):
+        if not config.getboolean('vars', 'show_count'):
+            show_count = False
+
+    default_points = None
+    if config.has_option('vars', 'default_points'):
+        default_points = config['vars']['default_points']
+
+    backlog_resolved_cutoff = None
+    if config.has_option('vars', 'backlog_resolved_cutoff'):
+        input_brc = config['vars']['backlog_resolved_cutoff']
+        if isinstance(read_date(input_brc), datetime.date):
+            backlog_resolved_cutoff = read_date(input_brc)
+        if input_brc.lower() in ['default', 'true', 't', 'yes', '1']:
+            backlog_resolved_cutoff = start_of_quarter(today)
+
+    status_report_start = start_of_quarter(today)
+    if config.has_option('vars', 'status_report_start'):
+        input_srs = config['vars']['status_report_start']
+        if isinstance(input_srs, int):
+            status_report_start = today - rd.relativedelta(days=input_srs)
+        elif isinstance(read_date(input_srs), datetime.date):
+            status_report_start = read_date(input_srs)
+
+    status_report_end = None
+    if config.has_option('vars', 'status_report_end'):
+        input_sre = config['vars']['status_report_end']
+        if isinstance(read_date(input_sre), datetime.date):
+            status_report_end = read_date(input_sre)
+
+    status_report_project = None
+    if config.has_option('vars', 'status_report_project'):
+        status_report_project = config['vars']['status_report_project']
+
+    retroactive_categories = False
+    if config.has_option('vars', 'retroactive_categories'):
+        if config.getboolean('vars', 'retroactive_categories'):
+            retroactive_categories = True
+
+    retroactive_points = False
+    if config.has_option('vars', 'retroactive_points'):
+        if config.getboolean('vars', 'retroactive_points'):
+            retroactive_points = True
+
+    # How many days back the list of recently closed tasks goes, or
+    # 'all' to list every task closed since start_date
+    recently_closed_days = 14
+    if config.has_option('vars', 'recently_closed_days'):
+        input_rcd = config['vars']['recently_closed_days']
+        if input_rcd.lower() == 'all':
+            recently_closed_days = None
+        else:
+            try:
+                recently_closed_days = int(input_rcd)
+            except ValueError:
+                print('Config file {0} has an invalid recently_closed_days: {1}'.
+                      format(scope_prefix, input_rcd))
+                sys.exit(1)
+
+    # Keep the scope's reconstructed history only as runs of
+    # unchanged days, in task_on_date_run
+    run_length_history = False
+    if config.has_option('vars', 'run_length_history'):
+        if config.getboolean('vars', 'run_length_history'):
+            run_length_history = True
+
+    if not start_date:
+        if config.has_option('vars', 'start_date'):
+            start_date = read_date(config['vars']['start_date'])
+        if not start_date:
+            start_date = start_of_quarter(today) - rd.relativedelta(months=+3)
+
+    return {'scope_prefix': scope_prefix,
+            'scope_title': scope_title,
+            'show_points': show_points,
+            'show_count': show_count,
+            'default_points': default_points,
+            'backlog_resolved_cutoff': backlog_resolved_cutoff,
+            'status_report_start': status_report_start,
+            'status_report_end': status_report_end,
+            'status_report_project': status_report_project,
+            'retroactive_categories': retroactive_categories,
+            'retroactive_points': retroactive_points,
+            'recently_closed_days': recently_closed_days,
+            'run_length_history': run_length_history,
+            'start_date': start_date}
 
 
 def reset_reporting_tables(conn, scope_prefix):
@@ -1419,8 +2160,11 @@ def reset_reporting_tables(conn, scope_prefix):
     cur.execute('SELECT wipe_reporting(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
 
+    cur.execute('SELECT drop_scope_partition_indexes(%s, %s)',
+                (scope_prefix, ['task_on_date_recategorized']))
     cur.execute('SELECT load_tasks_to_recategorize(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
+    build_scope_partition_indexes(conn, scope_prefix, ['task_on_date_recategorized'])
 
 
 def set_categories_retroactively(conn, scope_prefix):
@@ -1429,12 +2173,30 @@ def set_categories_retroactively(conn, scope_prefix):
                 {'scope_prefix': scope_prefix})
 
 
+def set_loaded_dump(cur, dump_path, fingerprint, digests):
+    cur.execute('SELECT set_loaded_dump(%s, %s, %s, %s)',
+                (fingerprint, os.path.abspath(dump_path), digests.get('projects'),
+                 digests.get('columns')))
+
+
 def set_points_retroactively(conn, scope_prefix):
     cur = conn.cursor()
     cur.execute('SELECT set_points_retroactive(%(scope_prefix)s)',
                 {'scope_prefix': scope_prefix})
 
 
+def start_load_job(dsn, search_path, reject_path, project_phid_to_id_dict):
+    """ Set up a process of the load pool with a connection and a
+    BulkLoader of its own, for load_task_batch."""
+    global LOAD_JOB
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute('SET search_path TO {0}'.format(search_path))
+    loader = BulkLoader(cur, '{0}.{1}'.format(reject_path, os.getpid()))
+    LOAD_JOB = (loader, project_phid_to_id_dict)
+
+
 def start_of_quarter(input_date):
     quarter_start = [datetime.date(input_date.year, month, 1) for month in (1, 4, 7, 10)]
 
@@ -1442,5 +2204,220 @@ def start_of_quarter(input_date):
     return quarter_start[index - 1]
 
 
+def update_reporting_tables(conn, scope_prefix, retroactive_categories, retroactive_points,
+                            backlog_resolved_cutoff, start_date, recently_closed_days):
+    """ Bring the scope's reporting tables, through the velocities, up
+    to date with its history.  If they were last built with the same
+    settings, and the scope has since been reconstructed incrementally
+    from the last day reported, or not at all, only the new days and the
+    rows of the tasks that changed, or whose categories the changes to
+    the recategorization rules can change, are recategorized, and only
+    the days whose rows differ are aggregated again.  If none of that
+    has changed, nothing is.  Otherwise they are rebuilt, as they are
+    with retroactive categories or points, which carry each new day back
+    through the whole history."""
+    cur = conn.cursor()
+    reported_through = get_max_date(conn, scope_prefix)
+    cur.execute('SELECT * FROM get_category_digests(%s)', (scope_prefix,))
+    categories = cur.fetchall()
+    inputs = [retroactive_categories, retroactive_points, backlog_resolved_cutoff,
+              start_date]
+    inputs_digest = hashlib.sha256(repr(inputs).encode('utf-8')).hexdigest()
+
+    changes = None
+    up_to_date = False
+    if not (retroactive_categories or retroactive_points):
+        cur.execute('SELECT * FROM get_reporting_changes(%s, %s)',
+                    (scope_prefix, inputs_digest))
+        changes = cur.fetchone()
+    if changes:
+        (since, task_ids, category_digests, category_project_ids,
+         cutoff_task_ids, lastq_task_ids) = changes
+        recategorized_task_ids = get_changed_category_tasks(
+            conn, list(zip(category_digests, category_project_ids)), categories)
+        task_ids = sorted(set(task_ids) | set(recategorized_task_ids))
+        previous_excluded = {'cutoff': cutoff_task_ids, 'lastq': lastq_task_ids}
+        up_to_date = since == reported_through and not task_ids
+    if up_to_date:
+        log('Reporting tables up to date', scope_prefix)
+        dates = []
+        excluded = previous_excluded
+    elif changes:
+        log('Reporting tables updating after {0}, {1} tasks changed'.
+            format(since, len(task_ids)), scope_prefix)
+        # Until the tables are consistent again, the next report has to
+        # rebuild them
+        cur.execute('DELETE FROM reporting_watermark WHERE scope = %s', (scope_prefix,))
+        cur.execute('SELECT replace_tasks_to_recategorize(%s, %s, %s)',
+                    (scope_prefix, since, task_ids))
+        # The planner only counts the new, uncategorized rows once the
+        # partition is analyzed again
+        cur.execute('ANALYZE task_on_date_recategorized_scope_{0}'.format(scope_prefix))
+        log('Recategorization Starting', scope_prefix)
+        recategorize(conn, scope_prefix)
+        cur.execute('SELECT get_recategorized_changes(%s, %s, %s)',
+                    (scope_prefix, since, task_ids))
+        dates = cur.fetchone()[0]
+        velocity_since = since + datetime.timedelta(days=1)
+        if dates:
+            velocity_since = dates[0]
+    else:
+        log('Reporting tables rebuilding', scope_prefix)
+        reset_reporting_tables(conn, scope_prefix)
+        log('Recategorization Starting', scope_prefix)
+        recategorize(conn, scope_prefix)
+        log('Applying Retroactive values, if any', scope_prefix)
+        if retroactive_categories:
+            set_categories_retroactively(conn, scope_prefix)
+        if retroactive_points:
+            set_points_retroactively(conn, scope_prefix)
+        dates = None
+        previous_excluded = None
+        velocity_since = None
+
+    log('Populating Recently Closed', scope_prefix)
+    populate_recently_closed(conn, scope_prefix, start_date, recently_closed_days, dates)
+    if not up_to_date:
+        log('Aggregating task records', scope_prefix)
+        excluded = aggregate_task_on_date(conn, scope_prefix, backlog_resolved_cutoff,
+                                          dates, previous_excluded)
+        log('Calculating velocities', scope_prefix)
+        cur.execute('SELECT calculate_velocities(%s, %s)', (scope_prefix, velocity_since))
+    # The rollups are by category sort order, which can change even
+    # when no task's category does
+    cur.execute('SELECT rollup_velocities(%s)', (scope_prefix,))
+    cur.execute('SELECT set_reporting_watermark(%s, %s, %s, %s, %s, %s, %s)',
+                (scope_prefix, reported_through, inputs_digest,
+                 [category[0] for category in categories],
+                 [category[1] for category in categories],
+                 excluded['cutoff'], excluded['lastq']))
+
+
+class TaskTimeline:
+    """The history of one task, as read by load_task_timelines(), for
+    working out its task_on_date row on one day after another.
+
+    intervals holds (project, valid_from, valid_to) from
+    maniphest_edge_interval.  attribute_intervals holds (valid_from,
+    valid_to, value) from maniphest_attribute_interval for status,
+    priority and points, with points as integers, and column_intervals
+    holds (valid_from, valid_to, column name) from
+    maniphest_column_interval for each project; look them up with
+    get_interval_value().  edge_transactions holds (effective_date,
+    edges), in the order they apply; edges take effect on their
+    effective_date."""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.points_from_info = None
+        self.intervals = []
+        self.attribute_intervals = {'status': [], 'priority': [], 'points': []}
+        self.edge_transactions = []
+        self.column_intervals = {}
+
+    def dates(self, project_id_list, first_date, last_date):
+        """ Return, in order, the days from first_date through last_date
+        on which the task is in one of the projects"""
+        dates = set()
+        for project, valid_from, valid_to in self.intervals:
+            if project not in project_id_list:
+                continue
+            working_date = max(valid_from, first_date)
+            if valid_to:
+                last_valid_date = min(valid_to - datetime.timedelta(days=1), last_date)
+            else:
+                last_valid_date = last_date
+            while working_date <= last_valid_date:
+                dates.add(working_date)
+                working_date += datetime.timedelta(days=1)
+        return sorted(dates)
+
+    def get_column(self, project, working_date):
+        """ Return the task's column on the project's board on
+        working_date"""
+        return get_interval_value(self.column_intervals.get(project, []), working_date, '')
+
+    def task_on_date_rows(self, scopes, first_date, last_date, project_id_to_name_dict):
+        """ Yield the task's task_on_date row for each day it is in each of
+        the scopes, carrying its state forward from one day to the next.
+        The rows of a day come in the order of scopes.
+
+        For each value, use the most recent transaction that is no later
+        than that day.  (So, if the value didn't change that day, use the
+        last time it was changed.  If it changed multiple times, use the
+        final value.)  Points data prior to Feb 2016 was not recorded
+        transactionally, so the as-is points of the task supplement
+        it."""
+        scope_dates = []
+        all_dates = set()
+        for scope in scopes:
+            dates = set(self.dates(scope['project_id_list'],
+                                   max(scope['first_date'], first_date), last_date))
+            scope_dates.append((scope, dates))
+            all_dates |= dates
+
+        edges = None
+        edge_position = 0
+        for working_date in sorted(all_dates):
+            while (edge_position < len(self.edge_transactions) and
+                   self.edge_transactions[edge_position][0] <= working_date):
+                edges = self.edge_transactions[edge_position][1]
+                edge_position += 1
+
+            status = get_interval_value(self.attribute_intervals['status'], working_date, '')
+            priority = get_interval_value(self.attribute_intervals['priority'], working_date, '')
+            points_from_trans = get_interval_value(self.attribute_intervals['points'],
+                                                   working_date)
+
+            if not edges:
+                log('Task {0} has no edges.'.format(self.task_id), 'load')
+                continue
+            if PHAB_TAGS['new'] in edges:
+                maint_type = 'New Functionality'
+            elif PHAB_TAGS['maint'] in edges:
+                maint_type = 'Maintenance'
+            else:
+                maint_type = ''
+
+            for scope, dates in scope_dates:
+                if working_date not in dates:
+                    continue
+                if isinstance(points_from_trans, int):
+                    pretty_points = points_from_trans
+                elif isinstance(self.points_from_info, int):
+                    pretty_points = self.points_from_info
+                else:
+                    pretty_points = scope['default_points']
+
+                best_edge = ''
+                # Reduce the list of edges to only the single best match,
+                # where best = earliest in the scope's project list
+                for project in scope['project_id_list']:
+                    if project in edges:
+                        best_edge = project
+                        break
+
+                if not best_edge:
+                    # Edges are counted from the day of the transaction,
+                    # but membership in the scope from midnight after it,
+                    # so a task can leave all of the projects the day
+                    # before it drops out of the scope.  Certain
+                    # transactions (gerrit Conduit transactions) also
+                    # aren't properly parsed by Phlogiston.  See
+                    # https://phabricator.wikimedia.org/T114021.
+                    # Skipping these should not affect the data for our
+                    # purposes.
+                    log('Error: No edge match for {0} on {1}'.format(self.task_id, working_date),
+                        scope['scope_prefix'])
+                    continue
+
+                pretty_project = project_id_to_name_dict[best_edge]
+                pretty_column = self.get_column(best_edge, working_date)
+
+                yield (scope['scope_prefix'], working_date, self.task_id, status,
+                       best_edge, pretty_project, pretty_column, pretty_points, maint_type,
+                       priority)
+
+
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -1,88 +1,161 @@
-CREATE OR REPLACE FUNCTION build_edges(
-       run_date date,
-       project_id_list int array) RETURNS void AS $$
-DECLARE
-  dayrow record;
-  taskrow record;
-  projrow record;
-  project_id int;
-BEGIN
+-- Replaced by maniphest_edge_interval, which is built at load time
+DROP FUNCTION IF EXISTS build_edges(date, int[]);
 
-    FOR taskrow IN SELECT id
-                     FROM maniphest_task
-                    ORDER BY id
-    LOOP
-        FOR projrow IN SELECT edges
-                         FROM maniphest_edge_transaction
-                        WHERE date_modified <= run_date
-                          AND task_id = taskrow.id
-                     ORDER BY date_modified DESC
-                        LIMIT 1
-        LOOP
-            FOREACH project_id IN ARRAY projrow.edges & project_id_list
-            LOOP
-                INSERT INTO maniphest_edge
-                VALUES (taskrow.id, project_id, run_date)
-                    ON CONFLICT DO NOTHING;
-            END LOOP;
-        END LOOP;
-    END LOOP;     
 
-    RETURN;
-END;
-$$ LANGUAGE plpgsql;
+-- Replaced by maniphest_blocked_closure, which is built at load time
+DROP FUNCTION IF EXISTS get_descendents(int, date);
 
 
-CREATE OR REPLACE FUNCTION get_descendents(
-       root_id int,
-       run_date date
-) RETURNS TABLE(id int) AS $$
-BEGIN
-  RETURN query
-  WITH RECURSIVE search_mb(parent_id, child_id, depth, path, cycle) AS (
-        SELECT parent_id,
-	       child_id,
-	       1,
-	       ARRAY[parent_id],
-               false
-        FROM maniphest_blocked mb
-       WHERE parent_id = root_id
-      UNION ALL
-        SELECT mb.parent_id,
-	       mb.child_id,
-	       smb.depth + 1,
-               path || mb.parent_id,
-               mb.parent_id = ANY(path)
-        FROM maniphest_blocked mb, search_mb smb
-        WHERE mb.parent_id = smb.child_id AND NOT cycle
-  )
-  SELECT child_id FROM search_mb;
+-- Run-length history is written directly by reconstruction and read
+-- through task_history and get_task_history
+DROP FUNCTION IF EXISTS compact_task_on_date(varchar);
+DROP FUNCTION IF EXISTS expand_task_on_date(varchar, date[]);
 
-END;
-$$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION carry_forward_task_on_date(
+       scope_prefix varchar(6),
+       from_date date,
+       last_date date,
+       task_ids int[]
+) RETURNS void AS $$
+
+  -- Repeat the scope's rows on from_date for each day through
+  -- last_date, for the tasks that are not in task_ids.  Used for the
+  -- tasks that have had no transactions since from_date, whose state
+  -- can't have changed.
+  INSERT INTO task_on_date
+  SELECT scope, day, id, status, project_id, project, projectcolumn,
+         points, maint_type, priority, category_title
+    FROM task_on_date,
+         generate_series(($2 + 1)::timestamp, $3::timestamp, interval '1 day') AS day
+   WHERE scope = $1
+     AND date = $2
+     AND NOT id = ANY($4);
+
+  UPDATE task_on_date_run
+     SET valid_to = $3 + 1
+   WHERE scope = $1
+     AND valid_to = $2 + 1
+     AND NOT id = ANY($4);
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+DROP FUNCTION IF EXISTS create_phab_parent_category_edges(varchar, date, int);
 
 CREATE OR REPLACE FUNCTION create_phab_parent_category_edges(
        scope_prefix varchar(6),
-       working_date date,
-       category_id int
+       first_date date,
+       last_date date,
+       category_tag_ids int[]
 ) RETURNS void AS $$
 
-  INSERT INTO phab_parent_category_edge (
-  SELECT $1,
-         $2,
-         id,
-         $3
-    FROM (SELECT *
-            FROM get_descendents($3, $2)) as x)
+  -- For each day from first_date through last_date, link every task
+  -- blocked, directly or not, by a task that has one of the category
+  -- tags that day, to that task, if it has been in the scope on or
+  -- before that day.
+  WITH first_in_scope AS (
+         SELECT id,
+                min(first_date) AS first_date
+           FROM (SELECT id,
+                        min(date)::date AS first_date
+                   FROM task_on_date
+                  WHERE scope = $1
+                  GROUP BY id
+                  UNION ALL
+                 SELECT id,
+                        min(valid_from)
+                   FROM task_on_date_run
+                  WHERE scope = $1
+                  GROUP BY id) AS forms
+          GROUP BY id
+  ),
+  category_day AS (
+         SELECT DISTINCT mei.task,
+                day::date AS date
+           FROM maniphest_edge_interval mei,
+                first_in_scope fis,
+                generate_series(greatest(mei.valid_from, fis.first_date, $2)::timestamp,
+                                least(mei.valid_to - 1, $3)::timestamp,
+                                interval '1 day') AS day
+          WHERE mei.project = ANY($4)
+            AND mei.task = fis.id
+  )
+  INSERT INTO phab_parent_category_edge
+  SELECT DISTINCT $1,
+         cd.date,
+         mbc.descendant_id,
+         cd.task
+    FROM category_day cd,
+         maniphest_blocked_closure mbc
+   WHERE mbc.ancestor_id = cd.task;
 
 $$ LANGUAGE SQL VOLATILE;
 
 
-CREATE OR REPLACE FUNCTION fix_status(
+CREATE OR REPLACE FUNCTION create_scope_partitions(
        scope_prefix varchar(6)
 ) RETURNS void AS $$
+DECLARE
+    partitioned_table text;
+    partition_index record;
 BEGIN
+    -- Give each table partitioned by scope a partition for this scope,
+    -- with its indexes, if it doesn't have one yet
+    FOR partitioned_table IN
+        SELECT c.relname
+          FROM pg_partitioned_table pt,
+               pg_class c
+         WHERE c.oid = pt.partrelid
+           AND c.relnamespace = current_schema()::text::regnamespace
+    LOOP
+        IF to_regclass(quote_ident(partitioned_table || '_scope_' || scope_prefix)) IS NULL THEN
+            EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES IN (%L)',
+                           partitioned_table || '_scope_' || scope_prefix,
+                           partitioned_table, scope_prefix);
+            FOR partition_index IN
+                SELECT *
+                  FROM get_scope_partition_indexes(scope_prefix, ARRAY[partitioned_table])
+            LOOP
+                EXECUTE format('CREATE INDEX IF NOT EXISTS %I ON %I %s',
+                               partition_index.index_name, partition_index.partition_name,
+                               partition_index.index_definition);
+            END LOOP;
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION drop_scope_partition_indexes(
+       scope_prefix varchar(6),
+       partitioned_tables text[]
+) RETURNS void AS $$
+DECLARE
+    partition_index record;
+BEGIN
+    -- Drop the secondary indexes of the scope's partitions, so that
+    -- rows written in bulk don't have to update them.  They are built
+    -- again, concurrently, by build_scope_partition_indexes in
+    -- phlogiston.py.
+    FOR partition_index IN
+        SELECT *
+          FROM get_scope_partition_indexes(scope_prefix, partitioned_tables)
+    LOOP
+        EXECUTE format('DROP INDEX IF EXISTS %I', partition_index.index_name);
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP FUNCTION IF EXISTS fix_status(varchar);
+
+CREATE OR REPLACE FUNCTION fix_status(
+       scope_prefix varchar(6),
+       task_ids int[] DEFAULT NULL
+) RETURNS void AS $$
+BEGIN
+    -- Only the rows of task_ids, if given, are fixed
 
     UPDATE task_on_date th
        SET status = os.status_at_load
@@ -100,7 +173,27 @@ BEGIN
             WHERE num_of_changes = 1
                       AND trans_status <> status_at_load) os
      WHERE th.scope = scope_prefix
-       AND th.id = os.task_id;
+       AND th.id = os.task_id
+       AND (task_ids IS NULL OR th.id = ANY(task_ids));
+
+    UPDATE task_on_date_run th
+       SET status = os.status_at_load
+      FROM (SELECT task_id,
+                   status_at_load
+              FROM (
+                    SELECT mt.task_id,
+                           left(max(mt.new_value),15) as trans_status,
+                           count(mt.date_modified) as num_of_changes,
+                           max(mta.status_at_load) as status_at_load
+                     FROM maniphest_transaction mt, maniphest_task mta
+                    WHERE mt.transaction_type = 'status'
+                      AND mt.task_id = mta.id
+                    GROUP BY task_id) as flipflops
+            WHERE num_of_changes = 1
+                      AND trans_status <> status_at_load) os
+     WHERE th.scope = scope_prefix
+       AND th.id = os.task_id
+       AND (task_ids IS NULL OR th.id = ANY(task_ids));
 
   -- NOTE: Not sure why the query above is so convoluted; suspect it's 
   -- corrected incorrect status values in some undocumented situation
@@ -113,44 +206,57 @@ BEGIN
        FROM maniphest_task mta
       WHERE tod.id = mta.id
         AND (status IS NULL OR status = '')
-        AND scope = scope_prefix;
+        AND scope = scope_prefix
+        AND (task_ids IS NULL OR tod.id = ANY(task_ids));
+
+     UPDATE task_on_date_run tod
+        SET status = mta.status_at_load
+       FROM maniphest_task mta
+      WHERE tod.id = mta.id
+        AND (status IS NULL OR status = '')
+        AND scope = scope_prefix
+        AND (task_ids IS NULL OR tod.id = ANY(task_ids));
 
 
 END;
 $$ LANGUAGE plpgsql;
 
 
-CREATE OR REPLACE FUNCTION get_phab_parent_categories_by_day(
-       scope_prefix varchar(6),
-       working_date date,
-       category_tag_id int
-) RETURNS TABLE(task int) AS $$
+-- Folded into create_phab_parent_category_edges
+CREATE OR REPLACE FUNCTION finish_reconstruction_run(
+       scope_prefix varchar(6)
+) RETURNS void AS $$
 
-  SELECT DISTINCT task
-    FROM task_on_date t, maniphest_edge m
-   WHERE t.scope = $1
-     AND m.date = $2
-     AND t.id = m.task
-     AND m.project = $3;
+  UPDATE reconstruction_run
+     SET finished_at = now()
+   WHERE scope = $1;
 
-$$ LANGUAGE SQL STABLE;
+$$ LANGUAGE SQL VOLATILE;
 
 
-CREATE OR REPLACE FUNCTION get_edge_value(
-       working_date date,
-       input_task_id int
+CREATE OR REPLACE FUNCTION get_changed_tasks(
+       since date
 ) RETURNS int[] AS $$
-BEGIN
-  RETURN (
-        SELECT mt.edges
-          FROM maniphest_edge_transaction mt
-         WHERE date(mt.date_modified) <= working_date
-           AND mt.task_id = input_task_id
-         ORDER BY date_modified DESC
-         LIMIT 1
-               );
-END;
-$$ LANGUAGE plpgsql;
+
+  -- The tasks with any transaction after midnight at the start of
+  -- since, which are the only tasks whose state can differ from their
+  -- state on that day
+  SELECT coalesce(array_agg(DISTINCT task_id), '{}')
+    FROM (SELECT task_id
+            FROM maniphest_transaction
+           WHERE date_modified > $1
+           UNION ALL
+          SELECT task_id
+            FROM maniphest_edge_transaction
+           WHERE date_modified > $1) AS changed;
+
+$$ LANGUAGE SQL STABLE;
+
+
+DROP FUNCTION IF EXISTS get_phab_parent_categories_by_day(varchar, date, int);
+
+
+DROP FUNCTION IF EXISTS get_edge_value(date, int);
 
 
 CREATE OR REPLACE FUNCTION get_projects_by_name(
@@ -184,40 +290,211 @@ CREATE OR REPLACE FUNCTION get_category_rules(
 $$ LANGUAGE SQL STABLE;
 
 
-CREATE OR REPLACE FUNCTION get_tasks(
-       working_date date,
-       project_ids int[]
-) RETURNS TABLE(id int) AS $$
+CREATE OR REPLACE FUNCTION get_scope_partition_indexes(
+       scope_prefix varchar(6),
+       partitioned_tables text[]
+) RETURNS TABLE(index_name text, partition_name text, index_definition text,
+                is_valid boolean) AS $$
+
+  -- is_valid is null if the index doesn't exist, and false if it was
+  -- left behind by a concurrent build that didn't finish
+  SELECT spi.partitioned_table || '_scope_' || $1 || '_' || spi.index_name,
+         spi.partitioned_table || '_scope_' || $1,
+         spi.index_definition,
+         i.indisvalid
+    FROM scope_partition_index spi
+    LEFT OUTER JOIN pg_index i
+      ON i.indexrelid = to_regclass(quote_ident(spi.partitioned_table || '_scope_' || $1 ||
+                                                '_' || spi.index_name))
+   WHERE spi.partitioned_table = ANY($2)
+   ORDER BY spi.partitioned_table, spi.index_name;
 
-  SELECT DISTINCT task
-    FROM maniphest_edge
-   WHERE date = $1
-     AND project = ANY($2);
+$$ LANGUAGE SQL STABLE;
+
+
+CREATE OR REPLACE FUNCTION get_task_attribute(
+       task_id int,
+       attribute text,
+       as_of date
+) RETURNS text AS $$
+
+  -- The task's status, priority or points at midnight at the start of
+  -- as_of, or NULL if it had none yet
+  SELECT value
+    FROM maniphest_attribute_interval
+   WHERE task = $1
+     AND attribute = $2
+     AND valid_from <= $3
+   ORDER BY valid_from DESC
+   LIMIT 1;
 
 $$ LANGUAGE SQL STABLE;
 
 
-CREATE OR REPLACE FUNCTION get_transaction_value(
-       working_date date,
-       input_transaction_type text,
-       input_task_id int
-) RETURNS table(new_value text) AS $$
+CREATE OR REPLACE FUNCTION get_task_attribute_intervals(
+       task_ids int[],
+       last_date date
+) RETURNS TABLE(task_id int, attribute text, value text, points int, valid_from date,
+                valid_to date) AS $$
 
-  SELECT mt.new_value
-    FROM maniphest_transaction mt
-   WHERE mt.date_modified <= $1
-     AND mt.transaction_type = $2
-     AND mt.task_id = $3
-   ORDER BY date_modified DESC;
+  SELECT task,
+         attribute,
+         value,
+         points,
+         valid_from,
+         valid_to
+    FROM maniphest_attribute_interval
+   WHERE task = ANY($1)
+     AND valid_from <= $2
+   ORDER BY task, attribute, valid_from;
 
 $$ LANGUAGE SQL STABLE;
 
 
+CREATE OR REPLACE FUNCTION get_task_column_intervals(
+       task_ids int[],
+       last_date date
+) RETURNS TABLE(task_id int, project int, column_name text, valid_from date,
+                valid_to date) AS $$
+
+  SELECT mci.task,
+         mci.project,
+         coalesce(pc.name, ''),
+         mci.valid_from,
+         mci.valid_to
+    FROM maniphest_column_interval mci
+    LEFT OUTER JOIN phabricator_column pc
+      ON pc.phid = mci.column_phid
+   WHERE mci.task = ANY($1)
+     AND mci.valid_from <= $2
+   ORDER BY mci.task, mci.project, mci.valid_from;
+
+$$ LANGUAGE SQL STABLE;
+
+
+CREATE OR REPLACE FUNCTION get_task_edge_transactions(
+       task_ids int[],
+       last_date date
+) RETURNS TABLE(task_id int, effective_date date, edges int[]) AS $$
+
+  -- A task's edges on a day are the edges after its last edge
+  -- transaction on or before that day.
+  SELECT task_id,
+         date(date_modified),
+         edges
+    FROM maniphest_edge_transaction
+   WHERE task_id = ANY($1)
+     AND date(date_modified) <= $2
+   ORDER BY task_id, date_modified;
+
+$$ LANGUAGE SQL STABLE;
+
+
+CREATE OR REPLACE FUNCTION get_task_history(
+       scope_prefix varchar(6),
+       dates date[]
+) RETURNS TABLE(scope varchar(6), date timestamp, id int, status text, project_id int,
+                project text, projectcolumn text, points int, maint_type text,
+                priority text, category_title text) AS $$
+
+  -- The scope's task_on_date rows on just the dates given, from
+  -- whichever form they are kept in
+  SELECT scope, date, id, status, project_id, project, projectcolumn,
+         points, maint_type, priority, category_title
+    FROM task_on_date
+   WHERE scope = $1
+     AND date = ANY($2)
+   UNION ALL
+  SELECT r.scope, d.date::timestamp, r.id, r.status, r.project_id, r.project,
+         r.projectcolumn, r.points, r.maint_type, r.priority, r.category_title
+    FROM task_on_date_run r,
+         unnest($2) AS d(date)
+   WHERE r.scope = $1
+     AND daterange(r.valid_from, r.valid_to) @> d.date;
+
+$$ LANGUAGE SQL STABLE;
+
+
+DROP FUNCTION IF EXISTS get_task_intervals(int[], date, date);
+
+CREATE OR REPLACE FUNCTION get_task_intervals(
+       project_ids int[],
+       first_date date,
+       last_date date,
+       task_ids int[] DEFAULT NULL
+) RETURNS TABLE(task int, project int, valid_from date, valid_to date) AS $$
+
+  -- Only the intervals of task_ids, if given
+  SELECT task,
+         project,
+         valid_from,
+         valid_to
+    FROM maniphest_edge_interval
+   WHERE project = ANY($1)
+     AND daterange(valid_from, valid_to) && daterange($2, $3, '[]')
+     AND ($4 IS NULL OR task = ANY($4))
+   ORDER BY task, valid_from;
+
+$$ LANGUAGE SQL STABLE;
+
+
+DROP FUNCTION IF EXISTS get_task_transactions(int[], date);
+DROP FUNCTION IF EXISTS get_tasks(date, int[]);
+DROP FUNCTION IF EXISTS get_transaction_value(date, text, int);
+
+
+DROP FUNCTION IF EXISTS merge_task_on_date_runs(varchar);
+
+CREATE OR REPLACE FUNCTION merge_task_on_date_runs(
+       scope_prefix varchar(6),
+       task_ids int[] DEFAULT NULL
+) RETURNS void AS $$
+
+  -- Join up runs that follow on from one another with the same values,
+  -- as left behind by reconstructing in slices or incrementally, or by
+  -- the passes that update the rows after reconstruction.  Only the
+  -- runs of task_ids are merged, if it is given.  A run
+  -- starts a new group unless it begins where the task's previous run
+  -- with the same values ends.
+  WITH merged_run AS (
+  SELECT scope, id, min(valid_from) AS valid_from, max(valid_to) AS valid_to,
+         status, project_id, project, projectcolumn, points, maint_type, priority,
+         category_title
+    FROM (SELECT *,
+                 count(*) FILTER (WHERE NOT continues) OVER (
+                     PARTITION BY id ORDER BY valid_from) AS run_group
+            FROM (SELECT *,
+                         coalesce(lag(valid_to) OVER same_values = valid_from, false)
+                             AS continues
+                    FROM task_on_date_run
+                   WHERE scope = $1
+                     AND ($2 IS NULL OR id = ANY($2))
+                  WINDOW same_values AS (
+                      PARTITION BY id, status, project_id, project, projectcolumn,
+                                   points, maint_type, priority, category_title
+                      ORDER BY valid_from)) AS runs) AS grouped
+   GROUP BY scope, id, run_group, status, project_id, project, projectcolumn,
+            points, maint_type, priority, category_title),
+  replaced AS (
+  DELETE FROM task_on_date_run
+   WHERE scope = $1
+     AND ($2 IS NULL OR id = ANY($2)))
+  INSERT INTO task_on_date_run
+  SELECT *
+    FROM merged_run;
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+DROP FUNCTION IF EXISTS put_category_tasks_in_own_category(varchar, int);
+
 CREATE OR REPLACE FUNCTION put_category_tasks_in_own_category(
        scope_prefix varchar(6),
-       category_id int
+       category_id int,
+       task_ids int[] DEFAULT NULL
 ) RETURNS void AS $$
 BEGIN
+    -- Only the rows of task_ids, if given, are updated
     UPDATE task_on_date th
        SET category_title = (
                SELECT mt.title
@@ -226,18 +503,128 @@ BEGIN
                )
      WHERE th.id in (
                SELECT DISTINCT task
-                 FROM maniphest_edge
-                WHERE project = category_id)
-       AND th.scope = scope_prefix;
+                 FROM maniphest_edge_interval mei,
+                      (SELECT min(date)::date AS first_date,
+                              max(date)::date AS last_date
+                         FROM task_on_date
+                        WHERE scope = scope_prefix) AS reconstructed
+                WHERE mei.project = category_id
+                  AND daterange(mei.valid_from, mei.valid_to) &&
+                      daterange(first_date, last_date, '[]'))
+       AND th.scope = scope_prefix
+       AND (task_ids IS NULL OR th.id = ANY(task_ids));
+
+    UPDATE task_on_date_run th
+       SET category_title = (
+               SELECT mt.title
+                 FROM maniphest_task mt
+                WHERE th.id = mt.id
+               )
+     WHERE th.id in (
+               SELECT DISTINCT task
+                 FROM maniphest_edge_interval mei,
+                      (SELECT min(valid_from) AS first_date,
+                              max(valid_to) AS last_date
+                         FROM task_on_date_run
+                        WHERE scope = scope_prefix) AS reconstructed
+                WHERE mei.project = category_id
+                  AND daterange(mei.valid_from, mei.valid_to) &&
+                      daterange(first_date, last_date))
+       AND th.scope = scope_prefix
+       AND (task_ids IS NULL OR th.id = ANY(task_ids));
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION set_reconstruction_source(
+       scope_prefix varchar(6)
+) RETURNS void AS $$
+
+  DELETE FROM reconstruction_source
+   WHERE scope = $1;
+
+  INSERT INTO reconstruction_source
+  SELECT $1, fingerprint, now()
+    FROM loaded_dump;
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+DROP FUNCTION IF EXISTS split_task_on_date_runs(varchar, date);
+
+CREATE OR REPLACE FUNCTION split_task_on_date_runs(
+       scope_prefix varchar(6),
+       split_date date,
+       task_ids int[] DEFAULT NULL
+) RETURNS void AS $$
+
+  -- Split the scope's runs that span split_date into the days before it
+  -- and the days from it on, so that the days from it on can be updated
+  -- on their own.  Only the runs of task_ids are split, if it is given.
+  INSERT INTO task_on_date_run
+  SELECT scope, id, $2, valid_to, status, project_id, project, projectcolumn,
+         points, maint_type, priority, category_title
+    FROM task_on_date_run
+   WHERE scope = $1
+     AND valid_from < $2
+     AND valid_to > $2
+     AND ($3 IS NULL OR id = ANY($3));
+
+  UPDATE task_on_date_run
+     SET valid_to = $2
+   WHERE scope = $1
+     AND valid_from < $2
+     AND valid_to > $2
+     AND ($3 IS NULL OR id = ANY($3));
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+CREATE OR REPLACE FUNCTION start_reconstruction_run(
+       scope_prefix varchar(6),
+       start_date date,
+       end_date date,
+       task_ids int[],
+       slices int
+) RETURNS void AS $$
+
+  DELETE FROM reconstruction_progress
+   WHERE scope = $1;
+
+  DELETE FROM reconstruction_run
+   WHERE scope = $1;
+
+  INSERT INTO reconstruction_run
+  VALUES ($1, $2, $3, $4, $5, now(), NULL);
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+CREATE OR REPLACE FUNCTION truncate_scope_partitions(
+       scope_prefix varchar(6),
+       partitioned_tables text[]
+) RETURNS void AS $$
+DECLARE
+    partitioned_table text;
+BEGIN
+    PERFORM create_scope_partitions(scope_prefix);
+    FOREACH partitioned_table IN ARRAY partitioned_tables
+    LOOP
+        EXECUTE format('TRUNCATE %I', partitioned_table || '_scope_' || scope_prefix);
+    END LOOP;
 END;
 $$ LANGUAGE plpgsql;
 
 
+DROP FUNCTION IF EXISTS update_phab_parent_category_titles(varchar, date);
+
 CREATE OR REPLACE FUNCTION update_phab_parent_category_titles(
        scope_prefix varchar(6),
-       start_date date
+       start_date date,
+       task_ids int[] DEFAULT NULL
 ) RETURNS void AS $$
 BEGIN
+    -- Only the rows of task_ids, if given, are updated
     UPDATE task_on_date th
        SET category_title = (
            SELECT string_agg(title, ' ')
@@ -256,7 +643,29 @@ BEGIN
             WHERE id = th.id
             )
      WHERE scope = scope_prefix
-       AND date >= start_date;
+       AND date >= start_date
+       AND (task_ids IS NULL OR th.id = ANY(task_ids));
+
+    UPDATE task_on_date_run th
+       SET category_title = (
+           SELECT string_agg(title, ' ')
+             FROM (
+                   SELECT th_foo.id, mt.title
+                     FROM maniphest_task mt,
+                          phab_parent_category_edge ppce,
+                          task_on_date_run th_foo
+                    WHERE th_foo.id = ppce.task_id
+                      AND th_foo.scope = ppce.scope
+                      AND daterange(th_foo.valid_from, th_foo.valid_to) @> ppce.date::date
+                      AND ppce.category_id = mt.id
+                      AND ppce.scope = scope_prefix
+                    GROUP BY th_foo.id, mt.title
+                    ) as foo
+            WHERE id = th.id
+            )
+     WHERE scope = scope_prefix
+       AND valid_from >= start_date
+       AND (task_ids IS NULL OR th.id = ANY(task_ids));
 END;
 $$ LANGUAGE plpgsql;
 
@@ -264,13 +673,10 @@ $$ LANGUAGE plpgsql;
 CREATE OR REPLACE FUNCTION wipe_reconstruction(
        scope_prefix varchar(6)
 ) RETURNS void AS $$
-BEGIN
-    DELETE FROM task_on_date
-     WHERE scope = scope_prefix;
 
-    DELETE FROM phab_parent_category_edge
-     WHERE scope = scope_prefix;
-END;
-$$ LANGUAGE plpgsql;
+  SELECT truncate_scope_partitions($1, ARRAY['task_on_date', 'task_on_date_run',
+                                             'phab_parent_category_edge']);
+
+$$ LANGUAGE SQL VOLATILE;
 
 
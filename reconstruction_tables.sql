@@ -1,8 +1,18 @@
 DROP TABLE IF EXISTS phab_parent_category_edge;
 DROP TABLE IF EXISTS category;
-DROP TABLE IF EXISTS maniphest_edge;
+DROP TABLE IF EXISTS recategorization_source;
+DROP VIEW IF EXISTS task_history;
 DROP TABLE IF EXISTS task_on_date;
+DROP TABLE IF EXISTS task_on_date_run;
+DROP TABLE IF EXISTS reconstruction_source;
+DROP TABLE IF EXISTS reconstruction_run;
+DROP TABLE IF EXISTS reconstruction_progress;
+DROP TABLE IF EXISTS scope_partition_index;
 
+-- task_on_date, task_on_date_run and phab_parent_category_edge, like
+-- the reporting tables, are partitioned by scope, so that each scope's
+-- rows are wiped with a TRUNCATE and its queries read only its own
+-- partition.  See create_scope_partitions.
 CREATE TABLE task_on_date (
        scope varchar(6),
        date timestamp,
@@ -16,17 +26,62 @@ CREATE TABLE task_on_date (
        priority text,
        category_title text,
        UNIQUE (id, scope, date)
-       );
+       ) PARTITION BY LIST (scope);
 
-CREATE INDEX ON task_on_date (scope);
-CREATE INDEX ON task_on_date (project);
-CREATE INDEX ON task_on_date (project_id);
-CREATE INDEX ON task_on_date (projectcolumn);
-CREATE INDEX ON task_on_date (category_title);
-CREATE INDEX ON task_on_date (status);
-CREATE INDEX ON task_on_date (date);
-CREATE INDEX ON task_on_date (id);
-CREATE INDEX ON task_on_date (date,id);
+
+-- The secondary indexes of the partitions of the tables partitioned by
+-- scope.  They are built on each partition rather than on the
+-- partitioned table, so that a partition's indexes can be dropped while
+-- it is rewritten in bulk and built again afterwards.  Only the indexes
+-- that the reconstruction and reporting queries were found to use, in
+-- pg_stat_user_indexes after a full run of each, are listed.  The
+-- reporting tables add theirs in reporting_tables.sql.
+CREATE TABLE scope_partition_index (
+       partitioned_table text,
+       index_name text,
+       index_definition text,
+       PRIMARY KEY (partitioned_table, index_name)
+);
+
+INSERT INTO scope_partition_index VALUES
+       ('task_on_date', 'id', '(id)'),
+       ('task_on_date', 'date_id', '(date, id)'),
+       ('task_on_date', 'status', '(status)'),
+       ('task_on_date_run', 'id', '(id)'),
+       ('task_on_date_run', 'valid', 'USING gist (daterange(valid_from, valid_to))'),
+       ('phab_parent_category_edge', 'task_id_date', '(task_id, date)');
+
+-- task_on_date in run-length form, for scopes with run_length_history:
+-- one row for each run of days on which a task's task_on_date row is
+-- the same, from valid_from through the day before valid_to.
+CREATE TABLE task_on_date_run (
+       scope varchar(6),
+       id int,
+       valid_from date,
+       valid_to date,
+       status text,
+       project_id int,
+       project text,
+       projectcolumn text,
+       points int,
+       maint_type text,
+       priority text,
+       category_title text
+       ) PARTITION BY LIST (scope);
+
+-- The task_on_date rows of every scope, whichever form they are kept
+-- in.  To read only some of the days of a scope kept in runs, use
+-- get_task_history, which doesn't expand the rest.
+CREATE VIEW task_history AS
+SELECT scope, date, id, status, project_id, project, projectcolumn,
+       points, maint_type, priority, category_title
+  FROM task_on_date
+ UNION ALL
+SELECT scope, date, id, status, project_id, project, projectcolumn,
+       points, maint_type, priority, category_title
+  FROM task_on_date_run,
+       generate_series(valid_from::timestamp, (valid_to - 1)::timestamp,
+                       interval '1 day') AS date;
 
 
 DROP TYPE IF EXISTS categoryrule CASCADE;
@@ -52,23 +107,52 @@ CREATE TABLE category (
        UNIQUE (scope, rule, project_id_list, matchstring)
 );
 
--- no RI for maniphest_edge because it would interfere with reloading from phab dumps
-CREATE TABLE maniphest_edge(
-       task int,
-       project int,
-       date date,
-       unique (task, project, date)
+-- The digests of the recategorization file and of the loaded projects
+-- each scope's category rows were last imported from; see
+-- import_recategorization_file and loaded_dump
+CREATE TABLE recategorization_source (
+       scope varchar(6) PRIMARY KEY,
+       file_digest text,
+       project_digest text
+);
+
+-- The fingerprint of the loaded dump each scope was last reconstructed
+-- from; see loaded_dump
+CREATE TABLE reconstruction_source (
+       scope varchar(6) PRIMARY KEY,
+       dump_fingerprint text,
+       reconstructed_at timestamp with time zone
+);
+
+-- The last reconstruction run of each scope, with the dates and, for
+-- an incremental run, the changed tasks it started with, so that it can
+-- be resumed if it stops before finished_at is set
+CREATE TABLE reconstruction_run (
+       scope varchar(6) PRIMARY KEY,
+       start_date date,
+       end_date date,
+       task_ids int[],
+       slices int,
+       started_at timestamp with time zone,
+       finished_at timestamp with time zone
 );
 
+-- The steps of the last reconstruction run of each scope that have
+-- been committed.  Task reconstruction steps cover the days from
+-- first_date through last_date; the other steps cover the whole run.
+CREATE TABLE reconstruction_progress (
+       scope varchar(6),
+       phase text,
+       first_date date,
+       last_date date,
+       completed_at timestamp with time zone
+);
+
+CREATE INDEX ON reconstruction_progress (scope);
+
 CREATE TABLE phab_parent_category_edge (
        scope varchar(6),
        date timestamp,
        task_id int,
        category_id int
-);
-
-CREATE INDEX ON phab_parent_category_edge (task_id);
-CREATE INDEX ON phab_parent_category_edge (task_id, scope);
-CREATE INDEX ON phab_parent_category_edge (category_id);
-CREATE INDEX ON phab_parent_category_edge (scope);
-CREATE INDEX ON phab_parent_category_edge (task_id, scope, date);
+) PARTITION BY LIST (scope);
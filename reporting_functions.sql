@@ -1,39 +1,66 @@
+DROP FUNCTION IF EXISTS aggregate_task_on_date(varchar(6), agg_range, int[], date[]);
+CREATE OR REPLACE FUNCTION aggregate_task_on_date(
+    scope_prefix varchar(6),
+    cutoff_task_ids int[],
+    lastq_task_ids int[],
+    dates date[] DEFAULT NULL
+    ) RETURNS void AS $$
+
+    -- Aggregate the scope's recategorized rows into all three ranges in
+    -- one pass, leaving the rows of cutoff_task_ids out of the cutoff
+    -- range and those of lastq_task_ids out of the lastq range; only on
+    -- dates, if given
+    DELETE FROM task_on_date_agg
+     WHERE scope = $1
+       AND ($4 IS NULL OR date = ANY($4::timestamp[]));
+
+    INSERT INTO task_on_date_agg (
+    SELECT $1,
+           r.range,
+           a.date,
+           a.category,
+           a.status,
+           r.points,
+           r.count,
+           a.maint_type
+      FROM (SELECT t.date,
+                   t.category,
+                   t.status,
+                   t.maint_type,
+                   SUM(t.points) AS points,
+                   COUNT(t.id) AS count,
+                   SUM(t.points) FILTER (WHERE c.id IS NULL) AS cutoff_points,
+                   COUNT(t.id) FILTER (WHERE c.id IS NULL) AS cutoff_count,
+                   SUM(t.points) FILTER (WHERE l.id IS NULL) AS lastq_points,
+                   COUNT(t.id) FILTER (WHERE l.id IS NULL) AS lastq_count
+              FROM task_on_date_recategorized t
+              LEFT OUTER JOIN unnest($2) AS c(id) ON c.id = t.id
+              LEFT OUTER JOIN unnest($3) AS l(id) ON l.id = t.id
+             WHERE t.scope = $1
+               AND ($4 IS NULL OR t.date = ANY($4::timestamp[]))
+             GROUP BY t.date, t.category, t.status, t.maint_type) AS a,
+           LATERAL (VALUES ('normal'::agg_range, a.points, a.count),
+                           ('cutoff', a.cutoff_points, a.cutoff_count),
+                           ('lastq', a.lastq_points, a.lastq_count))
+               AS r(range, points, count)
+     WHERE r.count > 0);
+
+$$ LANGUAGE SQL VOLATILE;
+
+
+DROP FUNCTION IF EXISTS calculate_velocities(varchar(6));
 CREATE OR REPLACE FUNCTION calculate_velocities(
-    scope_prefix varchar(6)
+    scope_prefix varchar(6),
+    since date DEFAULT NULL
     ) RETURNS date AS $$
 DECLARE
   past_dates date[];
   future_dates date[];
-  weekday date;
   most_recent_data date;
   oldest_data date;
-  weekrow record;
-  tranche record;
-  weeks_ahead int;
-  min_points_vel float;
-  avg_points_vel float;
-  max_points_vel float;
-  min_count_vel float;
-  avg_count_vel float;
-  max_count_vel float;
-  min_points_grow float;
-  avg_points_grow float;
-  max_points_grow float;
-  min_count_grow float;
-  avg_count_grow float;
-  max_count_grow float;
-  threew_max_points_grow float;
-  threem_max_points_grow float;
-  threew_max_count_grow float;
-  threem_max_count_grow float;
-  threew_avg_points_grow float;
-  threem_avg_points_grow float;
-  threew_avg_count_grow float;
-  threem_avg_count_grow float;
+  first_date date;
 BEGIN
 
-    DELETE FROM velocity where scope = scope_prefix;
-
     SELECT MAX(date)
       INTO most_recent_data
       FROM task_on_date_agg
@@ -61,6 +88,33 @@ BEGIN
             '1 week'::interval) dd
     );
 
+    -- A week's velocities depend only on the data of the weeks up to
+    -- it, so if only the data from since on has changed, and the weeks
+    -- fall on the same days as before, the weeks before since are kept.
+    -- The projections are always calculated again.
+    first_date := NULL;
+    IF since IS NOT NULL THEN
+        SELECT CASE WHEN MIN(date) = oldest_data
+                     AND MAX(date) <= most_recent_data
+                     AND (most_recent_data - MAX(date)::date) % 7 = 0
+                    THEN since
+               END
+          INTO first_date
+          FROM velocity
+         WHERE scope = scope_prefix
+           AND count_total IS NOT NULL;
+    END IF;
+
+    IF first_date IS NULL THEN
+        first_date := oldest_data;
+        PERFORM truncate_scope_partitions(scope_prefix, ARRAY['velocity']);
+    ELSE
+        DELETE FROM velocity
+         WHERE scope = scope_prefix
+           AND (date >= first_date
+                OR count_total IS NULL);
+    END IF;
+
     SELECT ARRAY(
     SELECT date_trunc('day', dd)::date
       INTO future_dates
@@ -70,7 +124,7 @@ BEGIN
             '1 week'::interval) dd
     );
 
-    -- load historical data into velocity
+    -- load historical data, with the resolved part of it, into velocity
     INSERT INTO velocity (
     SELECT scope,
            category,
@@ -79,32 +133,16 @@ BEGIN
            date_trunc('month', date) as month,
            date_trunc('quarter', date) as quarter,
            SUM(points) AS points_total,
-           SUM(count) AS count_total
+           SUM(count) AS count_total,
+           SUM(points) FILTER (WHERE status = 'resolved') AS points_resolved,
+           SUM(count) FILTER (WHERE status = 'resolved') AS count_resolved
       FROM task_on_date_agg
      WHERE range = 'normal'
        AND date = ANY (past_dates)
+       AND date >= first_date
        AND scope = scope_prefix
      GROUP BY date, scope, category);
 
-    -- load resolved data velocity
-    UPDATE velocity v
-       SET points_resolved = sum_points_resolved,
-           count_resolved = sum_count_resolved
-      FROM (SELECT scope,
-                   date,
-                   category,
-                   SUM(points) AS sum_points_resolved,
-                   SUM(count) AS sum_count_resolved
-              FROM task_on_date_agg
-             WHERE range = 'normal'
-               AND status = 'resolved'
-               AND scope = scope_prefix
-             GROUP BY scope, date, category) as t
-     WHERE t.date = v.date
-       AND t.category = v.category
-       AND t.scope = v.scope
-       AND v.scope = scope_prefix;
-
     -- calculate deltas for historical data
     UPDATE velocity
        SET delta_points_resolved = COALESCE(subq.delta_points_resolved,0),
@@ -126,322 +164,191 @@ BEGIN
      WHERE scope = scope_prefix) as subq
      WHERE velocity.scope = subq.scope
        AND velocity.date = subq.date
-       AND velocity.category = subq.category;   
-
-    -- calculate retrocasts and forecasts up to current day
-    FOREACH weekday IN ARRAY past_dates
-    LOOP
-        FOR tranche IN SELECT DISTINCT category
-                         FROM task_on_date_agg
-                        WHERE range = 'normal'
-                          AND date = weekday
-                          AND scope = scope_prefix
-                        ORDER BY category
-        LOOP
-            SELECT SUM(total::float)/3
-              INTO min_points_vel
-              FROM (SELECT CASE WHEN delta_points_resolved < 0 THEN 0
-                           ELSE delta_points_resolved
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_points_resolved 
-                     LIMIT 3) AS x;
-
-            SELECT SUM(delta_points_resolved::float)/3
-              INTO max_points_vel
-              FROM (SELECT delta_points_resolved
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_points_resolved DESC
-                     LIMIT 3) AS x;
-
-            SELECT AVG(delta_points_resolved::float)
-              INTO avg_points_vel
-              FROM velocity subqv
-             WHERE subqv.date > weekday - interval '3 weeks'
-               AND subqv.date <= weekday
-               AND subqv.scope = scope_prefix
-               AND subqv.category = tranche.category;
-
-            SELECT SUM(total::float)/3
-              INTO threew_max_points_grow
-              FROM (SELECT CASE WHEN delta_points_total < 0 THEN 0
-                           ELSE delta_points_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 weeks'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_points_total DESC
-                     LIMIT 3) AS x;
-
-            SELECT SUM(total::float)/3
-              INTO threem_max_points_grow
-              FROM (SELECT CASE WHEN delta_points_total < 0 THEN 0
-                           ELSE delta_points_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_points_total DESC
-                     LIMIT 3) AS x;
-
-            SELECT AVG(total::float)
-              INTO threew_avg_points_grow
-              FROM (SELECT CASE WHEN delta_points_total < 0 THEN 0
-                           ELSE delta_points_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 weeks'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category) AS x;
-
-            SELECT AVG(total::float)
-              INTO threem_avg_points_grow
-              FROM (SELECT CASE WHEN delta_points_total < 0 THEN 0
-                           ELSE delta_points_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category) as x;
-
-            SELECT SUM(total::float)/3 AS min_count_vel
-              INTO min_count_vel
-              FROM (SELECT CASE WHEN delta_count_resolved < 0 THEN 0
-                           ELSE delta_count_resolved
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_count_resolved 
-                     LIMIT 3) AS x;
-
-            SELECT SUM(delta_count_resolved::float)/3 AS max_count_vel
-              INTO max_count_vel
-              FROM (SELECT delta_count_resolved
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_count_resolved DESC
-                     LIMIT 3) AS x;
-
-            SELECT AVG(delta_count_resolved::float)
-              INTO avg_count_vel
-              FROM velocity subqv
-             WHERE subqv.date > weekday - interval '3 weeks'
-               AND subqv.date <= weekday
-               AND subqv.scope = scope_prefix
-               AND subqv.category = tranche.category;
-
-            SELECT SUM(total::float)/3
-              INTO threew_max_count_grow
-              FROM (SELECT CASE WHEN delta_count_total < 0 THEN 0
-                           ELSE delta_count_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 weeks'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_count_total DESC
-                     LIMIT 3) AS x;
-
-            SELECT SUM(total::float)/3
-              INTO threem_max_count_grow
-              FROM (SELECT CASE WHEN delta_count_total < 0 THEN 0
-                           ELSE delta_count_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category
-                     ORDER BY subqv.delta_count_total DESC
-                     LIMIT 3) AS x;
-
-            SELECT AVG(total::float)
-              INTO threew_avg_count_grow
-              FROM (SELECT CASE WHEN delta_count_total < 0 THEN 0
-                           ELSE delta_count_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 weeks'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category) AS x;
-
-            SELECT AVG(total::float)
-              INTO threem_avg_count_grow
-              FROM (SELECT CASE WHEN delta_count_total < 0 THEN 0
-                           ELSE delta_count_total
-                           END AS total
-                      FROM velocity subqv
-                     WHERE subqv.date > weekday - interval '3 months'
-                       AND subqv.date <= weekday
-                       AND subqv.scope = scope_prefix
-                       AND subqv.category = tranche.category) as x;
-
-            SELECT threew_avg_points_grow
-              INTO avg_points_grow;
-
-            SELECT GREATEST(threem_avg_points_grow, threem_max_points_grow)
-              INTO max_points_grow;
-
-            SELECT threew_avg_count_grow
-              INTO avg_count_grow;
-
-            SELECT GREATEST(threem_avg_count_grow, threem_max_count_grow)
-              INTO max_count_grow;
-
-            UPDATE velocity
-               SET pes_points_vel = min_points_vel,
-                   nom_points_vel = GREATEST(avg_points_vel,1),
-                   opt_points_vel = GREATEST(max_points_vel,2),
-                   pes_count_vel = min_count_vel,
-                   nom_count_vel = GREATEST(avg_count_vel,1),
-                   opt_count_vel = GREATEST(max_count_vel,2),
-                   opt_points_total_growrate = 0,
-                   nom_points_total_growrate = avg_points_grow,
-                   pes_points_total_growrate = max_points_grow,
-                   opt_count_total_growrate = 0,
-                   nom_count_total_growrate = avg_count_grow,
-                   pes_count_total_growrate = max_count_grow,
-                   threem_max_points_growrate = threem_max_points_grow,
-                   threew_max_points_growrate = threew_max_points_grow,
-                   threem_max_count_growrate = threem_max_count_grow,
-                   threew_max_count_growrate = threew_max_count_grow
-             WHERE scope = scope_prefix
-               AND category = tranche.category
-               AND date = weekday;
-
-        END LOOP;
-    END LOOP;
+       AND velocity.category = subq.category
+       AND velocity.date >= first_date;
+
+    -- The weeks are joined with themselves below, and without fresh
+    -- statistics the planner takes the rewritten partition to be empty
+    EXECUTE format('ANALYZE %I', 'velocity_scope_' || scope_prefix);
+
+    -- calculate retrocasts and forecasts up to current day.  Each week
+    -- of each category is paired with the weeks of the same category in
+    -- the three months up to it, and ranked among them by each delta,
+    -- so that every week's velocities and growth rates come from one
+    -- pass: averages over the last three weeks, and the three lowest
+    -- and highest deltas of the last three weeks and three months
+    UPDATE velocity v
+       SET pes_points_vel = w.min_points_vel,
+           nom_points_vel = GREATEST(w.avg_points_vel,1),
+           opt_points_vel = GREATEST(w.max_points_vel,2),
+           pes_count_vel = w.min_count_vel,
+           nom_count_vel = GREATEST(w.avg_count_vel,1),
+           opt_count_vel = GREATEST(w.max_count_vel,2),
+           opt_points_total_growrate = 0,
+           nom_points_total_growrate = w.threew_avg_points_grow,
+           pes_points_total_growrate = GREATEST(w.threem_avg_points_grow,
+                                                w.threem_max_points_grow),
+           opt_count_total_growrate = 0,
+           nom_count_total_growrate = w.threew_avg_count_grow,
+           pes_count_total_growrate = GREATEST(w.threem_avg_count_grow,
+                                               w.threem_max_count_grow),
+           threem_max_points_growrate = w.threem_max_points_grow,
+           threew_max_points_growrate = w.threew_max_points_grow,
+           threem_max_count_growrate = w.threem_max_count_grow,
+           threew_max_count_growrate = w.threew_max_count_grow
+      FROM (SELECT date,
+                   category,
+                   SUM(GREATEST(delta_points_resolved, 0)::float)
+                       FILTER (WHERE points_resolved_up <= 3) / 3 AS min_points_vel,
+                   SUM(delta_points_resolved::float)
+                       FILTER (WHERE points_resolved_down <= 3) / 3 AS max_points_vel,
+                   AVG(delta_points_resolved::float)
+                       FILTER (WHERE in_three_weeks) AS avg_points_vel,
+                   SUM(GREATEST(delta_points_total, 0)::float)
+                       FILTER (WHERE in_three_weeks
+                                 AND threew_points_total_down <= 3) / 3 AS threew_max_points_grow,
+                   SUM(GREATEST(delta_points_total, 0)::float)
+                       FILTER (WHERE points_total_down <= 3) / 3 AS threem_max_points_grow,
+                   AVG(GREATEST(delta_points_total, 0)::float)
+                       FILTER (WHERE in_three_weeks) AS threew_avg_points_grow,
+                   AVG(GREATEST(delta_points_total, 0)::float) AS threem_avg_points_grow,
+                   SUM(GREATEST(delta_count_resolved, 0)::float)
+                       FILTER (WHERE count_resolved_up <= 3) / 3 AS min_count_vel,
+                   SUM(delta_count_resolved::float)
+                       FILTER (WHERE count_resolved_down <= 3) / 3 AS max_count_vel,
+                   AVG(delta_count_resolved::float)
+                       FILTER (WHERE in_three_weeks) AS avg_count_vel,
+                   SUM(GREATEST(delta_count_total, 0)::float)
+                       FILTER (WHERE in_three_weeks
+                                 AND threew_count_total_down <= 3) / 3 AS threew_max_count_grow,
+                   SUM(GREATEST(delta_count_total, 0)::float)
+                       FILTER (WHERE count_total_down <= 3) / 3 AS threem_max_count_grow,
+                   AVG(GREATEST(delta_count_total, 0)::float)
+                       FILTER (WHERE in_three_weeks) AS threew_avg_count_grow,
+                   AVG(GREATEST(delta_count_total, 0)::float) AS threem_avg_count_grow
+              FROM (SELECT weeks.date,
+                           weeks.category,
+                           past.delta_points_resolved,
+                           past.delta_count_resolved,
+                           past.delta_points_total,
+                           past.delta_count_total,
+                           past.date > weeks.date - interval '3 weeks' AS in_three_weeks,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category
+                                                  ORDER BY past.delta_points_resolved)
+                             AS points_resolved_up,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category
+                                                  ORDER BY past.delta_points_resolved DESC)
+                             AS points_resolved_down,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category
+                                                  ORDER BY past.delta_count_resolved)
+                             AS count_resolved_up,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category
+                                                  ORDER BY past.delta_count_resolved DESC)
+                             AS count_resolved_down,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category
+                                                  ORDER BY past.delta_points_total DESC)
+                             AS points_total_down,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category
+                                                  ORDER BY past.delta_count_total DESC)
+                             AS count_total_down,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category,
+                                                           past.date > weeks.date - interval '3 weeks'
+                                                  ORDER BY past.delta_points_total DESC)
+                             AS threew_points_total_down,
+                           row_number() OVER (PARTITION BY weeks.date, weeks.category,
+                                                           past.date > weeks.date - interval '3 weeks'
+                                                  ORDER BY past.delta_count_total DESC)
+                             AS threew_count_total_down
+                      FROM velocity weeks,
+                           velocity past
+                     WHERE weeks.scope = scope_prefix
+                       AND weeks.date >= first_date
+                       AND past.scope = scope_prefix
+                       AND past.category = weeks.category
+                       AND past.date > weeks.date - interval '3 months'
+                       AND past.date <= weeks.date) AS window_weeks
+             GROUP BY date, category) AS w
+     WHERE v.scope = scope_prefix
+       AND v.date = w.date
+       AND v.category = w.category;
 
     -- generate actual forecast in weeks for all historical data
     -- (for everything but the current week, this is technically a retrocast)
     -- Forecast is size of open backlog divided by velocity
     -- Velocity is forecast velocity, with a minimum of 1 point or story per week,
-    -- minus forecast backlog growth
-
-    UPDATE velocity
-       SET pes_points_fore = ROUND((points_total - points_resolved)::float /
-                                   NULLIF((pes_points_vel - pes_points_total_growrate),0)),
-           nom_points_fore = ROUND((points_total - points_resolved)::float /
-                                   NULLIF((nom_points_vel - nom_points_total_growrate),0)),
-           opt_points_fore = ROUND((points_total - points_resolved)::float /
-                                   NULLIF((opt_points_vel - opt_points_total_growrate),0))
-     WHERE scope = scope_prefix
-       AND points_resolved < points_total;
-
-    UPDATE velocity
-       SET pes_points_fore = NULL
-     WHERE pes_points_fore <= 0
-       AND scope = scope_prefix;
-
-    UPDATE velocity
-       SET nom_points_fore = NULL
-     WHERE nom_points_fore <= 0
-       AND scope = scope_prefix;
-
-    UPDATE velocity
-       SET opt_points_fore = NULL
-     WHERE opt_points_fore <= 0
-       AND scope = scope_prefix;
-
-
-    UPDATE velocity
-       SET pes_count_fore = ROUND((count_total - count_resolved)::float /
-                                   NULLIF((pes_count_vel - pes_count_total_growrate),0)),
-           nom_count_fore = ROUND((count_total - count_resolved)::float /
-                                   NULLIF((nom_count_vel - nom_count_total_growrate),0)),
-           opt_count_fore = ROUND((count_total - count_resolved)::float /
-                                   NULLIF((opt_count_vel - opt_count_total_growrate),0))
-     WHERE scope = scope_prefix
-       AND count_resolved < count_total;
-
-    UPDATE velocity
-       SET pes_count_fore = NULL
-     WHERE pes_count_fore <= 0
-       AND scope = scope_prefix;
-
-    UPDATE velocity
-       SET nom_count_fore = NULL
-     WHERE nom_count_fore <= 0
-       AND scope = scope_prefix;
-
-    UPDATE velocity
-       SET opt_count_fore = NULL
-     WHERE opt_count_fore <= 0
-       AND scope = scope_prefix;
-       
-       
-    -- convert # of weeks in future to specific date
-    
-    UPDATE velocity
-       SET pes_points_date = date_trunc('day', date + (pes_points_fore * interval '1 week')),
-           nom_points_date = date_trunc('day', date + (nom_points_fore * interval '1 week')),
-           opt_points_date = date_trunc('day', date + (opt_points_fore * interval '1 week')),
-           pes_count_date = date_trunc('day', date + (pes_count_fore * interval '1 week')),
-           nom_count_date = date_trunc('day', date + (nom_count_fore * interval '1 week')),
-           opt_count_date = date_trunc('day', date + (opt_count_fore * interval '1 week'))
-     WHERE scope = scope_prefix;
-
-    -- calculate future projections based on today's forecasts
-    -- include today to get zero-based forecast viz lines
-
-    FOR tranche IN SELECT DISTINCT category
-                     FROM task_on_date_agg
-                    WHERE scope = scope_prefix
-                      AND range = 'normal'
-                    ORDER BY category
-    LOOP
-
-        FOREACH weekday IN ARRAY future_dates
-        LOOP
-            weeks_ahead := EXTRACT(EPOCH FROM date_trunc('day', weekday) - date_trunc('day', most_recent_data)) / 604800;
-            INSERT INTO velocity (scope, category, date,
-                   pes_points_growviz, nom_points_growviz, opt_points_growviz,
-                   pes_count_growviz, nom_count_growviz, opt_count_growviz,
-                   pes_points_velviz, nom_points_velviz, opt_points_velviz,
-                   pes_count_velviz, nom_count_velviz, opt_count_velviz) (
-            SELECT scope, category, weekday,
-                   points_total + (pes_points_total_growrate * weeks_ahead),
-                   points_total + (nom_points_total_growrate * weeks_ahead),
-                   points_total + (opt_points_total_growrate * weeks_ahead),
-                   count_total + (pes_count_total_growrate * weeks_ahead),
-                   count_total + (nom_count_total_growrate * weeks_ahead),
-                   count_total + (opt_count_total_growrate * weeks_ahead),
-                   points_resolved + (pes_points_vel * weeks_ahead),
-                   points_resolved + (nom_points_vel * weeks_ahead),
-                   points_resolved + (opt_points_vel * weeks_ahead),
-                   count_resolved + (pes_count_vel * weeks_ahead),
-                   count_resolved + (nom_count_vel * weeks_ahead),
-                   count_resolved + (opt_count_vel * weeks_ahead)
+    -- minus forecast backlog growth.  Forecasts of zero or fewer weeks
+    -- are left NULL.
+    UPDATE velocity v
+       SET pes_points_fore = f.pes_points_fore,
+           nom_points_fore = f.nom_points_fore,
+           opt_points_fore = f.opt_points_fore,
+           pes_count_fore = f.pes_count_fore,
+           nom_count_fore = f.nom_count_fore,
+           opt_count_fore = f.opt_count_fore,
+           -- convert # of weeks in future to specific date
+           pes_points_date = date_trunc('day', v.date + (f.pes_points_fore * interval '1 week')),
+           nom_points_date = date_trunc('day', v.date + (f.nom_points_fore * interval '1 week')),
+           opt_points_date = date_trunc('day', v.date + (f.opt_points_fore * interval '1 week')),
+           pes_count_date = date_trunc('day', v.date + (f.pes_count_fore * interval '1 week')),
+           nom_count_date = date_trunc('day', v.date + (f.nom_count_fore * interval '1 week')),
+           opt_count_date = date_trunc('day', v.date + (f.opt_count_fore * interval '1 week'))
+      FROM (SELECT date,
+                   category,
+                   NULLIF(GREATEST(ROUND((points_total - points_resolved)::float /
+                                         NULLIF((pes_points_vel - pes_points_total_growrate),0)),
+                                   0), 0)::int AS pes_points_fore,
+                   NULLIF(GREATEST(ROUND((points_total - points_resolved)::float /
+                                         NULLIF((nom_points_vel - nom_points_total_growrate),0)),
+                                   0), 0)::int AS nom_points_fore,
+                   NULLIF(GREATEST(ROUND((points_total - points_resolved)::float /
+                                         NULLIF((opt_points_vel - opt_points_total_growrate),0)),
+                                   0), 0)::int AS opt_points_fore,
+                   NULLIF(GREATEST(ROUND((count_total - count_resolved)::float /
+                                         NULLIF((pes_count_vel - pes_count_total_growrate),0)),
+                                   0), 0)::int AS pes_count_fore,
+                   NULLIF(GREATEST(ROUND((count_total - count_resolved)::float /
+                                         NULLIF((nom_count_vel - nom_count_total_growrate),0)),
+                                   0), 0)::int AS nom_count_fore,
+                   NULLIF(GREATEST(ROUND((count_total - count_resolved)::float /
+                                         NULLIF((opt_count_vel - opt_count_total_growrate),0)),
+                                   0), 0)::int AS opt_count_fore
               FROM velocity
              WHERE scope = scope_prefix
-               AND category = tranche.category
-               AND date = most_recent_data
-               AND count_total IS NOT NULL);
+               AND date >= first_date) AS f
+     WHERE v.scope = scope_prefix
+       AND v.date = f.date
+       AND v.category = f.category;
 
-        END LOOP;
-    END LOOP;
+    -- calculate future projections based on today's forecasts
+    -- include today to get zero-based forecast viz lines
+    INSERT INTO velocity (scope, category, date,
+           pes_points_growviz, nom_points_growviz, opt_points_growviz,
+           pes_count_growviz, nom_count_growviz, opt_count_growviz,
+           pes_points_velviz, nom_points_velviz, opt_points_velviz,
+           pes_count_velviz, nom_count_velviz, opt_count_velviz) (
+    SELECT scope, category, weekday,
+           points_total + (pes_points_total_growrate * weeks_ahead),
+           points_total + (nom_points_total_growrate * weeks_ahead),
+           points_total + (opt_points_total_growrate * weeks_ahead),
+           count_total + (pes_count_total_growrate * weeks_ahead),
+           count_total + (nom_count_total_growrate * weeks_ahead),
+           count_total + (opt_count_total_growrate * weeks_ahead),
+           points_resolved + (pes_points_vel * weeks_ahead),
+           points_resolved + (nom_points_vel * weeks_ahead),
+           points_resolved + (opt_points_vel * weeks_ahead),
+           count_resolved + (pes_count_vel * weeks_ahead),
+           count_resolved + (nom_count_vel * weeks_ahead),
+           count_resolved + (opt_count_vel * weeks_ahead)
+      FROM velocity,
+           (SELECT weekday,
+                   (EXTRACT(EPOCH FROM date_trunc('day', weekday) -
+                                       date_trunc('day', most_recent_data)) / 604800)::int
+                     AS weeks_ahead
+              FROM unnest(future_dates) AS weekday) AS future
+     WHERE scope = scope_prefix
+       AND date = most_recent_data
+       AND count_total IS NOT NULL
+     ORDER BY category, weekday);
 
     RETURN most_recent_data;
 END;
@@ -507,6 +414,29 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+DROP FUNCTION IF EXISTS get_recategorization_digest(varchar(6));
+CREATE OR REPLACE FUNCTION get_category_digests(
+    scope_prefix varchar(6)
+    ) RETURNS TABLE(digest text, project_id int) AS $$
+
+  -- A digest of each of the scope's recategorization rules, in sort
+  -- order, with the columns that a column rule's matchstring matches,
+  -- and the project that a task has to be in to match the rule
+  SELECT md5(row(c.rule, c.project_id_list, c.matchstring, c.title, c.display,
+                 c.force_status,
+                 CASE WHEN c.rule = 'ProjectColumn' AND c.matchstring <> '' THEN
+                      (SELECT array_agg(pc.phid ORDER BY pc.phid)
+                         FROM phabricator_column pc
+                        WHERE pc.name LIKE '%' || c.matchstring || '%')
+                 END)::text),
+         c.project_id_list[1]
+    FROM category c
+   WHERE c.scope = $1
+   ORDER BY c.sort_order;
+
+$$ LANGUAGE SQL STABLE;
+
+
 CREATE OR REPLACE FUNCTION get_forecast_weeks(
     scope_prefix varchar(6)
     ) RETURNS TABLE (
@@ -594,6 +524,99 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+CREATE OR REPLACE FUNCTION get_recategorized_changes(
+    scope_prefix varchar(6),
+    since date,
+    task_ids int[]
+    ) RETURNS date[] AS $$
+DECLARE
+  changed_dates date[];
+BEGIN
+
+    -- The days whose recategorized rows may differ from the ones last
+    -- reported: every day after since, and the days through since on
+    -- which the rows of task_ids put aside by replace_tasks_to_recategorize
+    -- differ from the ones that replaced them
+    SELECT array(
+    SELECT DISTINCT date::date
+      FROM ((SELECT *
+               FROM replaced_task_on_date_recategorized
+             EXCEPT ALL
+             SELECT *
+               FROM task_on_date_recategorized
+              WHERE scope = scope_prefix
+                AND date <= since
+                AND id = ANY(task_ids))
+            UNION ALL
+            (SELECT *
+               FROM task_on_date_recategorized
+              WHERE scope = scope_prefix
+                AND date <= since
+                AND id = ANY(task_ids)
+             EXCEPT ALL
+             SELECT *
+               FROM replaced_task_on_date_recategorized)
+            UNION ALL
+             SELECT *
+               FROM task_on_date_recategorized
+              WHERE scope = scope_prefix
+                AND date > since) AS changed
+     ORDER BY date::date)
+      INTO changed_dates;
+
+    DROP TABLE replaced_task_on_date_recategorized;
+
+    RETURN changed_dates;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP FUNCTION IF EXISTS get_reporting_changes(varchar(6), text);
+CREATE OR REPLACE FUNCTION get_reporting_changes(
+    scope_prefix varchar(6),
+    inputs_digest text
+    ) RETURNS TABLE(since date, task_ids int[], category_digests text[],
+                    category_project_ids int[], cutoff_task_ids int[],
+                    lastq_task_ids int[]) AS $$
+
+  -- If the scope's reporting tables were last built from the same
+  -- settings, what can have changed in its history since: nothing, if
+  -- it hasn't been reconstructed again, or the days after since and the
+  -- rows of the tasks changed by its last reconstruction, if that was
+  -- incremental from the last day reported, along with the tasks they
+  -- block, as for its fix-ups.  The recategorization rules and the
+  -- tasks that were left out of the cutoff ranges come with them.
+  -- Otherwise there is no row, and the tables have to be rebuilt.
+  SELECT rw.reported_through,
+         CASE WHEN rr.started_at = rw.reconstruction_started_at
+              THEN '{}'::int[]
+              ELSE array(SELECT unnest(rr.task_ids)
+                          UNION
+                         SELECT descendant_id
+                           FROM maniphest_blocked_closure
+                          WHERE ancestor_id = ANY(rr.task_ids))
+         END,
+         rw.category_digests,
+         rw.category_project_ids,
+         rw.cutoff_task_ids,
+         rw.lastq_task_ids
+    FROM reporting_watermark rw,
+         reconstruction_run rr
+   WHERE rw.scope = $1
+     AND rr.scope = $1
+     AND rw.inputs_digest = $2
+     AND rr.finished_at IS NOT NULL
+     AND (rr.started_at = rw.reconstruction_started_at
+          OR (rr.task_ids IS NOT NULL
+              AND rr.start_date = rw.reported_through
+              AND EXISTS (SELECT *
+                            FROM reconstruction_source rs, loaded_dump ld
+                           WHERE rs.scope = $1
+                             AND rs.dump_fingerprint = ld.fingerprint)));
+
+$$ LANGUAGE SQL STABLE;
+
+
 DROP FUNCTION IF EXISTS get_status_report(character varying, int, date, date);
 CREATE OR REPLACE FUNCTION get_status_report(
     scope_prefix varchar(6),
@@ -652,21 +675,21 @@ BEGIN
 	           q1.status,
                    (SELECT todr2pre.status
                       FROM task_on_date_recategorized as todr2pre,
-                           maniphest_edge me2pre
+                           maniphest_edge_interval me2pre
                      WHERE todr2pre.id = q1.id
                        AND todr2pre.date = initial_date
                        AND todr2pre.scope = scope_prefix
                        AND todr2pre.id = me2pre.task
-                       AND me2pre.date = initial_date
+                       AND daterange(me2pre.valid_from, me2pre.valid_to) @> initial_date
                        AND me2pre.project = status_report_project) AS previous_status,
 		   (SELECT todr2par.status
                       FROM task_on_date_recategorized as todr2par,
-                           maniphest_edge me2par
+                           maniphest_edge_interval me2par
                      WHERE todr2par.id = q1.parent_id
                        AND todr2par.date = initial_date
                        AND todr2par.scope = scope_prefix
                        AND todr2par.id = me2par.task
-                       AND me2par.date = initial_date
+                       AND daterange(me2par.valid_from, me2par.valid_to) @> initial_date
                        AND me2par.project = status_report_project) AS parent_previous_status,
  	           q1.points,
 		   q1.cut_status
@@ -685,8 +708,8 @@ BEGIN
 		     WHERE todr1.scope = scope_prefix
 		       AND todr1.date = final_date
 		       AND todr1.id IN (SELECT task
-		                         FROM maniphest_edge me
-                                        WHERE me.date = final_date
+		                         FROM maniphest_edge_interval me
+                                        WHERE daterange(me.valid_from, me.valid_to) @> final_date
                                           AND project = status_report_project)
                     UNION
                     SELECT DISTINCT ON (todr1a.id) todr1a.id,
@@ -702,12 +725,12 @@ BEGIN
 		     WHERE todr1a.scope = scope_prefix
 		       AND todr1a.date = initial_date
 		       AND todr1a.id IN (SELECT task
-		                         FROM maniphest_edge me
-                                        WHERE me.date = initial_date
+		                         FROM maniphest_edge_interval me
+                                        WHERE daterange(me.valid_from, me.valid_to) @> initial_date
                                           AND project = status_report_project)
 		       AND todr1a.id NOT IN (SELECT task
-   		                              FROM maniphest_edge me
-                                             WHERE me.date = final_date
+   		                              FROM maniphest_edge_interval me
+                                             WHERE daterange(me.valid_from, me.valid_to) @> final_date
                                                AND project = status_report_project)
                    ) as q1
            ) as q2
@@ -756,10 +779,15 @@ END;
 $$ LANGUAGE plpgsql;
 
 
+DROP FUNCTION IF EXISTS load_tasks_to_recategorize(varchar(6));
 CREATE OR REPLACE FUNCTION load_tasks_to_recategorize(
-    scope_prefix varchar(6)
+    scope_prefix varchar(6),
+    since date DEFAULT NULL,
+    task_ids int[] DEFAULT NULL
 ) RETURNS void AS $$
 
+  -- With since, only the days after it and the rows of task_ids are
+  -- loaded.  The rows just loaded are the ones not yet categorized.
   INSERT INTO task_on_date_recategorized(
     SELECT scope,
            date,
@@ -771,102 +799,105 @@ CREATE OR REPLACE FUNCTION load_tasks_to_recategorize(
            status,
            points,
            maint_type
-      FROM task_on_date
+      FROM task_history
      WHERE scope = $1
+       AND ($2 IS NULL
+            OR date > $2
+            OR id = ANY($3))
   );
 
   UPDATE task_on_date_recategorized
      SET status = 'open'
    WHERE status = 'stalled'
-     AND scope = $1;
+     AND scope = $1
+     AND category IS NULL;
 
   DELETE FROM task_on_date_recategorized
    WHERE (status = 'duplicate'
       OR status = 'invalid'
       OR status = 'declined')
-     AND scope = $1;
+     AND scope = $1
+     AND category IS NULL;
 
 $$ LANGUAGE SQL VOLATILE;
 
 
+DROP FUNCTION IF EXISTS get_closed_tasks(varchar(6), date);
+CREATE OR REPLACE FUNCTION get_closed_tasks(
+    scope_prefix varchar(6),
+    since date
+    ) RETURNS TABLE(date timestamp, id int, category text, points int) AS $$
+
+  -- Every day after since on which a task is resolved but was not
+  -- resolved the day before, found in one pass over the scope's
+  -- recategorized rows by comparing each row with the task's previous
+  -- one.  A previous row that is not from the day before, because the
+  -- task was purged from that day, doesn't count as resolved.
+  SELECT date, id, category, points
+    FROM (SELECT date, id, category, points, status,
+                 lag(status) OVER task_days AS previous_status,
+                 lag(date) OVER task_days AS previous_date
+            FROM task_on_date_recategorized
+           WHERE scope = $1
+             AND date >= $2
+          WINDOW task_days AS (PARTITION BY id ORDER BY date)) AS history
+   WHERE status = 'resolved'
+     AND date > $2
+     AND (previous_status IS DISTINCT FROM 'resolved'
+          OR previous_date <> date - interval '1 day');
+
+$$ LANGUAGE SQL STABLE;
+
+
+DROP FUNCTION IF EXISTS populate_recently_closed(varchar(6), date, date);
 CREATE OR REPLACE FUNCTION populate_recently_closed(
     scope_prefix varchar(6),
     start_date date,
-    end_date date
+    end_date date,
+    dates date[] DEFAULT NULL
     ) RETURNS void AS $$
-DECLARE
-  daterow record;
-BEGIN
 
-  FOR daterow IN SELECT date
-                   FROM GENERATE_SERIES(
-                        (start_date::date + '1 day'::interval),
-                        end_date::date,
-                        '1 day'::interval) as date
-    LOOP
-
-        INSERT INTO recently_closed (
-             SELECT scope_prefix as scope,
-                    date,
-                    date_trunc('week', date) as week,
-                    date_trunc('month', date) as month,
-                    date_trunc('quarter', date) as quarter,
-                    category,
-                    SUM(points) AS points,
-                    COUNT(id) AS count
-               FROM task_on_date_recategorized
-              WHERE status = 'resolved'
-                AND date = daterow.date
-                AND scope = scope_prefix
-                AND id NOT IN (SELECT id
-                                 FROM task_on_date_recategorized
-                                WHERE status = 'resolved'
-                                  AND scope = scope_prefix
-                                  AND date = daterow.date - interval '1 day')
-              GROUP BY date, category);
-
-    END LOOP;
+    -- With dates, only the tasks closed on those days are found again
+    DELETE FROM recently_closed
+     WHERE scope = $1
+       AND ($4 IS NULL OR date = ANY($4));
+
+    INSERT INTO recently_closed (
+         SELECT $1 as scope,
+                date,
+                date_trunc('week', date) as week,
+                date_trunc('month', date) as month,
+                date_trunc('quarter', date) as quarter,
+                category,
+                SUM(points) AS points,
+                COUNT(id) AS count
+           FROM get_closed_tasks($1, GREATEST($2, (SELECT MIN(d) - 1
+                                                     FROM unnest($4) AS d)))
+          WHERE date <= $3
+            AND ($4 IS NULL OR date = ANY($4::timestamp[]))
+          GROUP BY date, category);
 
-    RETURN;
-END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE SQL VOLATILE;
 
+
+DROP FUNCTION IF EXISTS populate_recently_closed_task(varchar(6));
 CREATE OR REPLACE FUNCTION populate_recently_closed_task(
-    scope_prefix varchar(6)
+    scope_prefix varchar(6),
+    since date
     ) RETURNS void AS $$
-DECLARE
-  daterow record;
-BEGIN
 
-    FOR daterow IN SELECT DISTINCT date
-                     FROM task_on_date_recategorized
-                    WHERE scope = scope_prefix
-                      AND date > now() - interval '14 days'
-                    ORDER BY date
-    LOOP
-
-        INSERT INTO recently_closed_task (
-             SELECT scope_prefix as scope,
-                    thr.date,
-                    thr.id,
-                    thr.category,
-		    thr.points as points
-              FROM task_on_date_recategorized thr LEFT OUTER JOIN maniphest_task mt USING (id)
-             WHERE thr.status = 'resolved'
-               AND thr.date = daterow.date
-               AND thr.scope = scope_prefix
-               AND thr.id NOT IN (SELECT id
-                                    FROM task_on_date
-                                   WHERE status = 'resolved'
-                                     AND scope = scope_prefix
-                                     AND date = daterow.date - interval '1 day' )
-               
-             );
-    END LOOP;
+    DELETE FROM recently_closed_task
+     WHERE scope = $1;
 
-    RETURN;
-END;
-$$ LANGUAGE plpgsql;
+    INSERT INTO recently_closed_task (
+         SELECT $1 as scope,
+                date,
+                id,
+                category,
+                points
+           FROM get_closed_tasks($1, $2));
+
+$$ LANGUAGE SQL VOLATILE;
 
 
 CREATE OR REPLACE FUNCTION purge_leftover_and_omitted_task_on_date_rec(
@@ -880,7 +911,8 @@ BEGIN
 
 
     DELETE FROM task_on_date_recategorized
-     WHERE category IN
+     WHERE scope = scope_prefix
+       AND category IN
            (SELECT title
               FROM category
              WHERE scope = scope_prefix
@@ -890,7 +922,9 @@ BEGIN
     -- if that list ever grows beyond 1 item, this query must be re-written
     UPDATE task_on_date_recategorized
        SET status = 'resolved'
-     WHERE category IN
+     WHERE scope = scope_prefix
+       AND status IS DISTINCT FROM 'resolved'
+       AND category IN
            (SELECT title
               FROM category
              WHERE scope = scope_prefix
@@ -904,7 +938,7 @@ CREATE OR REPLACE FUNCTION reload_recat(
     scope_prefix varchar(6)
     ) RETURNS void as $$
 BEGIN
-    DELETE FROM task_on_date_recategorized WHERE scope = scope_prefix;
+    PERFORM truncate_scope_partitions(scope_prefix, ARRAY['task_on_date_recategorized']);
 
     /* INCOMPLETE */
 
@@ -912,83 +946,160 @@ END;
 $$ LANGUAGE plpgsql;
 
 
-CREATE OR REPLACE FUNCTION recategorize_by_column(
+CREATE OR REPLACE FUNCTION replace_tasks_to_recategorize(
     scope_prefix varchar(6),
-    project_id_input int[],
-    title text,
-    matchstring text
-) RETURNS void as $$
+    since date,
+    task_ids int[]
+    ) RETURNS void as $$
 BEGIN
 
-  UPDATE task_on_date_recategorized todr
-     SET category = title
-    FROM maniphest_edge me1
-   WHERE todr.scope = scope_prefix
-     AND me1.project = project_id_input[1]
-     AND me1.task = todr.id
-     AND me1.date = todr.date
-     AND todr.category IS NULL
-     AND todr.projectcolumn LIKE '%' || matchstring || '%';
-END;
-$$ LANGUAGE plpgsql;
-
+    -- Load the days after since and the rows of task_ids again, to be
+    -- categorized.  The rows of task_ids through since are put aside
+    -- for get_recategorized_changes to compare with the new ones.
+    DROP TABLE IF EXISTS replaced_task_on_date_recategorized;
+    CREATE TEMP TABLE replaced_task_on_date_recategorized AS
+    SELECT *
+      FROM task_on_date_recategorized
+     WHERE scope = scope_prefix
+       AND date <= since
+       AND id = ANY(task_ids);
 
-CREATE OR REPLACE FUNCTION recategorize_by_parenttask(
-    scope_prefix varchar(6),
-    project_id_input int[],
-    title text,
-    matchstring text
-) RETURNS void as $$
-BEGIN
+    DELETE FROM task_on_date_recategorized
+     WHERE scope = scope_prefix
+       AND (date > since
+            OR id = ANY(task_ids));
 
-  UPDATE task_on_date_recategorized todr
-     SET category = title
-    FROM maniphest_edge me1
-   WHERE todr.scope = scope_prefix
-     AND me1.project = project_id_input[1]
-     AND me1.task = todr.id
-     AND me1.date = todr.date
-     AND todr.category IS NULL
-     AND todr.phab_category_title LIKE '%' || matchstring || '%';
+    PERFORM load_tasks_to_recategorize(scope_prefix, since, task_ids);
 END;
 $$ LANGUAGE plpgsql;
 
-CREATE OR REPLACE FUNCTION recategorize_by_project(
-    scope_prefix varchar(6),
-    project_id_input int[],
-    title text
+
+DROP FUNCTION IF EXISTS recategorize_by_column(varchar(6), int[], text, text);
+DROP FUNCTION IF EXISTS recategorize_by_parenttask(varchar(6), int[], text, text);
+DROP FUNCTION IF EXISTS recategorize_by_project(varchar(6), int[], text);
+DROP FUNCTION IF EXISTS recategorize_by_intersection(varchar(6), int[], text);
+
+CREATE OR REPLACE FUNCTION recategorize(
+    scope_prefix varchar(6)
 ) RETURNS void as $$
-BEGIN
 
+  -- Categorize the scope's rows in one pass.  Each uncategorized row
+  -- takes the title of the first rule, in sort order, that it matches,
+  -- which is what applying the rules one at a time to the rows left
+  -- uncategorized by the ones before would give.  The names of the
+  -- columns and the distinct parent task titles are matched against
+  -- each rule's matchstring once, rather than on every row.
+  WITH rule_columns AS MATERIALIZED (
+       SELECT c.sort_order,
+              array_agg(pc.phid) AS column_phids
+         FROM category c, phabricator_column pc
+        WHERE c.scope = $1
+          AND c.rule = 'ProjectColumn'
+          AND pc.name LIKE '%' || c.matchstring || '%'
+        GROUP BY c.sort_order
+  ), rules AS MATERIALIZED (
+       SELECT c.sort_order,
+              c.rule,
+              c.project_id_list[1] AS project,
+              c.project_id_list[2] AS second_project,
+              c.matchstring,
+              rc.column_phids,
+              c.title
+         FROM category c
+         LEFT OUTER JOIN rule_columns rc USING (sort_order)
+        WHERE c.scope = $1
+          AND c.title IS NOT NULL
+  ), rule_parent_titles AS MATERIALIZED (
+       SELECT r.sort_order,
+              t.phab_category_title
+         FROM rules r,
+              (SELECT DISTINCT phab_category_title
+                 FROM task_on_date_recategorized
+                WHERE scope = $1
+                  AND category IS NULL) AS t
+        WHERE r.rule = 'ParentTask'
+          AND t.phab_category_title LIKE '%' || r.matchstring || '%'
+  ), first_match AS (
+       SELECT DISTINCT ON (todr.id, todr.date)
+              todr.id,
+              todr.date,
+              r.title
+         FROM task_on_date_recategorized todr
+         JOIN maniphest_edge_interval me1
+           ON me1.task = todr.id
+          AND daterange(me1.valid_from, me1.valid_to) @> todr.date::date
+         JOIN rules r
+           ON r.project = me1.project
+         LEFT OUTER JOIN rule_parent_titles rpt
+           ON rpt.sort_order = r.sort_order
+          AND rpt.phab_category_title = todr.phab_category_title
+        WHERE todr.scope = $1
+          AND todr.category IS NULL
+          AND CASE r.rule
+              WHEN 'ProjectByID' THEN true
+              WHEN 'Intersection' THEN
+                   EXISTS (SELECT *
+                             FROM maniphest_edge_interval me2
+                            WHERE me2.project = r.second_project
+                              AND me2.task = todr.id
+                              AND daterange(me2.valid_from, me2.valid_to) @> todr.date::date)
+              WHEN 'ProjectColumn' THEN
+                   r.matchstring = ''
+                   OR EXISTS (SELECT *
+                                FROM maniphest_column_interval mci
+                               WHERE mci.column_phid = ANY(r.column_phids)
+                                 AND mci.task = todr.id
+                                 AND mci.project = todr.project_id
+                                 AND mci.valid_from <= todr.date::date
+                                 AND (mci.valid_to IS NULL
+                                      OR mci.valid_to > todr.date::date))
+              WHEN 'ParentTask' THEN
+                   rpt.sort_order IS NOT NULL
+              ELSE false
+              END
+        ORDER BY todr.id, todr.date, r.sort_order
+  )
   UPDATE task_on_date_recategorized todr
-     SET category = title
-    FROM maniphest_edge me1
-   WHERE todr.scope = scope_prefix
-     AND me1.project = project_id_input[1]
-     AND me1.task = todr.id
-     AND me1.date = todr.date
-     AND todr.category IS NULL;
-END;
-$$ LANGUAGE plpgsql;
+     SET category = first_match.title
+    FROM first_match
+   WHERE todr.scope = $1
+     AND todr.id = first_match.id
+     AND todr.date = first_match.date;
 
+$$ LANGUAGE SQL VOLATILE;
 
-CREATE OR REPLACE FUNCTION recategorize_by_intersection(
-    scope_prefix varchar(6),
-    project_id int[],
-    title text
-) RETURNS void as $$
 
-  UPDATE task_on_date_recategorized todr
-     SET category = $3
-    FROM maniphest_edge me1, maniphest_edge me2
-   WHERE todr.scope = scope_prefix
-     AND me1.project = $2[1]
-     AND me1.task = todr.id
-     AND me1.date = todr.date
-     AND me2.project = $2[2]
-     AND me2.task = todr.id
-     AND me2.date = todr.date
-     AND todr.category IS NULL;
+CREATE OR REPLACE FUNCTION rollup_velocities(
+    scope_prefix varchar(6)
+    ) RETURNS void AS $$
+
+  -- Sum the scope's weekly velocities by week, month and quarter, and
+  -- by category sort order, in one pass
+  SELECT truncate_scope_partitions($1, ARRAY['velocity_rollup']);
+
+  INSERT INTO velocity_rollup (
+  SELECT $1,
+         CASE GROUPING(v.week, v.month)
+              WHEN 1 THEN 'week'
+              WHEN 2 THEN 'month'
+              ELSE 'quarter'
+         END::velocity_period,
+         CASE GROUPING(v.week, v.month)
+              WHEN 1 THEN v.week
+              WHEN 2 THEN v.month
+              ELSE v.quarter
+         END,
+         MAX(v.date),
+         z.sort_order,
+         MAX(v.category),
+         SUM(v.delta_points_resolved),
+         SUM(v.delta_count_resolved)
+    FROM velocity v
+    LEFT OUTER JOIN category z ON v.scope = z.scope AND v.category = z.title
+   WHERE v.scope = $1
+   GROUP BY GROUPING SETS ((v.week, z.sort_order),
+                           (v.month, z.sort_order),
+                           (v.quarter, z.sort_order)));
 
 $$ LANGUAGE SQL VOLATILE;
 
@@ -1037,30 +1148,39 @@ END;
 $$ LANGUAGE plpgsql;
 
 
-CREATE OR REPLACE FUNCTION wipe_reporting(
-       scope_prefix varchar(6)
-) RETURNS void AS $$
-BEGIN
-    DELETE FROM task_on_date_recategorized
-     WHERE scope = scope_prefix;
+DROP FUNCTION IF EXISTS set_reporting_watermark(varchar(6), date, text, int[], int[]);
+CREATE OR REPLACE FUNCTION set_reporting_watermark(
+    scope_prefix varchar(6),
+    reported_through date,
+    inputs_digest text,
+    category_digests text[],
+    category_project_ids int[],
+    cutoff_task_ids int[],
+    lastq_task_ids int[]
+    ) RETURNS void AS $$
 
-    DELETE FROM task_on_date_agg
-     WHERE scope = scope_prefix;
+  DELETE FROM reporting_watermark
+   WHERE scope = $1;
 
-    DELETE FROM recently_closed
-     WHERE scope = scope_prefix;
+  INSERT INTO reporting_watermark
+  SELECT $1, $2, rr.started_at, $3, $4, $5, $6, $7
+    FROM reconstruction_run rr
+   WHERE rr.scope = $1;
 
-    DELETE FROM recently_closed_task
-     WHERE scope = scope_prefix;
+$$ LANGUAGE SQL VOLATILE;
 
-    DELETE FROM maintenance_week
-     WHERE scope = scope_prefix;
 
-    DELETE FROM maintenance_delta
-     WHERE scope = scope_prefix;
+CREATE OR REPLACE FUNCTION wipe_reporting(
+       scope_prefix varchar(6)
+) RETURNS void AS $$
 
-    DELETE FROM velocity
-     WHERE scope = scope_prefix;
+  SELECT truncate_scope_partitions($1, ARRAY['task_on_date_recategorized',
+                                             'task_on_date_agg', 'recently_closed',
+                                             'recently_closed_task', 'maintenance_week',
+                                             'maintenance_delta', 'velocity',
+                                             'velocity_rollup']);
 
-END;
-$$ LANGUAGE plpgsql;
+  DELETE FROM reporting_watermark
+   WHERE scope = $1;
+
+$$ LANGUAGE SQL VOLATILE;
@@ -1,3 +1,6 @@
+-- Each of these tables is partitioned by scope, like task_on_date; see
+-- create_scope_partitions.
+
 DROP TYPE IF EXISTS agg_range CASCADE;
 CREATE TYPE agg_range AS ENUM ('normal', 'cutoff', 'lastq');
 
@@ -12,7 +15,13 @@ CREATE TABLE task_on_date_agg (
        points int,
        count int,
        maint_type text
-);
+) PARTITION BY LIST (scope);
+
+DELETE FROM scope_partition_index
+ WHERE partitioned_table = 'task_on_date_agg';
+
+INSERT INTO scope_partition_index VALUES
+       ('task_on_date_agg', 'date', '(date)');
 
 DROP TABLE IF EXISTS task_on_date_recategorized;
 
@@ -28,12 +37,15 @@ CREATE TABLE task_on_date_recategorized (
        points int,
        maint_type text,
        priority text
-       );
+       ) PARTITION BY LIST (scope);
+
+DELETE FROM scope_partition_index
+ WHERE partitioned_table = 'task_on_date_recategorized';
 
-CREATE INDEX ON task_on_date_recategorized (scope);
-CREATE INDEX ON task_on_date_recategorized (status);
-CREATE INDEX ON task_on_date_recategorized (date);
-CREATE INDEX ON task_on_date_recategorized (id);
+INSERT INTO scope_partition_index VALUES
+       ('task_on_date_recategorized', 'status', '(status)'),
+       ('task_on_date_recategorized', 'date', '(date)'),
+       ('task_on_date_recategorized', 'id', '(id)');
 
 DROP TABLE IF EXISTS recently_closed;
 
@@ -46,7 +58,7 @@ CREATE TABLE recently_closed (
     category text,
     points int,
     count int
-);
+) PARTITION BY LIST (scope);
 
 DROP TABLE IF EXISTS recently_closed_task;
 
@@ -56,7 +68,7 @@ CREATE TABLE recently_closed_task (
     id int,
     category text,
     points int
-);
+) PARTITION BY LIST (scope);
 
 DROP TABLE IF EXISTS maintenance_week;
 DROP TABLE IF EXISTS maintenance_delta;
@@ -67,7 +79,7 @@ CREATE TABLE maintenance_week (
     maint_type text,
     points int,
     count int
-);
+) PARTITION BY LIST (scope);
 
 CREATE TABLE maintenance_delta (
     scope varchar(6),
@@ -77,7 +89,7 @@ CREATE TABLE maintenance_delta (
     new_points int,
     maint_count int,
     new_count int
-);
+) PARTITION BY LIST (scope);
 
 DROP TABLE IF EXISTS velocity;
 
@@ -136,4 +148,52 @@ CREATE TABLE velocity (
     pes_count_velviz float,
     nom_count_velviz float,
     opt_count_velviz float
+) PARTITION BY LIST (scope);
+
+DROP TYPE IF EXISTS velocity_period CASCADE;
+CREATE TYPE velocity_period AS ENUM ('week', 'month', 'quarter');
+
+DROP TABLE IF EXISTS velocity_rollup;
+
+-- The velocities summed by week, month and quarter, as date, and by
+-- category sort order, for the recently closed reports.  The
+-- velocities fall on one day of each week, so the rows summed into a
+-- week are all from last_date.
+CREATE TABLE velocity_rollup (
+    scope varchar(6),
+    period velocity_period,
+    date date,
+    last_date timestamp,
+    sort_order int,
+    category text,
+    points int,
+    count int
+) PARTITION BY LIST (scope);
+
+DELETE FROM scope_partition_index
+ WHERE partitioned_table = 'velocity_rollup';
+
+INSERT INTO scope_partition_index VALUES
+       ('velocity_rollup', 'period_date', '(period, date)');
+
+DROP TABLE IF EXISTS reporting_watermark;
+
+-- What each scope's reporting tables were last built from, so that the
+-- next report can update them rather than rebuild them: the days of
+-- its history through reported_through, as left by the reconstruction
+-- run started at reconstruction_started_at, with the settings summed
+-- up in inputs_digest and the recategorization rules given by the
+-- digest and the project of each, in sort order, as returned by
+-- get_category_digests.  The tasks left out of the cutoff and lastq
+-- ranges are kept to tell which tasks move in or out of them.  Not
+-- partitioned; it has one row per scope.
+CREATE TABLE reporting_watermark (
+       scope varchar(6) PRIMARY KEY,
+       reported_through date,
+       reconstruction_started_at timestamp with time zone,
+       inputs_digest text,
+       category_digests text[],
+       category_project_ids int[],
+       cutoff_task_ids int[],
+       lastq_task_ids int[]
 );